@@ -0,0 +1,118 @@
+"""
+Микробенчмарк: старый путь (распаковка + декодирование текста + обратное кодирование во Flask)
+против нового байтового пайплайна proxy.py на больших текстовых и бинарных телах.
+
+Запуск: python benchmarks/bench_decode.py [--size-mb 16] [--repeat 5]
+"""
+import argparse
+import gzip
+import io
+import os
+import sys
+import time
+
+import requests
+from urllib3 import HTTPResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import proxy
+
+def make_response(body, content_type, content_encoding=None):
+    """Ответ requests поверх тела в памяти, как будто он пришел от origin"""
+    headers = {'Content-Type': content_type, 'Content-Length': str(len(body))}
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+    response = requests.Response()
+    response.status_code = 200
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response.raw = HTTPResponse(
+        body=io.BytesIO(body),
+        headers=headers,
+        status=200,
+        preload_content=False,
+        decode_content=False
+    )
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    return response
+
+def legacy_path(response):
+    """Поведение до перехода на байты: все тело в памяти, decode и обратный encode"""
+    content = response.raw.read(decode_content=False)
+    if response.headers.get('Content-Encoding') == 'gzip':
+        try:
+            content = gzip.decompress(content)
+        except Exception:
+            pass
+
+    text = None
+    if response.encoding:
+        try:
+            text = content.decode(response.encoding)
+        except Exception:
+            pass
+    if text is None:
+        for encoding in ['utf-8', 'latin-1', 'cp1251', 'iso-8859-1']:
+            try:
+                text = content.decode(encoding)
+                break
+            except Exception:
+                continue
+
+    # Flask кодирует строку обратно в UTF-8
+    return len(text.encode('utf-8')) if text is not None else len(content)
+
+def bytes_passthrough(response):
+    """Новый путь: клиент принимает кодировку origin, байты идут как есть"""
+    return sum(len(chunk) for chunk in proxy.iter_response_body(response))
+
+def bytes_transcode(response):
+    """Новый путь: клиент не принимает сжатие, потоковая распаковка в identity"""
+    encoding = proxy.get_content_encoding(response.headers)
+    target = 'identity' if encoding else None
+    return sum(len(chunk) for chunk in proxy.iter_response_body(response, target))
+
+def measure(func, body, content_type, content_encoding, repeat):
+    best = None
+    for _ in range(repeat):
+        response = make_response(body, content_type, content_encoding)
+        start = time.perf_counter()
+        func(response)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=16)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    line = '<p>Привет, мир! Hello, world! 0123456789</p>\n'.encode('utf-8')
+    text = (line * (size // len(line) + 1))[:size]
+    binary = os.urandom(size)
+
+    cases = [
+        ('text identity', text, 'text/html; charset=utf-8', None),
+        ('text gzip', gzip.compress(text, 6), 'text/html; charset=utf-8', 'gzip'),
+        ('binary identity', binary, 'application/octet-stream', None),
+        ('binary gzip', gzip.compress(binary, 1), 'application/octet-stream', 'gzip'),
+    ]
+    paths = [
+        ('legacy decode', legacy_path),
+        ('bytes passthrough', bytes_passthrough),
+        ('bytes transcode', bytes_transcode),
+    ]
+
+    print(f'Тело: {args.size_mb} MB, лучший результат из {args.repeat}')
+    print(f'{"случай":<18}' + ''.join(f'{name:>20}' for name, _ in paths))
+    for case_name, body, content_type, content_encoding in cases:
+        row = f'{case_name:<18}'
+        for _, func in paths:
+            elapsed = measure(func, body, content_type, content_encoding, args.repeat)
+            row += f'{elapsed * 1000:>17.1f} ms'
+        print(row)
+
+if __name__ == '__main__':
+    main()
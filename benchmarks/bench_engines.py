@@ -0,0 +1,166 @@
+"""
+Бенчмарк: потоковый Flask-движок (proxy.py) против asyncio-движка (proxy_async.py)
+на медленном origin. Показывает, с какой конкурентности асинхронный движок
+начинает выигрывать по пропускной способности.
+
+Запуск: python benchmarks/bench_engines.py [--latency 0.5] [--levels 10,50,100,500,1000]
+"""
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'порт {port} так и не открылся')
+
+def run_origin(port, latency, body_size):
+    """Медленный origin: отвечает через latency секунд телом body_size байт"""
+    body = b'x' * body_size
+
+    async def handler(request):
+        await asyncio.sleep(latency)
+        return web.Response(body=body, content_type='application/octet-stream')
+
+    app = web.Application()
+    app.router.add_get('/{tail:.*}', handler)
+    web.run_app(app, host='127.0.0.1', port=port, access_log=None, print=None, backlog=4096)
+
+def start_process(args, port, extra_env=None):
+    env = dict(os.environ, PORT=str(port), PROXY_CACHE='0', PROXY_COALESCE='0')
+    env.update(extra_env or {})
+    process = subprocess.Popen(
+        [sys.executable] + args, cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    wait_for_port(port)
+    return process
+
+async def run_level(proxy_port, origin_port, concurrency, requests_per_worker, timeout):
+    """Прогоняет concurrency параллельных клиентов, каждый делает requests_per_worker запросов"""
+    latencies = []
+    errors = 0
+    connector = aiohttp.TCPConnector(limit=0)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        async def worker(worker_id):
+            nonlocal errors
+            for i in range(requests_per_worker):
+                # Уникальный путь на каждый запрос, чтобы прокси не мог объединить запросы
+                url = f'http://127.0.0.1:{proxy_port}/url=http://127.0.0.1:{origin_port}/{worker_id}/{i}'
+                start = time.perf_counter()
+                try:
+                    async with session.get(url) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                            continue
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    def percentile(p):
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    return {
+        'concurrency': concurrency,
+        'ok': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(0.50),
+        'p99': percentile(0.99),
+    }
+
+def format_ms(value):
+    return f'{value * 1000:.0f}' if value is not None else '-'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.5, help='задержка origin, секунд')
+    parser.add_argument('--body-size', type=int, default=1024)
+    parser.add_argument('--levels', default='10,50,100,250,500,1000,2000')
+    parser.add_argument('--requests-per-worker', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--origin', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.origin:
+        run_origin(args.origin, args.latency, args.body_size)
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    levels = [int(level) for level in args.levels.split(',')]
+    origin_port, threaded_port, async_port = free_port(), free_port(), free_port()
+
+    processes = [start_process(
+        ['benchmarks/bench_engines.py', '--origin', str(origin_port),
+         '--latency', str(args.latency), '--body-size', str(args.body_size)],
+        origin_port
+    )]
+    try:
+        processes.append(start_process(['proxy.py'], threaded_port))
+        processes.append(start_process(['proxy_async.py'], async_port))
+
+        results = {'threaded': [], 'async': []}
+        for level in levels:
+            for engine, port in (('threaded', threaded_port), ('async', async_port)):
+                result = asyncio.run(run_level(
+                    port, origin_port, level, args.requests_per_worker, args.timeout
+                ))
+                results[engine].append(result)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    print(f'origin: задержка {args.latency}s, тело {args.body_size} байт')
+    print(f'{"конкур.":>8} | {"threaded rps":>12} {"p50 ms":>7} {"p99 ms":>7} {"ошибки":>6} | '
+          f'{"async rps":>10} {"p50 ms":>7} {"p99 ms":>7} {"ошибки":>6}')
+    crossover = None
+    for threaded, asynchronous in zip(results['threaded'], results['async']):
+        print(f'{threaded["concurrency"]:>8} | '
+              f'{threaded["rps"]:>12.1f} {format_ms(threaded["p50"]):>7} {format_ms(threaded["p99"]):>7} {threaded["errors"]:>6} | '
+              f'{asynchronous["rps"]:>10.1f} {format_ms(asynchronous["p50"]):>7} {format_ms(asynchronous["p99"]):>7} {asynchronous["errors"]:>6}')
+        if crossover is None and asynchronous['rps'] > threaded['rps'] * 1.1:
+            crossover = threaded['concurrency']
+
+    if crossover is None:
+        print('Точка пересечения не достигнута на заданных уровнях конкурентности')
+    else:
+        print(f'asyncio-движок быстрее потокового (>10%) начиная с {crossover} одновременных запросов')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Микробенчмарк: глобальный счетчик под общей блокировкой (старый request_count)
+против шардированных метрик proxy.py. Как во Flask с threaded=True, каждый
+запрос обслуживается новым потоком, одновременно живут не больше --threads потоков.
+
+Запуск: python benchmarks/bench_metrics.py [--threads 1,4,16] [--requests 20000]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import proxy
+
+def run_requests(threads, requests, handle):
+    """Запускает handle в отдельном потоке на каждый запрос, не больше threads одновременно"""
+    slots = threading.BoundedSemaphore(threads)
+
+    def serve():
+        try:
+            handle()
+        finally:
+            slots.release()
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        slots.acquire()
+        threading.Thread(target=serve).start()
+    # Дожидаемся последних потоков, забирая все слоты
+    for _ in range(threads):
+        slots.acquire()
+    return time.perf_counter() - start
+
+def bench_locked(threads, requests):
+    state = {'count': 0}
+    lock = threading.Lock()
+
+    def handle():
+        for _ in range(3):
+            with lock:
+                state['count'] += 1
+
+    return run_requests(threads, requests, handle)
+
+def bench_sharded(threads, requests):
+    labels = (('route', 'bench'), ('host', 'example.com'), ('status', '200'))
+
+    def handle():
+        proxy.metrics.inc('dh_proxy_requests_total', labels)
+        proxy.metrics.observe('dh_proxy_request_duration_seconds', 0.05, labels)
+        proxy.metrics.inc('dh_proxy_response_bytes_total', labels, 1024)
+
+    return run_requests(threads, requests, handle)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', default='1,4,16')
+    parser.add_argument('--requests', type=int, default=20000, help='запросов (потоков) на прогон')
+    args = parser.parse_args()
+
+    print(f'{"потоков":>8} | {"lock ns/запрос":>14} | {"metrics ns/запрос":>17}')
+    for threads in [int(value) for value in args.threads.split(',')]:
+        locked = bench_locked(threads, args.requests) / args.requests * 1e9
+        sharded = bench_sharded(threads, args.requests) / args.requests * 1e9
+        print(f'{threads:>8} | {locked:>14.0f} | {sharded:>17.0f}')
+
+if __name__ == '__main__':
+    main()
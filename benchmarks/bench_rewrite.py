@@ -0,0 +1,133 @@
+"""
+Микробенчмарк: потоковое переписывание ссылок HTML/CSS (LinkRewriteStage) против
+буферизации всего документа на многомегабайтных страницах, без сжатия и с gzip.
+
+Показывает пропускную способность (MB/s) и пик памяти Python на один документ.
+
+Запуск: python benchmarks/bench_rewrite.py [--size-mb 8] [--repeat 5]
+"""
+import argparse
+import gzip
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+import requests
+from urllib3 import HTTPResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import proxy
+
+BASE_URL = 'https://example.com/catalog/index.html'
+
+# Типичная разметка: ссылки, картинки, инлайновые стили и текст без ссылок
+HTML_SAMPLE = (
+    b'<div class="item"><a href="/product/12345?ref=list">Product</a>'
+    b'<img src="img/thumb_12345.jpg" alt="thumb" loading="lazy">'
+    b'<span style="background:url(\'/static/bg.png\')">Lorem ipsum dolor sit amet, '
+    b'consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore.</span>'
+    b'<a href="#reviews">Reviews</a></div>\n'
+)
+CSS_SAMPLE = (
+    b'.item-12345 { background: url("../img/sprite.png") no-repeat; margin: 0 auto; }\n'
+    b'.icon { background-image: url(icons/star.svg); width: 16px; height: 16px; }\n'
+    b'.text { font: 14px/1.4 sans-serif; color: #333; padding: 4px 8px; }\n'
+)
+
+def make_response(body, content_type, content_encoding=None):
+    """Ответ requests поверх тела в памяти, как будто он пришел от origin"""
+    headers = {'Content-Type': content_type, 'Content-Length': str(len(body))}
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+    response = requests.Response()
+    response.status_code = 200
+    response.url = BASE_URL
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response.raw = HTTPResponse(
+        body=io.BytesIO(body),
+        headers=headers,
+        status=200,
+        preload_content=False,
+        decode_content=False
+    )
+    return response
+
+def link_stage(response):
+    mimetype, _ = proxy.parse_content_type(response.headers['Content-Type'])
+    patterns, boundaries = proxy.LINK_REWRITE_TYPES[mimetype]
+    return proxy.LinkRewriteStage(BASE_URL, patterns, boundaries)
+
+def passthrough(response):
+    """Без переписывания: байты origin как есть"""
+    return sum(len(chunk) for chunk in proxy.iter_response_body(response))
+
+def buffered(response):
+    """Весь документ в памяти: распаковка, переписывание одним куском, сжатие обратно"""
+    encoding = proxy.get_content_encoding(response.headers)
+    body = b''.join(proxy.iter_response_body(response, 'identity' if encoding else None))
+    stage = link_stage(response)
+    body = stage.feed(body) + stage.flush()
+    if encoding:
+        body = gzip.compress(body, 6)
+    return len(body)
+
+def streaming(response):
+    """Потоковая стадия: по чанку, с перекодированием обратно в исходное сжатие"""
+    encoding = proxy.get_content_encoding(response.headers)
+    target = 'gzip' if encoding else 'identity'
+    chunks = proxy.iter_response_body(response, target, stages=[link_stage(response)])
+    return sum(len(chunk) for chunk in chunks)
+
+def measure(func, body, content_type, content_encoding, repeat):
+    best = None
+    for _ in range(repeat):
+        response = make_response(body, content_type, content_encoding)
+        start = time.perf_counter()
+        func(response)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # Пик памяти - отдельным прогоном: tracemalloc заметно замедляет выполнение
+    response = make_response(body, content_type, content_encoding)
+    tracemalloc.start()
+    func(response)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=8)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    html = (HTML_SAMPLE * (size // len(HTML_SAMPLE) + 1))[:size]
+    css = (CSS_SAMPLE * (size // len(CSS_SAMPLE) + 1))[:size]
+
+    cases = [
+        ('html identity', html, 'text/html; charset=utf-8', None),
+        ('html gzip', gzip.compress(html, 6), 'text/html; charset=utf-8', 'gzip'),
+        ('css identity', css, 'text/css', None),
+        ('css gzip', gzip.compress(css, 6), 'text/css', 'gzip'),
+    ]
+    paths = [
+        ('passthrough', passthrough),
+        ('buffered rewrite', buffered),
+        ('streaming rewrite', streaming),
+    ]
+
+    print(f'Документ: {args.size_mb} MB, лучший результат из {args.repeat}; MB/s по несжатому размеру, пик памяти')
+    print(f'{"случай":<15}' + ''.join(f'{name:>28}' for name, _ in paths))
+    for case_name, body, content_type, content_encoding in cases:
+        row = f'{case_name:<15}'
+        for _, func in paths:
+            elapsed, peak = measure(func, body, content_type, content_encoding, args.repeat)
+            row += f'{size / elapsed / 1024 / 1024:>15.1f} MB/s {peak / 1024 / 1024:>6.1f} MB'
+        print(row)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""
+Нагрузочный тест прокси: поднимает локальный origin (benchmarks/origin.py) и
+прокси, гоняет по маршрутам /url= набор сценариев с заданной конкурентностью.
+
+Для каждого сценария считает пропускную способность, p50/p95/p99 задержки,
+RSS и CPU процесса прокси на один запрос. Результаты пишутся в JSON, чтобы
+сравнивать их между коммитами.
+
+Запуск:
+  python benchmarks/loadtest.py [--engine proxy.py] [--concurrency 50] [--duration 10]
+  python benchmarks/loadtest.py --scenarios gzip,br --output before.json
+  python benchmarks/loadtest.py --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import origin
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+SCENARIOS = {
+    'small': {'size': 1024},
+    'large': {'size': 1024 * 1024},
+    'gzip': {'size': 64 * 1024, 'encoding': 'gzip'},
+    'br': {'size': 64 * 1024, 'encoding': 'br'},
+    'chunked': {'size': 256 * 1024, 'chunked': True},
+    'slow': {'size': 4096, 'latency': 0.1},
+    'post': {'size': 16 * 1024, 'method': 'POST'},
+}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'порт {port} так и не открылся')
+
+def start_process(args, port, extra_env=None):
+    env = dict(os.environ, PORT=str(port))
+    env.update(extra_env or {})
+    process = subprocess.Popen(
+        [sys.executable] + args, cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    wait_for_port(port)
+    return process
+
+def read_process_stats(pid):
+    """CPU (секунды user+system) и RSS (байты) процесса из /proc, None вне Linux"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/statm') as f:
+            rss_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    return cpu, rss_pages * resource.getpagesize()
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('-dirty' if dirty else '')
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+async def run_scenario(proxy_port, origin_port, pid, scenario, concurrency, duration, warmup, timeout):
+    """Замкнутый цикл: concurrency клиентов шлют запросы друг за другом в течение duration секунд"""
+    options = dict(scenario)
+    method = options.pop('method', 'GET')
+    path = origin.build_path(**options)
+    payload = b'x' * options.get('size', 1024) if method == 'POST' else None
+    headers = {'Accept-Encoding': 'gzip, br'}
+
+    latencies = []
+    errors = 0
+    received = 0
+    counter = 0
+    measuring = False
+    stop_at = 0.0
+
+    connector = aiohttp.TCPConnector(limit=0)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout, auto_decompress=False) as session:
+        async def worker():
+            nonlocal errors, received, counter
+            while time.perf_counter() < stop_at:
+                counter += 1
+                # Уникальный хвост пути, чтобы кэш и объединение запросов не искажали замер
+                url = f'http://127.0.0.1:{proxy_port}/url=http://127.0.0.1:{origin_port}{path}/{counter}'
+                start = time.perf_counter()
+                try:
+                    async with session.request(method, url, headers=headers, data=payload) as response:
+                        body = await response.read()
+                        ok = response.status == 200
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    ok = False
+                if not measuring:
+                    continue
+                if not ok:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+                received += len(body)
+
+        # Прогрев: соединения к прокси и origin открываются до начала замера
+        stop_at = time.perf_counter() + warmup
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+        measuring = True
+        before = read_process_stats(pid)
+        start = time.perf_counter()
+        stop_at = start + duration
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        after = read_process_stats(pid)
+
+    latencies.sort()
+    result = {
+        'scenario': scenario,
+        'method': method,
+        'concurrency': concurrency,
+        'duration': round(elapsed, 3),
+        'ok': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'received_mb_per_s': round(received / elapsed / 1024 / 1024, 2) if elapsed else 0.0,
+        'p50_ms': None,
+        'p95_ms': None,
+        'p99_ms': None,
+        'rss_mb': None,
+        'cpu_ms_per_request': None,
+    }
+    for name, p in (('p50_ms', 0.50), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+        value = percentile(latencies, p)
+        if value is not None:
+            result[name] = round(value * 1000, 2)
+    if before and after:
+        result['rss_mb'] = round(after[1] / 1024 / 1024, 1)
+        if latencies:
+            result['cpu_ms_per_request'] = round((after[0] - before[0]) * 1000 / len(latencies), 3)
+    return result
+
+def format_value(value, pattern='{:.1f}'):
+    return pattern.format(value) if value is not None else '-'
+
+def print_results(report, baseline=None):
+    previous = {}
+    if baseline:
+        previous = {item['name']: item for item in baseline['results']}
+
+    print(f'{report["engine"]} @ {report["revision"] or "?"}, конкурентность {report["concurrency"]}, '
+          f'{report["duration"]}s на сценарий')
+    print(f'{"сценарий":>10} | {"rps":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+          f'{"ошибки":>6} {"RSS MB":>7} {"CPU ms/req":>10}')
+    for item in report['results']:
+        line = (f'{item["name"]:>10} | {item["rps"]:>8.1f} {format_value(item["p50_ms"]):>8} '
+                f'{format_value(item["p95_ms"]):>8} {format_value(item["p99_ms"]):>8} {item["errors"]:>6} '
+                f'{format_value(item["rss_mb"]):>7} {format_value(item["cpu_ms_per_request"], "{:.3f}"):>10}')
+        old = previous.get(item['name'])
+        if old and old['rps']:
+            change = (item['rps'] - old['rps']) / old['rps'] * 100
+            line += f'  rps {change:+.1f}%'
+            if old['p99_ms'] and item['p99_ms']:
+                line += f', p99 {(item["p99_ms"] - old["p99_ms"]) / old["p99_ms"] * 100:+.1f}%'
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--engine', default='proxy.py', help='proxy.py или proxy_async.py')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='через запятую: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10, help='секунд на сценарий')
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='переменные окружения прокси, например PROXY_CACHE=1')
+    parser.add_argument('--output', help='файл JSON с результатами (по умолчанию benchmarks/results/)')
+    parser.add_argument('--compare', help='JSON прошлого прогона для сравнения')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    names = [name for name in args.scenarios.split(',') if name]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'неизвестные сценарии: {", ".join(unknown)}')
+
+    # Кэш и объединение запросов по умолчанию выключены: меряем сам путь проксирования
+    proxy_env = {'PROXY_CACHE': '0', 'PROXY_COALESCE': '0'}
+    for item in args.env:
+        key, _, value = item.partition('=')
+        proxy_env[key] = value
+
+    origin_port, proxy_port = free_port(), free_port()
+    processes = [start_process(['benchmarks/origin.py', '--port', str(origin_port)], origin_port)]
+    try:
+        proxy_process = start_process([args.engine], proxy_port, proxy_env)
+        processes.append(proxy_process)
+
+        results = []
+        for name in names:
+            result = asyncio.run(run_scenario(
+                proxy_port, origin_port, proxy_process.pid, SCENARIOS[name],
+                args.concurrency, args.duration, args.warmup, args.timeout
+            ))
+            results.append(dict(name=name, **result))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'engine': args.engine,
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'proxy_env': proxy_env,
+        'results': results,
+    }
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        engine = os.path.splitext(os.path.basename(args.engine))[0]
+        output = os.path.join(
+            RESULTS_DIR, f'{time.strftime("%Y%m%d-%H%M%S")}-{report["revision"] or "unknown"}-{engine}.json'
+        )
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(report, baseline)
+    print(f'Результаты: {output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Локальный origin для нагрузочных тестов прокси.
+
+Параметры ответа задаются сегментами пути, потому что прокси не передает
+query string: /size=65536/latency=0.05/encoding=gzip/chunked=1/<что угодно>
+
+  size     - размер несжатого тела в байтах (по умолчанию 1024)
+  latency  - задержка перед ответом, секунд (по умолчанию 0)
+  encoding - identity, gzip или br (по умолчанию identity)
+  chunked  - 1: тело отдается частями без Content-Length
+
+Запуск: python benchmarks/origin.py [--port 18080]
+"""
+import argparse
+import asyncio
+import functools
+import gzip
+
+import brotli
+from aiohttp import web
+
+CHUNK_SIZE = 16 * 1024
+
+# Похоже на обычную HTML-страницу, чтобы степень сжатия была реалистичной
+SAMPLE = (
+    b'<div class="item"><a href="https://example.com/page">DH PROXY</a>'
+    b'<span>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</span></div>\n'
+)
+
+def parse_options(path):
+    options = {'size': 1024, 'latency': 0.0, 'encoding': 'identity', 'chunked': False}
+    for segment in path.split('/'):
+        key, sep, value = segment.partition('=')
+        if not sep or key not in options:
+            continue
+        if key == 'size':
+            options['size'] = int(value)
+        elif key == 'latency':
+            options['latency'] = float(value)
+        elif key == 'encoding':
+            options['encoding'] = value
+        else:
+            options['chunked'] = value not in ('0', '')
+    return options
+
+def build_path(size=1024, latency=0.0, encoding='identity', chunked=False):
+    """Путь на origin для заданных параметров ответа"""
+    return f'/size={size}/latency={latency}/encoding={encoding}/chunked={int(chunked)}'
+
+@functools.lru_cache(maxsize=64)
+def make_body(size, encoding):
+    """Тело ответа считается один раз на пару (размер, сжатие)"""
+    body = (SAMPLE * (size // len(SAMPLE) + 1))[:size]
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return body
+
+async def handler(request):
+    options = parse_options(request.path)
+    if options['latency']:
+        await asyncio.sleep(options['latency'])
+
+    body = make_body(options['size'], options['encoding'])
+    headers = {'Content-Type': 'text/html; charset=utf-8', 'Cache-Control': 'no-store'}
+    if options['encoding'] != 'identity':
+        headers['Content-Encoding'] = options['encoding']
+
+    if not options['chunked']:
+        return web.Response(body=body, headers=headers)
+
+    response = web.StreamResponse(headers=headers)
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    for offset in range(0, len(body), CHUNK_SIZE):
+        await response.write(body[offset:offset + CHUNK_SIZE])
+    await response.write_eof()
+    return response
+
+async def echo(request):
+    body = await request.read()
+    return web.Response(body=body, content_type='application/octet-stream')
+
+def create_app():
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_post('/{tail:.*}', echo)
+    app.router.add_route('GET', '/{tail:.*}', handler)
+    return app
+
+def run(port, host='127.0.0.1'):
+    web.run_app(create_app(), host=host, port=port, access_log=None, print=None, backlog=4096)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    args = parser.parse_args()
+    run(args.port, args.host)
+
+if __name__ == '__main__':
+    main()
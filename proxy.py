@@ -1,15 +1,197 @@
 from flask import Flask, request, Response, render_template_string
 import requests
-from urllib.parse import unquote
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import unquote, urljoin, urlsplit
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.ssl_ import create_urllib3_context
+from urllib3.exceptions import NameResolutionError, NewConnectionError, ConnectTimeoutError
+from http.cookiejar import DefaultCookiePolicy
+from collections import OrderedDict, deque
+import email.utils
+import hashlib
+import hmac
+import tempfile
 import threading
-import gzip
+import certifi
+import time
+import zlib
+import codecs
+import re
 import brotli
 import json
+import os
+import bisect
+import functools
+import fnmatch
+import ipaddress
+import socket
+import mmap
+import base64
+import binascii
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import dns.resolver
+    import dns.exception
+    import dns.name
+except ImportError:
+    dns = None
 
 app = Flask(__name__)
 
-request_count = 0
-count_lock = threading.Lock()
+# Настройки пула соединений к origin-серверам
+UPSTREAM_POOL_ORIGINS = int(os.environ.get('UPSTREAM_POOL_ORIGINS', 100))
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 32))
+UPSTREAM_IDLE_TIMEOUT = float(os.environ.get('UPSTREAM_IDLE_TIMEOUT', 60))
+UPSTREAM_TIMEOUT = float(os.environ.get('UPSTREAM_TIMEOUT', 30))
+
+# Адаптивные таймауты: после TIMEOUT_MIN_SAMPLES замеров таймауты хоста = p99 задержки * TIMEOUT_MULTIPLIER,
+# пока замеров мало - UPSTREAM_TIMEOUT
+ADAPTIVE_TIMEOUTS = os.environ.get('PROXY_ADAPTIVE_TIMEOUTS', '1') == '1'
+LATENCY_SAMPLES = int(os.environ.get('PROXY_LATENCY_SAMPLES', 256))
+LATENCY_MAX_HOSTS = int(os.environ.get('PROXY_LATENCY_MAX_HOSTS', 10000))
+TIMEOUT_MIN_SAMPLES = int(os.environ.get('PROXY_TIMEOUT_MIN_SAMPLES', 20))
+TIMEOUT_MULTIPLIER = float(os.environ.get('PROXY_TIMEOUT_MULTIPLIER', 4))
+CONNECT_TIMEOUT_MIN = float(os.environ.get('PROXY_CONNECT_TIMEOUT_MIN', 1))
+READ_TIMEOUT_MIN = float(os.environ.get('PROXY_READ_TIMEOUT_MIN', 5))
+TIMEOUT_MAX = float(os.environ.get('PROXY_TIMEOUT_MAX', 60))
+
+# Hedged GET: второй запрос уходит, если origin не ответил за p95; повторы ограничены общим бюджетом -
+# не больше RETRY_BUDGET_RATIO от числа запросов плюс RETRY_BUDGET_MIN_PER_SECOND
+HEDGE_ENABLED = os.environ.get('PROXY_HEDGE', '0') == '1'
+HEDGE_MIN_DELAY = float(os.environ.get('PROXY_HEDGE_MIN_DELAY', 0.05))
+HEDGE_WORKERS = int(os.environ.get('PROXY_HEDGE_WORKERS', 256))
+RETRY_BUDGET_RATIO = float(os.environ.get('PROXY_RETRY_BUDGET_RATIO', 0.1))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.environ.get('PROXY_RETRY_BUDGET_MIN_PER_SECOND', 1))
+RETRY_BUDGET_MAX_TOKENS = float(os.environ.get('PROXY_RETRY_BUDGET_MAX_TOKENS', 100))
+
+# Кэш постоянных редиректов (301/308): запрос сразу уходит на конечный адрес
+REDIRECT_CACHE_ENABLED = os.environ.get('PROXY_REDIRECT_CACHE', '1') == '1'
+REDIRECT_CACHE_SIZE = int(os.environ.get('PROXY_REDIRECT_CACHE_SIZE', 10000))
+REDIRECT_CACHE_TTL = int(os.environ.get('PROXY_REDIRECT_CACHE_TTL', 24 * 3600))
+REDIRECT_MAX_HOPS = 10
+
+# Кэш DNS для origin: TTL из записей (без dnspython - DNS_DEFAULT_TTL), отрицательный кэш NXDOMAIN,
+# фоновое обновление популярных записей за DNS_REFRESH_AHEAD доли TTL до истечения
+DNS_CACHE_ENABLED = os.environ.get('PROXY_DNS_CACHE', '1') == '1'
+DNS_DEFAULT_TTL = float(os.environ.get('PROXY_DNS_DEFAULT_TTL', 60))
+DNS_MIN_TTL = float(os.environ.get('PROXY_DNS_MIN_TTL', 5))
+DNS_MAX_TTL = float(os.environ.get('PROXY_DNS_MAX_TTL', 3600))
+DNS_NEGATIVE_TTL = float(os.environ.get('PROXY_DNS_NEGATIVE_TTL', 10))
+DNS_REFRESH_AHEAD = float(os.environ.get('PROXY_DNS_REFRESH_AHEAD', 0.2))
+DNS_REFRESH_MIN_HITS = int(os.environ.get('PROXY_DNS_REFRESH_MIN_HITS', 3))
+DNS_MAX_HOSTS = int(os.environ.get('PROXY_DNS_MAX_HOSTS', 10000))
+
+# Отрицательный кэш: недоступный хост (DNS, отказ в соединении, TLS) и 404/410 по url отвечают сразу
+NEGATIVE_CACHE_ENABLED = os.environ.get('PROXY_NEGATIVE_CACHE', '1') == '1'
+NEGATIVE_HOST_TTL = float(os.environ.get('PROXY_NEGATIVE_HOST_TTL', 5))
+NEGATIVE_URL_TTL = float(os.environ.get('PROXY_NEGATIVE_URL_TTL', 10))
+NEGATIVE_MAX_ENTRIES = int(os.environ.get('PROXY_NEGATIVE_MAX_ENTRIES', 10000))
+NEGATIVE_MAX_BODY = int(os.environ.get('PROXY_NEGATIVE_MAX_BODY', 64 * 1024))
+
+# Потоковая отдача тела ответа: клиент получает данные по мере их прихода от origin
+STREAM_RESPONSES = os.environ.get('PROXY_STREAM', '1') == '1'
+STREAM_CHUNK_SIZE = int(os.environ.get('PROXY_STREAM_CHUNK_SIZE', 64 * 1024))
+
+# Тело запроса клиента уходит к origin потоком; лимит размера в байтах, 0 - без лимита
+MAX_REQUEST_BODY = int(os.environ.get('PROXY_MAX_BODY_SIZE', 512 * 1024 * 1024))
+REQUEST_BODY_CHUNK_SIZE = int(os.environ.get('PROXY_REQUEST_CHUNK_SIZE', 64 * 1024))
+
+# Перекодировка текста в UTF-8 - только по явному включению и только для перечисленных типов,
+# по умолчанию тело ответа передается как непрозрачные байты
+CHARSET_REWRITE = os.environ.get('PROXY_CHARSET_REWRITE', '0') == '1'
+CHARSET_REWRITE_TYPES = tuple(
+    t.strip() for t in os.environ.get(
+        'PROXY_CHARSET_REWRITE_TYPES',
+        'text/html,text/plain,text/css,text/xml,application/json,application/javascript'
+    ).split(',') if t.strip()
+)
+
+# Переписывание ссылок в HTML и CSS на /url=, чтобы страница целиком работала через прокси
+LINK_REWRITE = os.environ.get('PROXY_LINK_REWRITE', '0') == '1'
+LINK_REWRITE_PREFIX = os.environ.get('PROXY_LINK_REWRITE_PREFIX', '/url=')
+# Хвост чанка без границы тега или правила CSS ждет следующего чанка, но не больше этого
+LINK_REWRITE_MAX_CARRY = int(os.environ.get('PROXY_LINK_REWRITE_MAX_CARRY', 64 * 1024))
+
+# Разделяемый HTTP-кэш для GET-запросов
+CACHE_ENABLED = os.environ.get('PROXY_CACHE', '1') == '1'
+CACHE_MEMORY_BYTES = int(os.environ.get('PROXY_CACHE_MEMORY_BYTES', 64 * 1024 * 1024))
+CACHE_DISK_BYTES = int(os.environ.get('PROXY_CACHE_DISK_BYTES', 1024 * 1024 * 1024))
+CACHE_DISK_DIR = os.environ.get('PROXY_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'dh-proxy-cache'))
+CACHE_MAX_ENTRY_BYTES = int(os.environ.get('PROXY_CACHE_MAX_ENTRY_BYTES', 16 * 1024 * 1024))
+CACHE_HEURISTIC_MAX_AGE = int(os.environ.get('PROXY_CACHE_HEURISTIC_MAX_AGE', 24 * 3600))
+# Окна отдачи устаревших ответов (RFC 5861) для ответов без своих stale-while-revalidate/stale-if-error.
+# По умолчанию 0: устаревшее отдается только с разрешения origin, ненулевое значение - осознанный opt-in
+CACHE_STALE_WHILE_REVALIDATE = int(os.environ.get('PROXY_CACHE_STALE_WHILE_REVALIDATE', 0))
+CACHE_STALE_IF_ERROR = int(os.environ.get('PROXY_CACHE_STALE_IF_ERROR', 0))
+CACHE_REVALIDATE_WORKERS = int(os.environ.get('PROXY_CACHE_REVALIDATE_WORKERS', 4))
+# Тела от этого размера отдаются с диска через mmap и не занимают память процесса
+CACHE_MMAP_MIN_BYTES = int(os.environ.get('PROXY_CACHE_MMAP_MIN_BYTES', 1024 * 1024))
+
+# Объединение одинаковых одновременных GET-запросов к origin
+COALESCE_ENABLED = os.environ.get('PROXY_COALESCE', '1') == '1'
+COALESCE_MAX_BUFFER = int(os.environ.get('PROXY_COALESCE_MAX_BUFFER', 8 * 1024 * 1024))
+# Сколько быстрый потребитель ждет отставшего, прежде чем отключить его от общего тела
+COALESCE_LAG_TIMEOUT = float(os.environ.get('PROXY_COALESCE_LAG_TIMEOUT', 30))
+# Заголовки клиента вне ключа объединения: учетных данных в них нет, а значения почти у всех разные.
+# Если ответ от них зависит (Vary), ведомый запрос все равно уйдет к origin сам
+COALESCE_IGNORED_HEADERS = ('user-agent', 'referer', 'x-forwarded-for', 'x-real-ip', 'forwarded', 'via')
+
+# Circuit breaker: origin с высокой долей ошибок временно отсекается без запросов к нему
+BREAKER_ENABLED = os.environ.get('PROXY_BREAKER', '1') == '1'
+BREAKER_WINDOW = float(os.environ.get('PROXY_BREAKER_WINDOW', 30))
+BREAKER_MIN_REQUESTS = int(os.environ.get('PROXY_BREAKER_MIN_REQUESTS', 10))
+BREAKER_FAILURE_RATE = float(os.environ.get('PROXY_BREAKER_FAILURE_RATE', 0.5))
+BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('PROXY_BREAKER_SLOW_CALL', 20))
+BREAKER_OPEN_SECONDS = float(os.environ.get('PROXY_BREAKER_OPEN_SECONDS', 15))
+BREAKER_HALF_OPEN_PROBES = int(os.environ.get('PROXY_BREAKER_HALF_OPEN_PROBES', 1))
+BREAKER_HALF_OPEN_SUCCESSES = int(os.environ.get('PROXY_BREAKER_HALF_OPEN_SUCCESSES', 2))
+BREAKER_MAX_HOSTS = int(os.environ.get('PROXY_BREAKER_MAX_HOSTS', 10000))
+
+# Пакетные запросы /batch: общий пул потоков, лимиты на пакет, таймаут элемента и общий дедлайн
+BATCH_WORKERS = int(os.environ.get('PROXY_BATCH_WORKERS', 32))
+BATCH_CONCURRENCY = int(os.environ.get('PROXY_BATCH_CONCURRENCY', 16))
+BATCH_MAX_ITEMS = int(os.environ.get('PROXY_BATCH_MAX_ITEMS', 100))
+BATCH_MAX_REQUEST_BYTES = int(os.environ.get('PROXY_BATCH_MAX_REQUEST_BYTES', 16 * 1024 * 1024))
+BATCH_MAX_ITEM_BYTES = int(os.environ.get('PROXY_BATCH_MAX_ITEM_BYTES', 10 * 1024 * 1024))
+BATCH_ITEM_TIMEOUT = float(os.environ.get('PROXY_BATCH_ITEM_TIMEOUT', 30))
+BATCH_DEADLINE = float(os.environ.get('PROXY_BATCH_DEADLINE', 60))
+
+# Сколько секунд браузер может кэшировать ответ на CORS preflight
+CORS_MAX_AGE = int(os.environ.get('PROXY_CORS_MAX_AGE', 86400))
+
+# Метрики: число шардов (потоки распределяются по ним по id) и максимум различных хостов в метках
+METRICS_SHARDS = int(os.environ.get('PROXY_METRICS_SHARDS', 64))
+METRICS_MAX_HOSTS = int(os.environ.get('PROXY_METRICS_MAX_HOSTS', 200))
+
+# Заголовок Server-Timing с фазами запроса к origin (гистограммы по фазам пишутся всегда)
+SERVER_TIMING = os.environ.get('PROXY_SERVER_TIMING', '0') == '1'
+
+# Контроль нагрузки: не больше ADMISSION_LIMIT одновременных запросов к прокси, до ADMISSION_QUEUE ждут
+# свободного места не дольше ADMISSION_QUEUE_TIMEOUT, остальные сразу получают 503.
+# ADMISSION_ADAPTIVE - лимит подстраивается под задержку (AIMD) в пределах MIN_LIMIT..MAX_LIMIT
+ADMISSION_ENABLED = os.environ.get('PROXY_ADMISSION', '1') == '1'
+ADMISSION_LIMIT = int(os.environ.get('PROXY_ADMISSION_LIMIT', 200))
+ADMISSION_QUEUE = int(os.environ.get('PROXY_ADMISSION_QUEUE', 100))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('PROXY_ADMISSION_QUEUE_TIMEOUT', 2))
+ADMISSION_RETRY_AFTER = int(os.environ.get('PROXY_ADMISSION_RETRY_AFTER', 1))
+ADMISSION_ADAPTIVE = os.environ.get('PROXY_ADMISSION_ADAPTIVE', '0') == '1'
+ADMISSION_MIN_LIMIT = int(os.environ.get('PROXY_ADMISSION_MIN_LIMIT', 10))
+ADMISSION_MAX_LIMIT = int(os.environ.get('PROXY_ADMISSION_MAX_LIMIT', 1000))
+ADMISSION_TARGET_LATENCY = float(os.environ.get('PROXY_ADMISSION_TARGET_LATENCY', 5))
+ADMISSION_BACKOFF = float(os.environ.get('PROXY_ADMISSION_BACKOFF', 0.9))
+
+# Bulkhead-пулы: запросы к хостам по шаблонам делят лимит и очередь своего пула, поэтому медленный
+# origin выбирает только свою долю. Формат: имя:лимит[:очередь[:таймаут очереди]]=шаблон,шаблон;...
+# например downloads:20:10=*.cdn.example.com,files.example.org;api:100=api.example.com
+# Хосты без совпадения ограничены только общим admission-лимитом
+BULKHEADS = os.environ.get('PROXY_BULKHEADS', '')
+BULKHEAD_QUEUE_TIMEOUT = float(os.environ.get('PROXY_BULKHEAD_QUEUE_TIMEOUT', 5))
+
+# Токен для admin-эндпоинтов и /metrics; без него они отвечают только клиентам с loopback
+ADMIN_TOKEN = os.environ.get('PROXY_ADMIN_TOKEN')
 
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
@@ -689,165 +871,3443 @@ echo $response;</div>
 </html>
 '''
 
-def decode_response_content(response):
-    """Правильно декодирует содержимое ответа с учетом кодировки и сжатия"""
-    content = response.content
+# ======================
+# Метрики
+# ======================
+
+class Metrics:
+    """
+    Счетчики и гистограммы в фиксированном наборе шардов. Поток пишет в шард по своему id
+    под замком этого шарда: регистрации потоков и общего замка нет, а с threaded=True
+    каждый запрос - новый поток. Шарды суммируются только при выдаче /metrics
+    """
+
+    def __init__(self, shards=METRICS_SHARDS):
+        # (замок, счетчики, гистограммы)
+        self._shards = [(threading.Lock(), {}, {}) for _ in range(max(1, shards))]
+        self._descriptions = {}
+        self._collectors = []
+
+    def describe(self, name, metric_type, help_text, buckets=None):
+        self._descriptions[name] = (metric_type, help_text, tuple(buckets or ()))
+
+    def register_collector(self, collector):
+        """collector() возвращает список (имя, метки, значение) для метрик-gauge"""
+        self._collectors.append(collector)
+
+    def _shard(self):
+        # native id - номер потока в ОС: соседние потоки попадают в разные шарды,
+        # а get_ident() - адрес, кратный размеру стека, и собрал бы их в одном
+        return self._shards[threading.get_native_id() % len(self._shards)]
+
+    @staticmethod
+    def _merge_histogram(target, key, values):
+        current = target.get(key)
+        if current is None:
+            target[key] = list(values)
+        else:
+            for index, value in enumerate(values):
+                current[index] += value
+
+    def inc(self, name, labels=(), value=1):
+        lock, counters, _ = self._shard()
+        key = (name, labels)
+        with lock:
+            counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        lock, _, histograms = self._shard()
+        key = (name, labels)
+        buckets = self._descriptions[name][2]
+        index = bisect.bisect_left(buckets, value)
+        with lock:
+            values = histograms.get(key)
+            if values is None:
+                # Счетчики по бакетам, последний бакет - +Inf, в конце - сумма значений
+                values = histograms[key] = [0] * (len(buckets) + 2)
+            values[index] += 1
+            values[-1] += value
+
+    def snapshot(self):
+        """Суммирует все шарды: возвращает (счетчики, гистограммы)"""
+        counters = {}
+        histograms = {}
+        for lock, shard_counters, shard_histograms in self._shards:
+            with lock:
+                shard_counters = list(shard_counters.items())
+                shard_histograms = [(key, list(values)) for key, values in shard_histograms.items()]
+            for key, value in shard_counters:
+                counters[key] = counters.get(key, 0) + value
+            for key, values in shard_histograms:
+                self._merge_histogram(histograms, key, values)
+        return counters, histograms
+
+    def counter_values(self, name):
+        """Значения счетчика name по наборам меток"""
+        counters, _ = self.snapshot()
+        return {labels: value for (metric, labels), value in counters.items() if metric == name}
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        parts = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+            parts.append(f'{key}="{value}"')
+        return '{' + ','.join(parts) + '}'
 
-    # Проверяем кодировку и распаковываем если нужно
-    if response.headers.get('Content-Encoding') == 'gzip':
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        counters, histograms = self.snapshot()
+        samples = {}
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append((labels, value))
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(set(samples) | {name for name, _ in histograms}):
+            metric_type, help_text, buckets = self._descriptions.get(name, ('untyped', '', ()))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            if metric_type == 'histogram':
+                for (metric, labels), values in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets + (float('inf'),), values[:-1]):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{name}_bucket{self._format_labels(labels + (("le", le),))} {cumulative}')
+                    lines.append(f'{name}_sum{self._format_labels(labels)} {values[-1]}')
+                    lines.append(f'{name}_count{self._format_labels(labels)} {cumulative}')
+                continue
+            for labels, value in sorted(samples[name]):
+                lines.append(f'{name}{self._format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+metrics.describe('dh_proxy_requests_total', 'counter', 'Proxied requests by route, method, upstream host and status')
+metrics.describe('dh_proxy_request_duration_seconds', 'histogram',
+                 'Time from request start to the last byte sent to the client', LATENCY_BUCKETS)
+metrics.describe('dh_proxy_response_bytes_total', 'counter', 'Response body bytes sent to clients')
+metrics.describe('dh_proxy_request_bytes_total', 'counter', 'Request body bytes received from clients')
+metrics.describe('dh_proxy_upstream_pool_events_total', 'counter',
+                 'Upstream connection pool events: hits, misses, new connections, idle evictions')
+metrics.describe('dh_proxy_coalesce_events_total', 'counter',
+                 'Single-flight events: requests, upstream flights, coalesced followers, followers that refetched a private response, laggards detached')
+
+known_metric_hosts = set()
+
+def metric_host(url):
+    """Хост origin для меток; редкие хосты сверх лимита попадают в other"""
+    host = urlsplit(url).netloc.lower() or 'unknown'
+    if host in known_metric_hosts:
+        return host
+    if len(known_metric_hosts) >= METRICS_MAX_HOSTS:
+        return 'other'
+    known_metric_hosts.add(host)
+    return host
+
+class MeteredBody:
+    """Обертка тела ответа: считает отданные байты и пишет метрики при закрытии"""
+
+    def __init__(self, body, on_close):
+        self._body = body
+        self._on_close = on_close
+        self._closed = False
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self._body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
         try:
-            content = gzip.decompress(content)
-        except:
-            pass
-    elif response.headers.get('Content-Encoding') == 'br':
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._on_close(self)
+
+TIMING_PHASES = ('dns', 'connect', 'tls', 'ttfb', 'transfer', 'decode')
+
+metrics.describe('dh_proxy_upstream_phase_seconds', 'histogram', 'Time spent in each phase of proxied requests by upstream host', LATENCY_BUCKETS)
+
+class RequestTiming:
+    """Время по фазам одного проксируемого запроса, в секундах"""
+
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def timed(self, chunks, phase, nested=None):
+        """Итератор: время ожидания очередного чанка идет в phase, за вычетом вложенной фазы nested"""
+        iterator = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            nested_before = self.phases.get(nested, 0.0)
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add(phase, time.perf_counter() - start - (self.phases.get(nested, 0.0) - nested_before))
+            yield chunk
+
+    def header_value(self):
+        return ', '.join(
+            f'{phase};dur={self.phases[phase] * 1000:.1f}'
+            for phase in TIMING_PHASES if phase in self.phases
+        )
+
+    def record(self, host):
+        for phase, seconds in self.phases.items():
+            metrics.observe('dh_proxy_upstream_phase_seconds', seconds, (('host', host), ('phase', phase)))
+
+# Фазы текущего запроса: соединения к origin и чтение тела пишут сюда из потока этого запроса
+timing_local = threading.local()
+
+def current_timing():
+    return getattr(timing_local, 'timing', None)
+
+def add_timing(phase, seconds):
+    timing = current_timing()
+    if timing is not None:
+        timing.add(phase, seconds)
+
+def instrumented(route):
+    """Декоратор маршрута прокси: длительность, статус, объем данных и фазы запроса в метрики"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            timing = timing_local.timing = RequestTiming()
+            try:
+                response = view(*args, **kwargs)
+            except Exception:
+                timing_local.timing = None
+                raise
+            host = metric_host(normalize_target_url(kwargs.get('target_url', '')))
+            method = request.method
+            status = str(response.status_code)
+            request_bytes = request.content_length or 0
+
+            def record(body):
+                labels = (('route', route), ('method', method), ('host', host), ('status', status))
+                metrics.inc('dh_proxy_requests_total', labels)
+                metrics.observe('dh_proxy_request_duration_seconds', time.perf_counter() - start,
+                                (('route', route), ('host', host), ('status', status)))
+                metrics.inc('dh_proxy_response_bytes_total', (('route', route), ('host', host)), body.sent)
+                if request_bytes:
+                    metrics.inc('dh_proxy_request_bytes_total', (('route', route), ('host', host)), request_bytes)
+                timing.record(host)
+                timing_local.timing = None
+
+            # Тело еще не прочитано: в заголовок попадают фазы до ответа origin,
+            # transfer и decode - только при буферизованной отдаче
+            if SERVER_TIMING and timing.phases:
+                response.headers['Server-Timing'] = timing.header_value()
+            response.response = MeteredBody(response.response, record)
+            return response
+        return wrapper
+    return decorator
+
+# ======================
+# Контроль нагрузки
+# ======================
+
+metrics.describe('dh_proxy_admission_shed_total', 'counter', 'Requests rejected by a concurrency limiter: queue full or queue timeout')
+metrics.describe('dh_proxy_admission_queue_wait_seconds', 'histogram', 'Time requests waited in a limiter queue', LATENCY_BUCKETS)
+metrics.describe('dh_proxy_admission_in_flight', 'gauge', 'Requests currently admitted by a limiter')
+metrics.describe('dh_proxy_admission_queue_depth', 'gauge', 'Requests currently waiting in a limiter queue')
+metrics.describe('dh_proxy_admission_limit', 'gauge', 'Current concurrency limit of a limiter')
+
+class ConcurrencyLimiter:
+    """
+    Не больше limit одновременных запросов; до max_queue запросов ждут своей очереди
+    не дольше queue_timeout, остальным сразу отказ. При adaptive лимит меняется по AIMD:
+    +1 при успешной работе под нагрузкой, * backoff при задержке выше target_latency или ошибке.
+    """
+
+    def __init__(self, name, limit, max_queue, queue_timeout, adaptive=False,
+                 min_limit=1, max_limit=None, target_latency=None, backoff=0.9):
+        self.name = name
+        self.limit = float(limit)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.adaptive = adaptive
+        self.min_limit = min_limit
+        self.max_limit = max_limit or limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.queued = 0
+        self.labels = (('limiter', name),)
+
+    def acquire(self):
+        """True - запрос допущен (вызвать release), False - отказ"""
+        with self.condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            if self.queued >= self.max_queue:
+                metrics.inc('dh_proxy_admission_shed_total', self.labels + (('reason', 'queue_full'),))
+                return False
+
+            self.queued += 1
+            start = time.monotonic()
+            deadline = start + self.queue_timeout
+            try:
+                while self.in_flight >= int(self.limit):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        metrics.inc('dh_proxy_admission_shed_total', self.labels + (('reason', 'queue_timeout'),))
+                        return False
+                    self.condition.wait(remaining)
+                self.in_flight += 1
+            finally:
+                self.queued -= 1
+        metrics.observe('dh_proxy_admission_queue_wait_seconds', time.monotonic() - start, self.labels)
+        return True
+
+    def release(self, latency=None, ok=True):
+        with self.condition:
+            self.in_flight -= 1
+            if self.adaptive and latency is not None:
+                if not ok or latency > self.target_latency:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                elif self.in_flight * 2 >= self.limit:
+                    # Лимит растет, только пока он реально используется
+                    self.limit = min(self.max_limit, self.limit + 1)
+            self.condition.notify()
+
+    def snapshot(self):
+        with self.condition:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'queued': self.queued,
+                'max_queue': self.max_queue,
+                'adaptive': self.adaptive,
+            }
+
+admission_limiter = ConcurrencyLimiter(
+    'global', ADMISSION_LIMIT, ADMISSION_QUEUE, ADMISSION_QUEUE_TIMEOUT,
+    adaptive=ADMISSION_ADAPTIVE, min_limit=ADMISSION_MIN_LIMIT, max_limit=ADMISSION_MAX_LIMIT,
+    target_latency=ADMISSION_TARGET_LATENCY, backoff=ADMISSION_BACKOFF
+)
+
+limiters = [admission_limiter]
+
+def collect_limiter_metrics():
+    samples = []
+    for limiter in limiters:
+        state = limiter.snapshot()
+        samples.append(('dh_proxy_admission_in_flight', limiter.labels, state['in_flight']))
+        samples.append(('dh_proxy_admission_queue_depth', limiter.labels, state['queued']))
+        samples.append(('dh_proxy_admission_limit', limiter.labels, state['limit']))
+    return samples
+
+metrics.register_collector(collect_limiter_metrics)
+
+def overloaded_response():
+    return Response('Proxy Error: Overloaded, retry later', 503, headers={'Retry-After': str(ADMISSION_RETRY_AFTER)})
+
+def admitted(view):
+    """Декоратор маршрута прокси: запрос занимает место в admission_limiter до закрытия тела ответа"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMISSION_ENABLED:
+            return view(*args, **kwargs)
+        if not admission_limiter.acquire():
+            return overloaded_response()
+
+        start = time.monotonic()
         try:
-            content = brotli.decompress(content)
-        except:
-            pass
+            response = view(*args, **kwargs)
+        except Exception:
+            admission_limiter.release()
+            raise
+        # Для AIMD важна задержка до ответа origin, а не скорость чтения клиентом
+        latency = time.monotonic() - start
+        # 502 от недоступного origin не говорит о перегрузке прокси, таймаут - говорит
+        ok = response.status_code != 504
+        response.response = MeteredBody(response.response, lambda body: admission_limiter.release(latency, ok))
+        return response
+    return wrapper
+
+def parse_bulkheads(spec):
+    """Список (limiter, шаблоны хостов) из PROXY_BULKHEADS в порядке объявления"""
+    bulkheads = []
+    for part in spec.split(';'):
+        if not part.strip():
+            continue
+        settings, _, patterns = part.partition('=')
+        name, *numbers = [value.strip() for value in settings.split(':')]
+        limit = int(numbers[0])
+        max_queue = int(numbers[1]) if len(numbers) > 1 else limit
+        queue_timeout = float(numbers[2]) if len(numbers) > 2 else BULKHEAD_QUEUE_TIMEOUT
+        hosts = tuple(pattern.strip().lower() for pattern in patterns.split(',') if pattern.strip())
+        bulkheads.append((ConcurrencyLimiter(name, limit, max_queue, queue_timeout), hosts))
+    return bulkheads
+
+bulkheads = parse_bulkheads(BULKHEADS)
+limiters.extend(limiter for limiter, _ in bulkheads)
+
+class BulkheadFull(Exception):
+    def __init__(self, name):
+        super().__init__(f'upstream pool {name} is busy')
+        self.name = name
+
+@functools.lru_cache(maxsize=4096)
+def find_bulkhead(host):
+    """Пул хоста origin: первый, чей шаблон совпал, или None"""
+    for limiter, patterns in bulkheads:
+        if any(fnmatch.fnmatchcase(host, pattern) for pattern in patterns):
+            return limiter
+    return None
+
+def bulkhead_for(url):
+    if not bulkheads:
+        return None
+    return find_bulkhead(urlsplit(url).hostname or '')
+
+def bulkheaded(view):
+    """Декоратор маршрута прокси: запрос занимает место в пуле своего origin до закрытия тела ответа"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        limiter = bulkhead_for(normalize_target_url(kwargs['target_url']))
+        if limiter is None:
+            return view(*args, **kwargs)
+        if not limiter.acquire():
+            return Response(
+                f'Proxy Error: Upstream pool {limiter.name} is busy, retry later', 503,
+                headers={'Retry-After': str(ADMISSION_RETRY_AFTER)}
+            )
 
-    # Пытаемся определить кодировку текста
-    if response.encoding:
         try:
-            return content.decode(response.encoding)
-        except:
-            pass
+            response = view(*args, **kwargs)
+        except Exception:
+            limiter.release()
+            raise
+        response.response = MeteredBody(response.response, lambda body: limiter.release())
+        return response
+    return wrapper
+
+# ======================
+# Кэш DNS
+# ======================
+
+DNS_EVENTS = ('hits', 'misses', 'negative_hits', 'refreshes', 'errors')
+
+metrics.describe('dh_proxy_dns_events_total', 'counter', 'DNS cache events: hits, misses, negative hits, background refreshes, errors')
+
+# Коды getaddrinfo, означающие, что имени нет (NXDOMAIN), а не временный сбой резолвера
+NXDOMAIN_ERRORS = {socket.EAI_NONAME, getattr(socket, 'EAI_NODATA', socket.EAI_NONAME)}
+
+def count_dns_event(name):
+    metrics.inc('dh_proxy_dns_events_total', (('event', name),))
 
-    # Пробуем распространенные кодировки
-    encodings = ['utf-8', 'latin-1', 'cp1251', 'iso-8859-1']
-    for encoding in encodings:
+def is_ip_address(host):
+    try:
+        ipaddress.ip_address(host.strip('[]'))
+    except ValueError:
+        return False
+    return True
+
+def query_dns(host):
+    """Адреса хоста и TTL. Без dnspython TTL неизвестен - берется DNS_DEFAULT_TTL"""
+    if dns is None:
+        try:
+            infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except UnicodeError as e:
+            # Имя не кодируется в IDNA (пустая или длиннее 63 символов метка) - такого хоста нет
+            raise socket.gaierror(socket.EAI_NONAME, f'{host}: {e}')
+        addresses = []
+        for family, _, _, _, sockaddr in infos:
+            if (family, sockaddr[0]) not in addresses:
+                addresses.append((family, sockaddr[0]))
+        return addresses, DNS_DEFAULT_TTL
+
+    addresses = []
+    ttl = None
+    for record_type, family in (('A', socket.AF_INET), ('AAAA', socket.AF_INET6)):
         try:
-            return content.decode(encoding)
-        except:
+            answer = dns.resolver.resolve(host, record_type, search=True)
+        except dns.resolver.NXDOMAIN:
+            raise socket.gaierror(socket.EAI_NONAME, f'{host}: NXDOMAIN')
+        except (dns.resolver.NoAnswer, dns.resolver.NoNameservers):
             continue
+        except dns.exception.Timeout:
+            raise socket.gaierror(socket.EAI_AGAIN, f'{host}: DNS timeout')
+        except (dns.exception.SyntaxError, dns.name.NameTooLong, dns.name.IDNAException, UnicodeError) as e:
+            raise socket.gaierror(socket.EAI_NONAME, f'{host}: {e}')
+        addresses.extend((family, record.to_text()) for record in answer)
+        ttl = answer.rrset.ttl if ttl is None else min(ttl, answer.rrset.ttl)
+    if not addresses:
+        raise socket.gaierror(socket.EAI_NONAME, f'{host}: no A/AAAA records')
+    return addresses, ttl
 
-    # Если ничего не помогло, возвращаем как есть
-    return content
+class DnsEntry:
+    """Результат резолва одного хоста: адреса или ошибка (отрицательная запись)"""
 
-@app.route('/')
-def index():
-    return render_template_string(HTML_TEMPLATE)
+    def __init__(self, addresses, ttl, error=None):
+        self.addresses = addresses
+        self.error = error
+        self.ttl = min(max(ttl, DNS_MIN_TTL), DNS_MAX_TTL) if error is None else ttl
+        self.expires = time.monotonic() + self.ttl
+        self.next_index = 0
+        self.hits = 0
+        self.refreshing = False
 
-@app.route('/url=<path:target_url>')
-def proxy_get(target_url):
-    global request_count
-    with count_lock:
-        request_count += 1
+class DnsCache:
+    """
+    Кэш резолва origin-хостов с учетом TTL. Адреса отдаются по кругу, чтобы
+    новые соединения распределялись по всем A/AAAA записям.
+    """
 
-    try:
-        if not target_url.startswith(('http://', 'https://')):
-            url = 'https://' + target_url
+    def __init__(self, max_hosts):
+        self.max_hosts = max_hosts
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def resolve(self, host):
+        """Список (family, адрес), начиная со следующего по кругу адреса"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(host)
+            fresh = entry is not None and now < entry.expires
+            if fresh:
+                self.entries.move_to_end(host)
+                entry.hits += 1
+                refresh = (
+                    entry.error is None
+                    and not entry.refreshing
+                    and entry.hits >= DNS_REFRESH_MIN_HITS
+                    and entry.expires - now < entry.ttl * DNS_REFRESH_AHEAD
+                )
+                if refresh:
+                    entry.refreshing = True
+
+        if not fresh:
+            count_dns_event('misses')
+            entry = self._lookup(host)
+        elif entry.error is not None:
+            count_dns_event('negative_hits')
+        else:
+            count_dns_event('hits')
+            if refresh:
+                threading.Thread(target=self._refresh, args=(host,), daemon=True).start()
+
+        if entry.error is not None:
+            raise entry.error
+        with self.lock:
+            start = entry.next_index % len(entry.addresses)
+            entry.next_index += 1
+        return entry.addresses[start:] + entry.addresses[:start]
+
+    def _lookup(self, host):
+        try:
+            addresses, ttl = query_dns(host)
+        except socket.gaierror as e:
+            count_dns_event('errors')
+            if e.errno not in NXDOMAIN_ERRORS:
+                raise
+            entry = DnsEntry([], DNS_NEGATIVE_TTL, error=e)
         else:
-            url = target_url
+            entry = DnsEntry(addresses, ttl)
+        self._put(host, entry)
+        return entry
+
+    def _refresh(self, host):
+        """Фоновое обновление: при сбое старая запись живет до своего истечения"""
+        try:
+            addresses, ttl = query_dns(host)
+        except Exception:
+            count_dns_event('errors')
+            with self.lock:
+                entry = self.entries.get(host)
+                if entry is not None:
+                    entry.refreshing = False
+            return
+        count_dns_event('refreshes')
+        self._put(host, DnsEntry(addresses, ttl))
+
+    def _put(self, host, entry):
+        with self.lock:
+            self.entries[host] = entry
+            self.entries.move_to_end(host)
+            while len(self.entries) > self.max_hosts:
+                self.entries.popitem(last=False)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                host: {
+                    'addresses': [address for _, address in entry.addresses],
+                    'error': str(entry.error) if entry.error is not None else None,
+                    'ttl': entry.ttl,
+                    'expires_in': round(entry.expires - now, 2),
+                    'hits': entry.hits,
+                }
+                for host, entry in self.entries.items()
+            }
+
+dns_cache = DnsCache(DNS_MAX_HOSTS)
+
+def get_dns_stats():
+    values = metrics.counter_values('dh_proxy_dns_events_total')
+    stats = {name: values.get((('event', name),), 0) for name in DNS_EVENTS}
+    stats['resolver'] = 'dnspython' if dns is not None else 'getaddrinfo'
+    stats['hosts'] = dns_cache.snapshot()
+    return stats
+
+# ======================
+# Пул соединений к origin-серверам
+# ======================
+
+POOL_EVENTS = ('hits', 'misses', 'new_connections', 'idle_evictions')
+
+def count_pool_event(name):
+    metrics.inc('dh_proxy_upstream_pool_events_total', (('event', name),))
+
+# Общий TLS-контекст: сертификаты грузятся один раз, а не на каждое соединение
+UPSTREAM_SSL_CONTEXT = create_urllib3_context()
+UPSTREAM_SSL_CONTEXT.load_verify_locations(certifi.where())
+
+class UpstreamConnectionMixin:
+    """Считает реально открытые TCP-соединения к origin, замеряет их время и берет адрес из кэша DNS"""
+
+    def connect(self):
+        self.dh_socket_seconds = 0.0
+        start = time.perf_counter()
+        super().connect()
+        # У HTTPS после TCP-соединения идет TLS-рукопожатие
+        if isinstance(self, HTTPSConnection):
+            add_timing('tls', time.perf_counter() - start - self.dh_socket_seconds)
+
+    def _new_conn(self):
+        count_pool_event('new_connections')
+        self.dh_dns_seconds = 0.0
+        start = time.perf_counter()
+        sock = self._connect_socket()
+        self.dh_socket_seconds = time.perf_counter() - start
+        connect_seconds = self.dh_socket_seconds - self.dh_dns_seconds
+        get_host_latency(self.host).connect.append(connect_seconds)
+        add_timing('connect', connect_seconds)
+        return sock
+
+    def _connect_socket(self):
+        host = self._dns_host
+        if not DNS_CACHE_ENABLED or is_ip_address(host):
+            return super()._new_conn()
+
+        start = time.perf_counter()
+        try:
+            addresses = dns_cache.resolve(host)
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        finally:
+            self.dh_dns_seconds = time.perf_counter() - start
+            add_timing('dns', self.dh_dns_seconds)
+
+        # Адреса пробуем по очереди, как это делает create_connection для имени хоста
+        error = None
+        try:
+            for _, address in addresses:
+                self._dns_host = address
+                try:
+                    return super()._new_conn()
+                except ConnectTimeoutError as e:
+                    # NewConnectionError - подкласс ConnectTimeoutError
+                    error = e
+            raise error
+        finally:
+            self._dns_host = host
+
+class UpstreamHTTPConnection(UpstreamConnectionMixin, HTTPConnection):
+    pass
+
+class UpstreamHTTPSConnection(UpstreamConnectionMixin, HTTPSConnection):
+    pass
+
+class UpstreamPoolMixin:
+    """Пул одного origin: учет попаданий и вытеснение простаивающих keep-alive соединений"""
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        last_used = getattr(conn, 'dh_last_used', None)
+        if conn.sock is not None and last_used is not None:
+            if time.monotonic() - last_used > UPSTREAM_IDLE_TIMEOUT:
+                conn.close()
+                count_pool_event('idle_evictions')
+        count_pool_event('hits' if conn.sock is not None else 'misses')
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.dh_last_used = time.monotonic()
+        super()._put_conn(conn)
+
+class UpstreamHTTPPool(UpstreamPoolMixin, HTTPConnectionPool):
+    ConnectionCls = UpstreamHTTPConnection
 
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': '*/*',
-            'Accept-Encoding': 'gzip, deflate, br'
+class UpstreamHTTPSPool(UpstreamPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = UpstreamHTTPSConnection
+
+class UpstreamAdapter(HTTPAdapter):
+    """Адаптер requests с пулами на каждый origin и общим TLS-контекстом"""
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault('ssl_context', UPSTREAM_SSL_CONTEXT)
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': UpstreamHTTPPool,
+            'https': UpstreamHTTPSPool,
         }
 
-        # Копируем заголовки от клиента, кроме проблемных
-        for key, value in request.headers:
-            if key.lower() not in ['host', 'connection', 'content-length']:
-                headers[key] = value
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        # CA уже загружены в общий контекст, не перечитываем bundle на каждое соединение
+        if verify is True:
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
 
-        response = requests.get(
-            url=url,
-            headers=headers,
-            timeout=30,
-            allow_redirects=True,
-            stream=True
-        )
+def create_upstream_session():
+    """Создает сессию requests, общую для всех потоков Flask"""
+    session = requests.Session()
+    adapter = UpstreamAdapter(
+        pool_connections=UPSTREAM_POOL_ORIGINS,
+        pool_maxsize=UPSTREAM_POOL_SIZE
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # Сессия общая для всех клиентов - cookies origin-серверов не должны в ней оседать
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
 
-        # Декодируем контент
-        content = decode_response_content(response)
+upstream_session = create_upstream_session()
 
-        # Создаем правильные заголовки для ответа
-        excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
-        response_headers = []
+def get_pool_stats():
+    values = metrics.counter_values('dh_proxy_upstream_pool_events_total')
+    stats = {name: values.get((('event', name),), 0) for name in POOL_EVENTS}
+    total = stats['hits'] + stats['misses']
+    stats['reuse_rate'] = round(stats['hits'] / total, 4) if total else 0.0
+    return stats
 
-        for key, value in response.headers.items():
-            if key.lower() not in excluded_headers:
-                response_headers.append((key, value))
-
-        # Добавляем CORS заголовки
-        response_headers.append(('Access-Control-Allow-Origin', '*'))
-        response_headers.append(('Access-Control-Allow-Methods', '*'))
-        response_headers.append(('Access-Control-Allow-Headers', '*'))
-        response_headers.append(('X-Proxy-Server', 'DH-PROXY/2.0'))
-
-        return Response(
-            content,
-            status=response.status_code,
-            headers=response_headers
-        )
+# ======================
+# Общие функции проксирования
+# ======================
 
-    except requests.exceptions.Timeout:
-        return Response('Proxy Error: Request timeout', 504)
-    except requests.exceptions.ConnectionError:
-        return Response('Proxy Error: Connection failed', 502)
-    except Exception as e:
-        return Response(f'Proxy Error: {str(e)}', 500)
+class RequestBodyTooLarge(Exception):
+    pass
 
-@app.route('/url=<path:target_url>', methods=['POST', 'PUT', 'DELETE', 'PATCH'])
-def proxy_with_body(target_url):
-    global request_count
-    with count_lock:
-        request_count += 1
+class RequestBodyStream:
+    """
+    Тело запроса клиента для requests: читается из входного потока WSGI кусками
+    по мере отправки к origin, лимит размера проверяется на лету
+    """
 
-    try:
-        if not target_url.startswith(('http://', 'https://')):
-            url = 'https://' + target_url
-        else:
-            url = target_url
+    def __init__(self, stream, content_length, limit):
+        self._stream = stream
+        self._limit = limit
+        self._read = 0
+        if content_length is not None:
+            # requests берет длину из атрибута len и отправляет Content-Length,
+            # без него тело уходит с Transfer-Encoding: chunked
+            self.len = content_length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > REQUEST_BODY_CHUNK_SIZE:
+            size = REQUEST_BODY_CHUNK_SIZE
+        data = self._stream.read(size)
+        self._read += len(data)
+        if self._limit and self._read > self._limit:
+            raise RequestBodyTooLarge()
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(REQUEST_BODY_CHUNK_SIZE)
+            if not data:
+                return
+            yield data
+
+def open_request_body():
+    """Тело текущего запроса как поток или None, если тела нет"""
+    content_length = request.content_length
+    if MAX_REQUEST_BODY and content_length and content_length > MAX_REQUEST_BODY:
+        raise RequestBodyTooLarge()
+
+    chunked = 'chunked' in request.headers.get('Transfer-Encoding', '').lower()
+    if not content_length and not chunked:
+        return None
+    return RequestBodyStream(request.stream, content_length if not chunked else None, MAX_REQUEST_BODY)
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+def follow_redirect_after_body(response, method, headers):
+    """
+    Потоковое тело нельзя отправить второй раз, поэтому редиректы после запроса с телом
+    обрабатываем сами, как requests: 303 и 301/302 на POST повторяем методом GET без тела,
+    остальные отдаем клиенту с Location в форме /url=
+    """
+    location = response.headers.get('Location')
+    if response.status_code not in REDIRECT_STATUSES or not location:
+        return response
 
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': '*/*',
-            'Accept-Encoding': 'gzip, deflate, br'
+    location = urljoin(response.url, location)
+    if response.status_code == 303 or (response.status_code in (301, 302) and method == 'POST'):
+        response.close()
+        get_headers = {
+            k: v for k, v in headers.items()
+            if k.lower() not in ('content-type', 'content-length', 'transfer-encoding')
         }
+        # Учетные данные не уходят на другой хост и с https на http - как при редиректе в requests
+        get_headers = redirected_headers(get_headers, upstream_session.should_strip_auth(response.url, location))
+        return fetch_upstream('GET', location, get_headers)
 
-        for key, value in request.headers:
-            if key.lower() not in ['host', 'connection', 'content-length']:
-                headers[key] = value
+    response.headers['Location'] = proxied_location(response.url, location)
+    return response
 
-        response = requests.request(
-            method=request.method,
-            url=url,
-            headers=headers,
-            data=request.get_data(),
-            timeout=30,
-            allow_redirects=True,
-            stream=True
+def normalize_target_url(target_url):
+    if not target_url.startswith(('http://', 'https://')):
+        return 'https://' + target_url
+    return target_url
+
+def build_upstream_headers(client_headers=None):
+    """Заголовки для запроса к origin на основе заголовков клиента"""
+    if client_headers is None:
+        client_headers = request.headers
+
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+        'Accept': '*/*',
+        'Accept-Encoding': 'gzip, deflate, br'
+    }
+
+    # Копируем заголовки от клиента, кроме проблемных
+    client_keys = set()
+    for key, value in client_headers.items():
+        client_keys.add(key.lower())
+        if key.lower() not in ['host', 'connection', 'content-length', 'transfer-encoding']:
+            headers[key] = value
+
+    # Кусок сжатого тела не распаковать: диапазон без Accept-Encoding клиента просим несжатым
+    if 'range' in client_keys and 'accept-encoding' not in client_keys:
+        headers['Accept-Encoding'] = 'identity'
+
+    return headers
+
+CORS_HEADERS = (
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Allow-Methods', '*'),
+    ('Access-Control-Allow-Headers', '*'),
+)
+
+# Ответ на preflight не зависит от origin - заголовки собираются один раз
+PREFLIGHT_HEADERS = CORS_HEADERS + (
+    ('Access-Control-Max-Age', str(CORS_MAX_AGE)),
+    ('X-Proxy-Server', 'DH-PROXY/2.0'),
+)
+
+def build_response_headers(response):
+    """Заголовки ответа клиенту: заголовки origin + CORS"""
+    excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
+    response_headers = []
+
+    for key, value in response.headers.items():
+        if key.lower() not in excluded_headers:
+            response_headers.append((key, value))
+
+    # Добавляем CORS заголовки
+    response_headers.extend(CORS_HEADERS)
+    response_headers.append(('X-Proxy-Server', 'DH-PROXY/2.0'))
+
+    return response_headers
+
+# ======================
+# Сжатие: прозрачная передача и потоковое перекодирование
+# ======================
+
+# Кодировки, которые прокси умеет распаковывать на лету
+DECODABLE_ENCODINGS = ('gzip', 'deflate', 'br')
+
+def get_content_encoding(headers):
+    return headers.get('Content-Encoding', '').strip().lower()
+
+def parse_accept_encoding(value):
+    """Разбирает Accept-Encoding в словарь {кодировка: q}"""
+    accepted = {}
+    for part in (value or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        coding, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        coding = coding.strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        accepted[coding] = q
+    return accepted
+
+def accepts_encoding(accepted, encoding):
+    """Проверяет, примет ли клиент тело в указанной кодировке"""
+    if encoding in accepted:
+        return accepted[encoding] > 0
+    if '*' in accepted:
+        return accepted['*'] > 0
+    # identity подходит всегда, если клиент явно не запретил ее
+    return encoding == 'identity'
+
+def choose_response_encoding(upstream_encoding, accept_encoding, must_decode=False):
+    """
+    Решает, что делать со сжатым телом от origin.
+    None - передать байты как есть, иначе - кодировка, в которую перекодировать.
+    must_decode - тело нужно распаковать для дополнительных стадий обработки.
+    """
+    compressed = upstream_encoding not in ('', 'identity')
+    accepted = parse_accept_encoding(accept_encoding)
+    if must_decode and (not compressed or upstream_encoding in DECODABLE_ENCODINGS):
+        if compressed and accepts_encoding(accepted, 'gzip'):
+            return 'gzip'
+        return 'identity'
+    if not compressed:
+        return None
+    if accepts_encoding(accepted, upstream_encoding):
+        return None
+    if upstream_encoding not in DECODABLE_ENCODINGS:
+        # Распаковать не сможем - отдаем как есть
+        return None
+    if accepts_encoding(accepted, 'gzip'):
+        return 'gzip'
+    return 'identity'
+
+class StreamDecompressor:
+    """Инкрементальная распаковка gzip/deflate/br без буферизации всего тела"""
+
+    def __init__(self, encoding, max_output=None):
+        self.encoding = encoding
+        self.max_output = max_output or STREAM_CHUNK_SIZE
+        self._decoder = None
+        if encoding in ('', 'identity'):
+            pass
+        elif encoding == 'br':
+            self._decoder = brotli.Decompressor()
+        elif encoding == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decoder = zlib.decompressobj()
+        self._first_chunk = True
+        self._members = 0
+        self._trailing_garbage = False
+
+    def decompress(self, data):
+        """Распаковывает чанк, выдавая куски не больше max_output"""
+        if self._decoder is None:
+            yield data
+            return
+
+        if self.encoding == 'br':
+            # Выход ограничен и для brotli: маленькая бомба не распаковывается в память целиком
+            output = self._decoder.process(data, output_buffer_limit=self.max_output)
+            if output:
+                yield output
+            while not self._decoder.is_finished():
+                output = self._decoder.process(b'', output_buffer_limit=self.max_output)
+                if not output:
+                    break
+                yield output
+            return
+
+        if self._first_chunk and self.encoding == 'deflate':
+            self._first_chunk = False
+            # Часть серверов отдает deflate без zlib-заголовка
+            try:
+                zlib.decompressobj().decompress(data[:64])
+            except zlib.error:
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        while data and not self._trailing_garbage:
+            if self._decoder.eof:
+                if self.encoding != 'gzip':
+                    return
+                # gzip из нескольких членов: следующий начинается сразу за концом предыдущего
+                self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                output = self._decoder.decompress(data, self.max_output)
+            except zlib.error:
+                if not self._members:
+                    raise
+                # Как urllib3: мусор после первого члена (например, нули) отбрасываем
+                self._trailing_garbage = True
+                return
+            if output:
+                yield output
+            data = self._decoder.unconsumed_tail
+            if self._decoder.eof:
+                self._members += 1
+                data = self._decoder.unused_data
+
+    def flush(self):
+        if self._decoder is None or self.encoding == 'br':
+            return b''
+        return self._decoder.flush()
+
+def iter_raw_body(response, chunk_size=None):
+    """Читает тело ответа origin без распаковки"""
+    for chunk in response.raw.stream(chunk_size or STREAM_CHUNK_SIZE, decode_content=False):
+        if chunk:
+            yield chunk
+
+class BodyTranscoder:
+    """
+    Потоковое перекодирование тела из source_encoding в target_encoding (gzip или identity).
+    Распакованные данные проходят через стадии обработки (объекты с методами feed/flush).
+    """
+
+    def __init__(self, source_encoding, target_encoding, stages=()):
+        self.decompressor = StreamDecompressor(source_encoding)
+        self.stages = list(stages)
+        self.compressor = None
+        if target_encoding == 'gzip':
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def _process(self, data):
+        for stage in self.stages:
+            data = stage.feed(data)
+        if self.compressor and data:
+            data = self.compressor.compress(data)
+        return data
+
+    def feed(self, chunk):
+        """Принимает чанк от origin, возвращает готовые для клиента куски"""
+        for data in self.decompressor.decompress(chunk):
+            data = self._process(data)
+            if data:
+                yield data
+
+    def finish(self):
+        """Дописывает хвосты распаковщика, стадий и компрессора"""
+        data = self.decompressor.flush()
+        for stage in self.stages:
+            data = stage.feed(data) + stage.flush()
+        if self.compressor:
+            data = self.compressor.compress(data) + self.compressor.flush()
+        if data:
+            yield data
+
+def transcode_chunks(chunks, source_encoding, target_encoding, stages=()):
+    """Перекодирует поток чанков через BodyTranscoder"""
+    transcoder = BodyTranscoder(source_encoding, target_encoding, stages)
+    for chunk in chunks:
+        yield from transcoder.feed(chunk)
+    yield from transcoder.finish()
+
+def iter_response_body(response, target_encoding=None, chunk_size=None, stages=()):
+    """Тело ответа origin: как есть или перекодированное под клиента"""
+    timing = current_timing()
+    chunks = iter_raw_body(response, chunk_size)
+    if timing is not None:
+        chunks = timing.timed(chunks, 'transfer')
+    if target_encoding is None:
+        return chunks
+    body = transcode_chunks(chunks, get_content_encoding(response.headers), target_encoding, stages)
+    if timing is not None:
+        body = timing.timed(body, 'decode', nested='transfer')
+    return body
+
+def decode_response_content(response, target_encoding=None, stages=()):
+    """Собирает тело ответа целиком (режим без стриминга). Тело остается байтами"""
+    return b''.join(iter_response_body(response, target_encoding, stages=stages))
+
+# ======================
+# Опциональные стадии обработки тела
+# ======================
+
+def parse_content_type(value):
+    """Возвращает (mimetype, charset) из заголовка Content-Type"""
+    mimetype, _, params = (value or '').partition(';')
+    charset = None
+    for param in params.split(';'):
+        key, _, val = param.strip().partition('=')
+        if key.lower() == 'charset':
+            charset = val.strip().strip('"\'') or None
+    return mimetype.strip().lower(), charset
+
+class CharsetStage:
+    """Стадия перекодировки текста из charset в UTF-8 без буферизации документа"""
+
+    def __init__(self, charset):
+        self.decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+
+    def feed(self, data):
+        return self.decoder.decode(data).encode('utf-8')
+
+    def flush(self):
+        return self.decoder.decode(b'', final=True).encode('utf-8')
+
+# Значение атрибута или url(): в кавычках или без - группы 2, 3, 4.
+# Без re.IGNORECASE: регистронезависимый поиск по байтам в 2-3 раза медленнее,
+# поэтому имена перечислены в нижнем и верхнем регистре
+LINK_ATTRIBUTES = ('href', 'src', 'action', 'formaction', 'poster', 'background')
+LINK_VALUE = rb'''(?:"([^"]*)"|'([^']*)'|([^\s"'<>`=]+))'''
+HTML_LINK_PATTERNS = (
+    re.compile(
+        rb'(\b(?:' + '|'.join(LINK_ATTRIBUTES + tuple(name.upper() for name in LINK_ATTRIBUTES)).encode()
+        + rb')\s*=\s*)' + LINK_VALUE
+    ),
+    re.compile(rb'''(\b(?:url|URL)\(\s*)(?:"([^"]*)"|'([^']*)'|([^\s"')]+))(?=\s*\))'''),
+)
+CSS_LINK_PATTERNS = (
+    HTML_LINK_PATTERNS[1],
+    re.compile(rb'''((?:@import|@IMPORT)\s+)(?:"([^"]*)"|'([^']*)')'''),
+)
+# Номер группы значения -> кавычка вокруг него
+LINK_QUOTES = {2: b'"', 3: b"'", 4: b''}
+# Тип документа -> (шаблоны ссылок, байты, после которых чанк можно резать)
+LINK_REWRITE_TYPES = {
+    'text/html': (HTML_LINK_PATTERNS, (b'>',)),
+    'application/xhtml+xml': (HTML_LINK_PATTERNS, (b'>',)),
+    'text/css': (CSS_LINK_PATTERNS, (b'}', b';', b'\n')),
+}
+
+@functools.lru_cache(maxsize=4096)
+def resolve_link(base_url, value):
+    """
+    Ссылка страницы в форме /url= или None, если ее оставить как есть.
+    Меню, иконки и стили повторяются по всей странице, поэтому результат кэшируется.
+    """
+    value = value.strip()
+    if not value or value.startswith((b'#', LINK_REWRITE_PREFIX.encode('latin-1'))):
+        return None
+    # latin-1 переносит любые байты в str и обратно без потерь
+    url = urljoin(base_url, value.decode('latin-1'))
+    if not url.startswith(('http://', 'https://')):
+        # data:, javascript:, mailto: и прочее остается как есть
+        return None
+    url, hash_mark, fragment = url.partition('#')
+    # Маршрут /url= видит только путь, поэтому query string уходит в него как %3F
+    return (LINK_REWRITE_PREFIX + url.replace('?', '%3F', 1) + hash_mark + fragment).encode('latin-1')
+
+def proxied_location(base_url, location):
+    """Location редиректа, который отдается клиенту, в форме /url= - следующий запрос тоже пойдет через прокси"""
+    rewritten = resolve_link(base_url, location.encode('latin-1'))
+    return rewritten.decode('latin-1') if rewritten is not None else location
+
+class LinkRewriteStage:
+    """
+    Стадия переписывания ссылок на /url=<абсолютный адрес> регулярными выражениями по байтам.
+    Чанк обрабатывается до последней границы тега или правила, остаток ждет следующего чанка,
+    поэтому ссылка на стыке чанков не теряется, а память не зависит от размера документа.
+    """
+
+    def __init__(self, base_url, patterns, boundaries):
+        self.base_url = base_url
+        self.patterns = patterns
+        self.boundaries = boundaries
+        self.tail = b''
+
+    def _replace(self, match):
+        # Значение - последняя совпавшая группа, после него в совпадении только кавычка
+        index = match.lastindex
+        rewritten = resolve_link(self.base_url, match.group(index))
+        if rewritten is None:
+            return match.group(0)
+        quote = LINK_QUOTES[index]
+        return match.group(1) + quote + rewritten + quote
+
+    def _rewrite(self, data):
+        for pattern in self.patterns:
+            data = pattern.sub(self._replace, data)
+        return data
+
+    def feed(self, data):
+        data = self.tail + data
+        cut = max(data.rfind(boundary) for boundary in self.boundaries) + 1
+        if cut == 0 and len(data) <= LINK_REWRITE_MAX_CARRY:
+            self.tail = data
+            return b''
+        if cut == 0:
+            cut = len(data)
+        self.tail = data[cut:]
+        return self._rewrite(data[:cut])
+
+    def flush(self):
+        data, self.tail = self.tail, b''
+        return self._rewrite(data)
+
+def is_ascii_compatible(charset):
+    """Совпадают ли в кодировке байты ASCII (для UTF-16 и подобных ссылки байтами не найти)"""
+    if not charset:
+        return True
+    try:
+        return 'href="/"'.encode(charset) == b'href="/"'
+    except (LookupError, UnicodeError):
+        return False
+
+def set_header(response_headers, name, value):
+    response_headers[:] = [(k, v) for k, v in response_headers if k.lower() != name.lower()]
+    response_headers.append((name, value))
+
+def build_body_stages(response, response_headers):
+    """Стадии обработки тела для этого ответа. По умолчанию их нет"""
+    stages = []
+    mimetype, charset = parse_content_type(response.headers.get('Content-Type'))
+
+    if CHARSET_REWRITE:
+        if mimetype in CHARSET_REWRITE_TYPES and charset:
+            try:
+                codec = codecs.lookup(charset).name
+            except LookupError:
+                codec = None
+            if codec and codec != 'utf-8':
+                stages.append(CharsetStage(codec))
+                set_header(response_headers, 'Content-Type', f'{mimetype}; charset=utf-8')
+
+    base_url = str(getattr(response, 'url', '') or '')
+    if LINK_REWRITE and mimetype in LINK_REWRITE_TYPES and base_url:
+        # После CharsetStage текст уже в UTF-8
+        if stages or is_ascii_compatible(charset):
+            patterns, boundaries = LINK_REWRITE_TYPES[mimetype]
+            stages.append(LinkRewriteStage(base_url, patterns, boundaries))
+
+    return stages
+
+def stream_response_content(response, target_encoding=None, chunk_size=None, stages=()):
+    """Отдает тело ответа по частям, в памяти держится не больше одного чанка"""
+    try:
+        for chunk in iter_response_body(response, target_encoding, chunk_size, stages):
+            yield chunk
+    finally:
+        # Клиент отключился или тело дочитано - освобождаем соединение с origin
+        response.close()
+
+def add_vary(response_headers, header_name):
+    for index, (key, value) in enumerate(response_headers):
+        if key.lower() == 'vary':
+            if header_name.lower() not in [v.strip().lower() for v in value.split(',')]:
+                response_headers[index] = (key, f'{value}, {header_name}')
+            return
+    response_headers.append(('Vary', header_name))
+
+def prepare_response_body(response, status, accept_encoding):
+    """
+    Заголовки ответа клиенту и план обработки тела. status передает движок: у ответа
+    requests это status_code, у aiohttp (proxy_async.py) - status.
+    Возвращает (заголовки, кодировка для перекодирования или None, стадии).
+    """
+    response_headers = build_response_headers(response)
+    upstream_encoding = get_content_encoding(response.headers)
+
+    if status == 206:
+        # Часть тела нельзя ни распаковать, ни обработать - байты идут клиенту как есть
+        stages = []
+        target_encoding = None
+    else:
+        stages = build_body_stages(response, response_headers)
+        target_encoding = choose_response_encoding(
+            upstream_encoding,
+            accept_encoding,
+            must_decode=bool(stages)
         )
 
-        content = decode_response_content(response)
+    if target_encoding is None:
+        # Байты идут клиенту без изменений - сохраняем исходные Content-Encoding и Content-Length
+        if upstream_encoding:
+            response_headers.append(('Content-Encoding', response.headers['Content-Encoding']))
+        content_length = response.headers.get('Content-Length')
+        if content_length:
+            response_headers.append(('Content-Length', content_length))
+    else:
+        if target_encoding != 'identity':
+            response_headers.append(('Content-Encoding', target_encoding))
+        if upstream_encoding:
+            add_vary(response_headers, 'Accept-Encoding')
 
-        excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
-        response_headers = []
+    return response_headers, target_encoding, stages
 
-        for key, value in response.headers.items():
-            if key.lower() not in excluded_headers:
-                response_headers.append((key, value))
-
-        response_headers.append(('Access-Control-Allow-Origin', '*'))
-        response_headers.append(('Access-Control-Allow-Methods', '*'))
-        response_headers.append(('Access-Control-Allow-Headers', '*'))
-        response_headers.append(('X-Proxy-Server', 'DH-PROXY/2.0'))
-
-        return Response(
-            content,
-            status=response.status_code,
-            headers=response_headers
+def make_proxy_response(response):
+    """Собирает ответ клиенту из ответа origin"""
+    response_headers, target_encoding, stages = prepare_response_body(
+        response, response.status_code, request.headers.get('Accept-Encoding')
+    )
+
+    if not STREAM_RESPONSES:
+        content = decode_response_content(response, target_encoding, stages)
+        return Response(content, status=response.status_code, headers=response_headers)
+
+    proxy_response = Response(
+        stream_response_content(response, target_encoding, stages=stages),
+        status=response.status_code,
+        headers=response_headers,
+        direct_passthrough=True
+    )
+    proxy_response.call_on_close(response.close)
+    return proxy_response
+
+def make_head_response(response):
+    """Ответ на HEAD: те же заголовки, что получил бы GET, тело не читается"""
+    response_headers, _, _ = prepare_response_body(response, response.status_code, request.headers.get('Accept-Encoding'))
+    response.close()
+    proxy_response = Response(status=response.status_code, headers=response_headers)
+    # Content-Length берется у origin, а не считается по пустому телу
+    proxy_response.automatically_set_content_length = False
+    return proxy_response
+
+# ======================
+# HTTP-кэш ответов (RFC 7234): память + диск
+# ======================
+
+# Заголовки соединения, которые не сохраняются в кэше
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'transfer-encoding', 'upgrade'
+}
+
+# Статусы, которые можно кэшировать эвристически (RFC 7231, раздел 6.1)
+HEURISTIC_STATUSES = {200, 203, 204, 300, 301, 404, 405, 410, 414, 501}
+
+def parse_cache_control(value):
+    """Разбирает Cache-Control в словарь {директива: значение или True}"""
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = arg.strip().strip('"') if arg else True
+    return directives
+
+def parse_seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+def parse_http_date(value):
+    if not value:
+        return None
+    try:
+        parsed = email.utils.parsedate_tz(value)
+        return email.utils.mktime_tz(parsed) if parsed else None
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def parse_vary(headers):
+    return tuple(sorted(
+        v.strip().lower() for v in headers.get('Vary', '').split(',') if v.strip()
+    ))
+
+class CacheEntry:
+    """Сохраненный ответ origin и метаданные для расчета свежести"""
+
+    def __init__(self, key, url, status, headers, vary, request_time, response_time, size, body=None, digest=None,
+                 effective_url=None):
+        self.key = key
+        self.url = url
+        # Адрес, с которого пришел ответ после редиректов: от него считаются относительные ссылки
+        self.effective_url = effective_url or url
+        self.status = status
+        self.headers = CaseInsensitiveDict(headers)
+        self.vary = vary
+        self.request_time = request_time
+        self.response_time = response_time
+        self.size = size
+        self.body = body
+        # sha256 тела: одинаковые тела разных URL хранятся одним блобом
+        if digest is None and body is not None:
+            digest = hashlib.sha256(body).hexdigest()
+        self.digest = digest
+
+    def freshness_lifetime(self):
+        cache_control = parse_cache_control(self.headers.get('Cache-Control'))
+        for directive in ('s-maxage', 'max-age'):
+            if directive in cache_control:
+                lifetime = parse_seconds(cache_control[directive])
+                if lifetime is not None:
+                    return lifetime
+
+        date = parse_http_date(self.headers.get('Date')) or self.response_time
+        if 'Expires' in self.headers:
+            expires = parse_http_date(self.headers['Expires'])
+            return max(0, expires - date) if expires else 0
+
+        # Эвристика: 10% времени с последнего изменения
+        last_modified = parse_http_date(self.headers.get('Last-Modified'))
+        if last_modified and self.status in HEURISTIC_STATUSES:
+            return min(CACHE_HEURISTIC_MAX_AGE, max(0, (date - last_modified) // 10))
+        return 0
+
+    def current_age(self, now=None):
+        now = now or time.time()
+        date = parse_http_date(self.headers.get('Date')) or self.response_time
+        apparent_age = max(0, self.response_time - date)
+        age_value = parse_seconds(self.headers.get('Age')) or 0
+        corrected_age = age_value + (self.response_time - self.request_time)
+        return max(apparent_age, corrected_age) + (now - self.response_time)
+
+    def is_fresh(self, request_cache_control=None):
+        request_cache_control = request_cache_control or {}
+        if 'no-cache' in request_cache_control:
+            return False
+        if 'no-cache' in parse_cache_control(self.headers.get('Cache-Control')):
+            return False
+        lifetime = self.freshness_lifetime()
+        if 'max-age' in request_cache_control:
+            max_age = parse_seconds(request_cache_control['max-age'])
+            if max_age is not None:
+                lifetime = min(lifetime, max_age)
+        return self.current_age() < lifetime
+
+    def stale_allowance(self, directive, default):
+        """Сколько секунд после истечения свежести запись можно отдавать устаревшей"""
+        cache_control = parse_cache_control(self.headers.get('Cache-Control'))
+        # s-maxage для разделяемого кэша подразумевает proxy-revalidate
+        if {'must-revalidate', 'proxy-revalidate', 'no-cache', 's-maxage'} & set(cache_control):
+            return 0
+        if directive in cache_control:
+            allowance = parse_seconds(cache_control[directive])
+            return allowance if allowance is not None else 0
+        return default
+
+    def can_serve_stale(self, directive, default):
+        staleness = self.current_age() - self.freshness_lifetime()
+        return staleness < self.stale_allowance(directive, default)
+
+    def conditional_headers(self):
+        headers = {}
+        if 'ETag' in self.headers:
+            headers['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['Last-Modified']
+        return headers
+
+    def to_meta(self):
+        return {
+            'key': self.key,
+            'url': self.url,
+            'status': self.status,
+            'headers': list(self.headers.items()),
+            'vary': self.vary,
+            'request_time': self.request_time,
+            'response_time': self.response_time,
+            'size': self.size,
+            'digest': self.digest,
+            'effective_url': self.effective_url,
+        }
+
+    @classmethod
+    def from_meta(cls, meta, body=None):
+        return cls(
+            meta['key'], meta['url'], meta['status'], meta['headers'], meta['vary'],
+            meta['request_time'], meta['response_time'], meta['size'], body, meta['digest'],
+            meta.get('effective_url')
         )
 
-    except requests.exceptions.Timeout:
-        return Response('Proxy Error: Request timeout', 504)
-    except requests.exceptions.ConnectionError:
-        return Response('Proxy Error: Connection failed', 502)
-    except Exception as e:
-        return Response(f'Proxy Error: {str(e)}', 500)
+class ResponseCache:
+    """
+    Разделяемый кэш ответов: LRU в памяти с лимитом по байтам и больший LRU на диске.
+    Тела хранятся по sha256 со счетчиком ссылок, одинаковые тела разных URL - один раз
+    """
+
+    def __init__(self, memory_bytes, disk_bytes, disk_dir, max_entry_bytes, mmap_min_bytes=CACHE_MMAP_MIN_BYTES):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.disk_dir = disk_dir
+        self.blob_dir = os.path.join(disk_dir, 'blobs')
+        self.max_entry_bytes = max_entry_bytes
+        self.mmap_min_bytes = mmap_min_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        # digest -> [число записей в памяти, тело]; memory_size считает каждое тело один раз
+        self.memory_blobs = {}
+        self.memory_size = 0
+        # key -> (url, digest)
+        self.disk = OrderedDict()
+        # digest -> [число записей на диске, размер]
+        self.disk_blobs = {}
+        self.disk_size = 0
+        # url -> имена заголовков из Vary последнего сохраненного ответа
+        self.vary_index = {}
+        self.stats = {
+            'hits': 0, 'misses': 0, 'revalidations': 0, 'revalidated': 0,
+            'stores': 0, 'memory_evictions': 0, 'disk_evictions': 0,
+            'disk_hits': 0, 'purged': 0, 'invalidations': 0,
+            'stale_while_revalidate': 0, 'stale_if_error': 0, 'background_revalidations': 0,
+            'memory_dedup': 0, 'disk_dedup': 0, 'mmap_reads': 0, 'range_hits': 0
+        }
+        if self.disk_bytes > 0:
+            os.makedirs(self.blob_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['memory_entries'] = len(self.memory)
+            stats['memory_blobs'] = len(self.memory_blobs)
+            stats['memory_bytes'] = self.memory_size
+            stats['disk_entries'] = len(self.disk)
+            stats['disk_blobs'] = len(self.disk_blobs)
+            stats['disk_bytes'] = self.disk_size
+        lookups = stats['hits'] + stats['misses'] + stats['revalidations']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+    @staticmethod
+    def make_key(url, vary):
+        material = url + '\n' + '\n'.join(f'{name}:{value}' for name, value in sorted(vary.items()))
+        return hashlib.sha256(material.encode('utf-8', 'surrogateescape')).hexdigest()
+
+    @staticmethod
+    def vary_values(names, request_headers):
+        return {name: ' '.join(request_headers.get(name, '').split()) for name in names}
+
+    def _disk_path(self, key, suffix):
+        return os.path.join(self.disk_dir, key + suffix)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def _load_disk_index(self):
+        metas = []
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                size = os.path.getsize(self._blob_path(meta['digest']))
+                metas.append((os.path.getmtime(path), meta, size))
+            except (OSError, ValueError, KeyError, TypeError):
+                self._remove_file(path)
+        for _, meta, size in sorted(metas, key=lambda item: item[0]):
+            self.disk[meta['key']] = (meta['url'], meta['digest'])
+            self._add_disk_blob(meta['digest'], size)
+            self.vary_index[meta['url']] = tuple(sorted(meta['vary']))
+        # Блобы, на которые не ссылается ни одна запись (например, после падения при записи)
+        for name in os.listdir(self.blob_dir):
+            if name not in self.disk_blobs:
+                self._remove_file(self._blob_path(name))
+
+    def _read_blob(self, digest, size):
+        with open(self._blob_path(digest), 'rb') as f:
+            if size < self.mmap_min_bytes:
+                return f.read()
+            # Страницы файла читаются ядром по мере отдачи клиенту, в кучу Python тело не копируется
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _read_disk(self, key):
+        try:
+            with open(self._disk_path(key, '.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            body = self._read_blob(meta['digest'], meta['size'])
+            os.utime(self._disk_path(key, '.json'))
+        except (OSError, ValueError, KeyError):
+            return None
+        return CacheEntry.from_meta(meta, body)
+
+    def _write_disk(self, entry, write_blob):
+        tmp_suffix = f'.tmp{threading.get_ident()}'
+        try:
+            if write_blob:
+                blob_path = self._blob_path(entry.digest)
+                with open(blob_path + tmp_suffix, 'wb') as f:
+                    f.write(entry.body)
+                os.replace(blob_path + tmp_suffix, blob_path)
+            meta_path = self._disk_path(entry.key, '.json')
+            with open(meta_path + tmp_suffix, 'w', encoding='utf-8') as f:
+                json.dump(entry.to_meta(), f)
+            os.replace(meta_path + tmp_suffix, meta_path)
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _add_memory_blob(self, entry):
+        """Ссылка записи на тело в памяти; одинаковое тело уже хранится - запись берет его"""
+        blob = self.memory_blobs.get(entry.digest)
+        if blob is None:
+            self.memory_blobs[entry.digest] = [1, entry.body]
+            self.memory_size += entry.size
+            return
+        blob[0] += 1
+        entry.body = blob[1]
+        self.stats['memory_dedup'] += 1
+
+    def _release_memory_blob(self, entry):
+        blob = self.memory_blobs[entry.digest]
+        blob[0] -= 1
+        if blob[0] == 0:
+            del self.memory_blobs[entry.digest]
+            self.memory_size -= entry.size
+
+    def _add_disk_blob(self, digest, size):
+        blob = self.disk_blobs.get(digest)
+        if blob is None:
+            self.disk_blobs[digest] = [1, size]
+            self.disk_size += size
+            return False
+        blob[0] += 1
+        return True
+
+    def _release_disk_blob(self, digest):
+        # Файл блоба удаляется под self.lock вместе с последней ссылкой; store() берет
+        # ссылку до записи, поэтому блоб, который он решил не писать, здесь не удалится
+        blob = self.disk_blobs[digest]
+        blob[0] -= 1
+        if blob[0] == 0:
+            del self.disk_blobs[digest]
+            self.disk_size -= blob[1]
+            self._remove_file(self._blob_path(digest))
+
+    def _drop_memory(self, key):
+        entry = self.memory.pop(key, None)
+        if entry:
+            self._release_memory_blob(entry)
+
+    def _drop_disk(self, key):
+        item = self.disk.pop(key, None)
+        if item:
+            self._release_disk_blob(item[1])
+            return True
+        return False
+
+    def _put_memory(self, entry):
+        """Кладет запись в память и вытесняет старые. Вызывается под self.lock"""
+        self._drop_memory(entry.key)
+        if entry.size > self.memory_bytes:
+            return
+        self.memory[entry.key] = entry
+        self._add_memory_blob(entry)
+        while self.memory_size > self.memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self._release_memory_blob(evicted)
+            self.stats['memory_evictions'] += 1
+
+    def _is_mapped(self, entry):
+        """Большие тела при наличии диска живут только там и читаются через mmap"""
+        return self.disk_bytes > 0 and self.mmap_min_bytes <= entry.size <= self.disk_bytes
+
+    def lookup(self, url, request_headers):
+        """Ищет сохраненный вариант ответа для url с учетом Vary"""
+        with self.lock:
+            names = self.vary_index.get(url)
+            if names is None:
+                return None
+            key = self.make_key(url, self.vary_values(names, request_headers))
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                return entry
+            on_disk = key in self.disk
+            if on_disk:
+                self.disk.move_to_end(key)
+
+        if not on_disk:
+            return None
+        entry = self._read_disk(key)
+        if entry is None:
+            with self.lock:
+                if self._drop_disk(key):
+                    self.stats['disk_evictions'] += 1
+            return None
+        with self.lock:
+            self.stats['disk_hits'] += 1
+            if isinstance(entry.body, mmap.mmap):
+                self.stats['mmap_reads'] += 1
+            else:
+                self._put_memory(entry)
+        return entry
+
+    def store(self, entry):
+        mapped = self._is_mapped(entry)
+        with self.lock:
+            self.vary_index[entry.url] = tuple(sorted(entry.vary))
+            if mapped:
+                self._drop_memory(entry.key)
+            else:
+                self._put_memory(entry)
+            self.stats['stores'] += 1
+
+        if self.disk_bytes <= 0 or entry.size > self.disk_bytes:
+            return
+        with self.lock:
+            # Ссылка на блоб берется вместе с проверкой: блоб, который уже есть и потому
+            # не пишется, не освободится, пока запись не сохранена. Это же держит блоб
+            # при обновлении после 304, когда ниже освобождается ссылка прежней записи
+            blob_exists = self._add_disk_blob(entry.digest, entry.size)
+        if not self._write_disk(entry, write_blob=not blob_exists):
+            with self.lock:
+                self._release_disk_blob(entry.digest)
+                if mapped:
+                    self._put_memory(entry)
+            return
+
+        evicted = []
+        with self.lock:
+            previous = self.disk.pop(entry.key, None)
+            self.disk[entry.key] = (entry.url, entry.digest)
+            if blob_exists and not (previous and previous[1] == entry.digest):
+                self.stats['disk_dedup'] += 1
+            if previous:
+                self._release_disk_blob(previous[1])
+            while self.disk_size > self.disk_bytes:
+                key, (_, digest) = self.disk.popitem(last=False)
+                self._release_disk_blob(digest)
+                self.stats['disk_evictions'] += 1
+                evicted.append(key)
+        for key in evicted:
+            self._remove_file(self._disk_path(key, '.json'))
+
+    def refresh(self, entry, response, request_time):
+        """Обновляет запись после 304 Not Modified от origin"""
+        headers = CaseInsensitiveDict(entry.headers)
+        for key, value in response.headers.items():
+            if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() not in ('content-length', 'content-encoding'):
+                headers[key] = value
+        refreshed = CacheEntry(
+            entry.key, entry.url, entry.status, list(headers.items()), entry.vary,
+            request_time, time.time(), entry.size, entry.body, entry.digest, entry.effective_url
+        )
+        self.store(refreshed)
+        return refreshed
+
+    def _remove_where(self, predicate):
+        removed = []
+        with self.lock:
+            for key in [k for k, e in self.memory.items() if predicate(e.url)]:
+                self._drop_memory(key)
+                removed.append(key)
+            for key in [k for k, (u, _) in self.disk.items() if predicate(u)]:
+                self._drop_disk(key)
+                removed.append(key)
+            for url in [u for u in self.vary_index if predicate(u)]:
+                del self.vary_index[url]
+        for key in set(removed):
+            self._remove_file(self._disk_path(key, '.json'))
+        return len(set(removed))
+
+    def invalidate(self, url):
+        """Удаляет все варианты url (после небезопасного запроса к нему)"""
+        removed = self._remove_where(lambda u: u == url)
+        if removed:
+            self.count('invalidations', removed)
+        return removed
+
+    def purge(self, prefix):
+        removed = self._remove_where(lambda u: u.startswith(prefix))
+        self.count('purged', removed)
+        return removed
+
+response_cache = ResponseCache(CACHE_MEMORY_BYTES, CACHE_DISK_BYTES, CACHE_DISK_DIR, CACHE_MAX_ENTRY_BYTES)
+
+metrics.describe('dh_proxy_cache_events_total', 'counter', 'Response cache events: hits, misses, revalidations, stores, evictions')
+metrics.describe('dh_proxy_cache_size_bytes', 'gauge', 'Bytes held by each cache tier')
+metrics.describe('dh_proxy_cache_entries', 'gauge', 'Entries held by each cache tier')
+metrics.describe('dh_proxy_cache_blobs', 'gauge', 'Unique response bodies held by each cache tier')
+
+def collect_cache_metrics():
+    stats = response_cache.get_stats()
+    samples = []
+    for name, value in stats.items():
+        if name in ('memory_entries', 'memory_blobs', 'memory_bytes',
+                    'disk_entries', 'disk_blobs', 'disk_bytes', 'hit_rate'):
+            continue
+        samples.append(('dh_proxy_cache_events_total', (('event', name),), value))
+    for tier in ('memory', 'disk'):
+        samples.append(('dh_proxy_cache_size_bytes', (('tier', tier),), stats[f'{tier}_bytes']))
+        samples.append(('dh_proxy_cache_entries', (('tier', tier),), stats[f'{tier}_entries']))
+        samples.append(('dh_proxy_cache_blobs', (('tier', tier),), stats[f'{tier}_blobs']))
+    return samples
+
+metrics.register_collector(collect_cache_metrics)
+
+def is_request_cacheable(request_headers):
+    if not CACHE_ENABLED:
+        return False
+    cache_control = parse_cache_control(request_headers.get('Cache-Control'))
+    return 'no-store' not in cache_control
+
+def is_response_shareable(response, request_headers):
+    """Может ли ответ одного клиента достаться другому: правила разделяемого кэша без учета свежести"""
+    cache_control = parse_cache_control(response.headers.get('Cache-Control'))
+    if 'no-store' in cache_control or 'private' in cache_control:
+        return False
+    if 'Set-Cookie' in response.headers or '*' in parse_vary(response.headers):
+        return False
+    if 'Authorization' in request_headers:
+        return bool({'public', 's-maxage', 'must-revalidate'} & set(cache_control))
+    return True
+
+def is_response_storable(response, request_headers):
+    """Можно ли сохранить ответ в разделяемом кэше (RFC 7234, раздел 3)"""
+    if not is_response_shareable(response, request_headers):
+        return False
+    cache_control = parse_cache_control(response.headers.get('Cache-Control'))
+    if response.status_code not in HEURISTIC_STATUSES:
+        return False
+    if not followed_only_permanent_redirects(response):
+        return False
+    content_length = parse_seconds(response.headers.get('Content-Length'))
+    if content_length is not None and content_length > CACHE_MAX_ENTRY_BYTES:
+        return False
+
+    explicit = 'max-age' in cache_control or 's-maxage' in cache_control or 'Expires' in response.headers
+    if explicit or 'public' in cache_control:
+        return True
+    return response.status_code in HEURISTIC_STATUSES and 'Last-Modified' in response.headers
+
+def followed_only_permanent_redirects(response):
+    """
+    Ответ можно сохранить под запрошенным url: на пути к нему не было временных редиректов.
+    После 302/303/307 это ответ другого адреса, и завтра запрошенный url может вести в другое место
+    """
+    return all(hop.status_code in PERMANENT_REDIRECTS for hop in getattr(response, 'history', ()))
+
+def cacheable_headers(response):
+    return [
+        (key, value) for key, value in response.headers.items()
+        if key.lower() not in HOP_BY_HOP_HEADERS
+    ]
+
+class CachingRawStream:
+    """Обертка над raw-потоком origin: копирует тело для кэша по мере отдачи клиенту"""
+
+    def __init__(self, raw, limit, on_complete):
+        self._raw = raw
+        self._limit = limit
+        self._on_complete = on_complete
+
+    def stream(self, amt=None, decode_content=None):
+        buffer = []
+        size = 0
+        for chunk in self._raw.stream(amt, decode_content=decode_content):
+            if buffer is not None:
+                size += len(chunk)
+                if size > self._limit:
+                    buffer = None
+                else:
+                    buffer.append(chunk)
+            yield chunk
+        # Сюда доходим только если тело дочитано целиком
+        if buffer is not None:
+            self._on_complete(b''.join(buffer))
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+def attach_cache_writer(url, request_headers, response, request_time):
+    """Сохраняет ответ в кэш, когда клиент дочитает его тело"""
+    vary_names = parse_vary(response.headers)
+    vary = ResponseCache.vary_values(vary_names, request_headers)
+    key = ResponseCache.make_key(url, vary)
+    status = response.status_code
+    headers = cacheable_headers(response)
+    effective_url = response.url
+    response_time = time.time()
+
+    def on_complete(body):
+        response_cache.store(CacheEntry(
+            key, url, status, headers, vary, request_time, response_time, len(body), body,
+            effective_url=effective_url
+        ))
+
+    response.raw = CachingRawStream(response.raw, CACHE_MAX_ENTRY_BYTES, on_complete)
+
+class CachedResponse:
+    """
+    Ответ из кэша с тем же интерфейсом, что использует make_proxy_response у ответа requests.
+    byte_range - (первый, последний байт) для ответа 206 на запрос с Range.
+    """
+
+    def __init__(self, entry, warning=None, byte_range=None):
+        self.status_code = entry.status
+        self.url = entry.effective_url
+        self.headers = CaseInsensitiveDict(entry.headers)
+        self.headers['Age'] = str(int(entry.current_age()))
+        if warning:
+            self.headers['Warning'] = warning
+        if entry.status == 200:
+            self.headers['Accept-Ranges'] = 'bytes'
+        self.raw = self
+        self._body = entry.body
+        self._start, self._end = 0, len(entry.body)
+        if byte_range is not None:
+            first, last = byte_range
+            self.status_code = 206
+            self.headers['Content-Range'] = f'bytes {first}-{last}/{entry.size}'
+            self.headers['Content-Length'] = str(last - first + 1)
+            self._start, self._end = first, last + 1
+
+    def stream(self, amt=None, decode_content=None):
+        amt = amt or STREAM_CHUNK_SIZE
+        for offset in range(self._start, self._end, amt):
+            yield self._body[offset:min(offset + amt, self._end)]
+
+    def close(self):
+        pass
+
+# ======================
+# Адаптивные таймауты и hedged-запросы
+# ======================
+
+HEDGE_EVENTS = ('sent', 'hedge_won', 'primary_won', 'budget_exhausted')
+
+metrics.describe('dh_proxy_hedge_events_total', 'counter', 'Hedged requests: sent, won by the hedge or the primary, skipped for lack of retry budget')
+metrics.describe('dh_proxy_retry_budget_tokens', 'gauge', 'Retries currently allowed by the global retry budget')
+
+def count_hedge_event(name):
+    metrics.inc('dh_proxy_hedge_events_total', (('event', name),))
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+class HostLatency:
+    """Последние задержки соединения и первого байта одного origin и выведенные из них таймауты"""
+
+    def __init__(self):
+        self.connect = deque(maxlen=LATENCY_SAMPLES)
+        self.ttfb = deque(maxlen=LATENCY_SAMPLES)
+        self.computed_at = 0.0
+        # (connect, read, задержка hedge или None)
+        self.limits = (UPSTREAM_TIMEOUT, UPSTREAM_TIMEOUT, None)
+
+    def get_limits(self):
+        # Перцентили пересчитываются не чаще раза в секунду, а не на каждый запрос
+        now = time.monotonic()
+        if now - self.computed_at >= 1:
+            self.computed_at = now
+            self.limits = self._compute()
+        return self.limits
+
+    def _compute(self):
+        # deque.copy() атомарна, в отличие от итерации по deque, в которую пишут другие потоки
+        connect = self.connect.copy()
+        ttfb = self.ttfb.copy()
+        connect_timeout = read_timeout = UPSTREAM_TIMEOUT
+        hedge_delay = None
+        if len(connect) >= TIMEOUT_MIN_SAMPLES:
+            connect_timeout = percentile(connect, 0.99) * TIMEOUT_MULTIPLIER
+            connect_timeout = min(max(connect_timeout, CONNECT_TIMEOUT_MIN), TIMEOUT_MAX)
+        if len(ttfb) >= TIMEOUT_MIN_SAMPLES:
+            read_timeout = percentile(ttfb, 0.99) * TIMEOUT_MULTIPLIER
+            read_timeout = min(max(read_timeout, READ_TIMEOUT_MIN), TIMEOUT_MAX)
+            hedge_delay = max(percentile(ttfb, 0.95), HEDGE_MIN_DELAY)
+        return connect_timeout, read_timeout, hedge_delay
+
+    def snapshot(self):
+        connect_timeout, read_timeout, hedge_delay = self.get_limits()
+        ttfb = self.ttfb.copy()
+        return {
+            'connect_timeout': round(connect_timeout, 3),
+            'read_timeout': round(read_timeout, 3),
+            'hedge_delay': round(hedge_delay, 3) if hedge_delay is not None else None,
+            'connect_samples': len(self.connect),
+            'ttfb_samples': len(ttfb),
+            'ttfb_p50': round(percentile(ttfb, 0.5), 4) if ttfb else None,
+            'ttfb_p95': round(percentile(ttfb, 0.95), 4) if ttfb else None,
+        }
+
+host_latencies = OrderedDict()
+host_latencies_lock = threading.Lock()
+
+def get_host_latency(host):
+    host = (host or '').lower()
+    with host_latencies_lock:
+        tracker = host_latencies.get(host)
+        if tracker is None:
+            tracker = host_latencies[host] = HostLatency()
+            while len(host_latencies) > LATENCY_MAX_HOSTS:
+                host_latencies.popitem(last=False)
+        else:
+            host_latencies.move_to_end(host)
+        return tracker
+
+def get_timeout_states():
+    with host_latencies_lock:
+        trackers = list(host_latencies.items())
+    return {host: tracker.snapshot() for host, tracker in trackers}
+
+class RetryBudget:
+    """
+    Общий бюджет повторов: каждый запрос добавляет ratio токена, каждый повтор тратит токен.
+    min_per_second токенов в секунду дается всегда, чтобы повторы работали и при малом трафике.
+    """
+
+    def __init__(self, ratio, min_per_second, max_tokens):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.lock = threading.Lock()
+        self.tokens = min(max_tokens, min_per_second)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.max_tokens, self.tokens + (now - self.updated) * self.min_per_second)
+        self.updated = now
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def available(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND, RETRY_BUDGET_MAX_TOKENS)
+
+metrics.register_collector(lambda: [('dh_proxy_retry_budget_tokens', (), round(retry_budget.available(), 2))])
+
+# Hedged-запросы выполняются в пуле, чтобы ждать первый из двух ответов
+hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedge')
+
+def close_when_done(future):
+    """Проигравший hedged-запрос: не начат - отменяем, идет - закрываем ответ, когда придет"""
+    if future.cancel():
+        return
+
+    def close(done):
+        if not done.cancelled() and done.exception() is None:
+            done.result().close()
+
+    future.add_done_callback(close)
+
+def fetch_hedged(method, url, headers, allow_redirects, timeouts, hedge_delay, tracker):
+    """
+    Если origin не ответил за hedge_delay (p95 хоста), уходит второй такой же запрос.
+    Побеждает первый успешный ответ; если оба неуспешны - ошибка основного запроса.
+    """
+    timing = current_timing()
+
+    def attempt():
+        # Фазы обеих попыток пишутся в тайминги исходного запроса
+        timing_local.timing = timing
+        try:
+            return fetch_upstream_once(method, url, headers, None, allow_redirects, timeouts, tracker)
+        finally:
+            timing_local.timing = None
+
+    primary = hedge_executor.submit(attempt)
+    done, _ = wait([primary], timeout=hedge_delay)
+    if done:
+        return primary.result()
+    if not retry_budget.withdraw():
+        count_hedge_event('budget_exhausted')
+        return primary.result()
+
+    count_hedge_event('sent')
+    hedge = hedge_executor.submit(attempt)
+    pending = {primary, hedge}
+    errors = {}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = None
+        for future in done:
+            try:
+                response = future.result()
+            except Exception as e:
+                errors[future] = e
+                continue
+            if winner is None:
+                winner = future, response
+            else:
+                response.close()
+        if winner is not None:
+            for future in pending:
+                close_when_done(future)
+            count_hedge_event('hedge_won' if winner[0] is hedge else 'primary_won')
+            return winner[1]
+    raise errors.get(primary) or errors[hedge]
+
+# ======================
+# Кэш постоянных редиректов
+# ======================
+
+PERMANENT_REDIRECTS = (301, 308)
+
+metrics.describe('dh_proxy_redirect_cache_events_total', 'counter', 'Permanent redirect cache: lookups rewritten, redirect hops saved, redirects learned, entries dropped')
+
+def count_redirect_event(name, amount=1):
+    metrics.inc('dh_proxy_redirect_cache_events_total', (('event', name),), amount)
+
+class RedirectCache:
+    """LRU url -> (куда ведет, код, когда истекает) для 301/308 от origin"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def resolve(self, method, url):
+        """
+        Конечный известный адрес для url, сколько редиректов пропущено и нужно ли
+        снять Authorization (на одном из переходов requests сам снял бы его)
+        """
+        now = time.monotonic()
+        hops = 0
+        strip_auth = False
+        seen = {url}
+        with self.lock:
+            while hops < REDIRECT_MAX_HOPS:
+                entry = self.entries.get(url)
+                if entry is None:
+                    break
+                target, status, expires = entry
+                if expires <= now:
+                    del self.entries[url]
+                    break
+                # 301 исторически превращает POST в GET - для методов с телом переходим только по 308
+                if status == 301 and method not in ('GET', 'HEAD'):
+                    break
+                if target in seen:
+                    break
+                self.entries.move_to_end(url)
+                seen.add(target)
+                strip_auth = strip_auth or upstream_session.should_strip_auth(url, target)
+                url = target
+                hops += 1
+        return url, hops, strip_auth
+
+    def store(self, source, target, status, ttl):
+        with self.lock:
+            self.entries[source] = (target, status, time.monotonic() + ttl)
+            self.entries.move_to_end(source)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def forget(self, url):
+        with self.lock:
+            return self.entries.pop(url, None) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+redirect_cache = RedirectCache(REDIRECT_CACHE_SIZE)
+
+def redirect_ttl(response):
+    """Сколько помнить редирект: не дольше max-age ответа и REDIRECT_CACHE_TTL; None - не запоминать"""
+    cache_control = parse_cache_control(response.headers.get('Cache-Control'))
+    if 'no-store' in cache_control or 'no-cache' in cache_control or 'private' in cache_control:
+        return None
+    max_age = parse_seconds(cache_control.get('max-age'))
+    if max_age is not None:
+        return min(max_age, REDIRECT_CACHE_TTL) or None
+    return REDIRECT_CACHE_TTL
+
+def redirected_headers(headers, strip_auth):
+    """
+    Заголовки запроса по адресу из кэша редиректов - такие, какие requests отправил бы после
+    перехода: Cookie снимается всегда, Authorization - при смене хоста или https -> http
+    """
+    dropped = ('cookie', 'authorization') if strip_auth else ('cookie',)
+    return {key: value for key, value in headers.items() if key.lower() not in dropped}
+
+def is_redirect_shareable(hop):
+    """
+    Можно ли отдавать редирект всем клиентам по одному url: кэш редиректов ключуется только
+    адресом, поэтому ответ с Vary или ответ на запрос с учетными данными без явного public/s-maxage
+    мог зависеть от клиента и не запоминается
+    """
+    if parse_vary(hop.headers):
+        return False
+    request_headers = hop.request.headers if hop.request is not None else {}
+    if not is_response_shareable(hop, request_headers):
+        return False
+    if 'Cookie' in request_headers:
+        cache_control = parse_cache_control(hop.headers.get('Cache-Control'))
+        return bool({'public', 's-maxage'} & set(cache_control))
+    return True
+
+def learn_redirects(response):
+    """Запоминает постоянные редиректы из цепочки, пройденной requests, и из самого ответа"""
+    for hop in list(response.history) + [response]:
+        if hop.status_code not in PERMANENT_REDIRECTS or 'Location' not in hop.headers:
+            continue
+        if not is_redirect_shareable(hop):
+            continue
+        ttl = redirect_ttl(hop)
+        if ttl is None:
+            continue
+        target = urljoin(hop.url, hop.headers['Location'])
+        if target != hop.url:
+            redirect_cache.store(hop.url, target, hop.status_code, ttl)
+            count_redirect_event('learned')
+
+# ======================
+# Отрицательный кэш
+# ======================
+
+NEGATIVE_STATUSES = (404, 410)
+
+metrics.describe('dh_proxy_negative_cache_events_total', 'counter', 'Negative cache: failures stored and requests answered from it, by kind (dns, refused, tls, 404, 410)')
+metrics.describe('dh_proxy_negative_cache_entries', 'gauge', 'Live negative cache entries by scope (host, url)')
+
+def count_negative_event(name, kind):
+    metrics.inc('dh_proxy_negative_cache_events_total', (('event', name), ('kind', kind)))
+
+class NegativeCacheError(requests.exceptions.ConnectionError):
+    """Хост недавно был недоступен, запрос отклонен без обращения к нему"""
+
+def classify_connection_error(error):
+    """Вид отказа для отрицательного кэша: dns, refused, tls; None - сбой, который не запоминаем"""
+    if isinstance(error, requests.exceptions.SSLError):
+        return 'tls'
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    if isinstance(reason, NameResolutionError):
+        return 'dns'
+    if isinstance(reason, NewConnectionError) and isinstance(reason.__cause__, ConnectionRefusedError):
+        return 'refused'
+    return None
+
+def negative_host_key(url):
+    # Со схемой: отказ TLS на https не должен закрывать http того же хоста и порта
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc.lower()}'
+
+class NegativeCache:
+    """
+    Короткоживущие отказы: host -> (вид, текст ошибки, когда истекает) для ошибок соединения
+    и url -> (запись кэша, когда истекает) для 404/410, которые не берет обычный кэш.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hosts = OrderedDict()
+        self.urls = OrderedDict()
+
+    def _get(self, entries, key):
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        if entry[-1] <= time.monotonic():
+            del entries[key]
+            return None
+        return entry
+
+    def _put(self, entries, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def check_host(self, url):
+        """Бросает NegativeCacheError, если хост url недавно не отвечал"""
+        host = negative_host_key(url)
+        with self.lock:
+            entry = self._get(self.hosts, host)
+        if entry is None:
+            return
+        kind, message, _ = entry
+        count_negative_event('hits', kind)
+        raise NegativeCacheError(f'{host}: {message}')
+
+    def record_error(self, url, error):
+        kind = classify_connection_error(error)
+        if kind is None:
+            return
+        host = negative_host_key(url)
+        with self.lock:
+            self._put(self.hosts, host, (kind, str(error), time.monotonic() + NEGATIVE_HOST_TTL))
+        count_negative_event('stored', kind)
+
+    def lookup_url(self, url):
+        with self.lock:
+            entry = self._get(self.urls, url)
+        if entry is None:
+            return None
+        count_negative_event('hits', str(entry[0].status))
+        return entry[0]
+
+    def store_url(self, entry, ttl):
+        with self.lock:
+            self._put(self.urls, entry.url, (entry, time.monotonic() + ttl))
+        count_negative_event('stored', str(entry.status))
+
+    def forget_url(self, url):
+        with self.lock:
+            self.urls.pop(url, None)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                'hosts': {
+                    host: {'kind': kind, 'error': message, 'expires_in': round(expires - now, 2)}
+                    for host, (kind, message, expires) in self.hosts.items() if expires > now
+                },
+                'urls': {
+                    url: {'status': entry.status, 'expires_in': round(expires - now, 2)}
+                    for url, (entry, expires) in self.urls.items() if expires > now
+                },
+            }
+
+negative_cache = NegativeCache(NEGATIVE_MAX_ENTRIES)
+
+def negative_url_ttl(response, request_headers):
+    """Сколько помнить 404/410: не дольше max-age ответа и NEGATIVE_URL_TTL; None - не запоминать"""
+    if response.status_code not in NEGATIVE_STATUSES or 'Authorization' in request_headers:
+        return None
+    if not followed_only_permanent_redirects(response):
+        return None
+    cache_control = parse_cache_control(response.headers.get('Cache-Control'))
+    if 'no-store' in cache_control or 'no-cache' in cache_control or 'private' in cache_control:
+        return None
+    # Запись одна на url: ответ может зависеть только от сжатия, его make_proxy_response подгоняет сам
+    if 'Set-Cookie' in response.headers or set(parse_vary(response.headers)) - {'accept-encoding'}:
+        return None
+    max_age = parse_seconds(cache_control.get('s-maxage', cache_control.get('max-age')))
+    if max_age is not None:
+        return min(max_age, NEGATIVE_URL_TTL) or None
+    return NEGATIVE_URL_TTL
+
+def attach_negative_writer(url, response, request_time, ttl):
+    """Запоминает 404/410 в отрицательном кэше, когда клиент дочитает тело"""
+    status = response.status_code
+    headers = cacheable_headers(response)
+    effective_url = response.url
+    response_time = time.time()
+
+    def on_complete(body):
+        negative_cache.store_url(CacheEntry(
+            url, url, status, headers, (), request_time, response_time, len(body), body,
+            effective_url=effective_url
+        ), ttl)
+
+    response.raw = CachingRawStream(response.raw, NEGATIVE_MAX_BODY, on_complete)
+
+def get_negative_stats():
+    values = metrics.counter_values('dh_proxy_negative_cache_events_total')
+    stats = {'hits': {}, 'stored': {}}
+    for labels, value in values.items():
+        labels = dict(labels)
+        stats[labels['event']][labels['kind']] = value
+    stats.update(negative_cache.snapshot())
+    return stats
+
+def collect_negative_metrics():
+    snapshot = negative_cache.snapshot()
+    return [
+        ('dh_proxy_negative_cache_entries', (('scope', 'host'),), len(snapshot['hosts'])),
+        ('dh_proxy_negative_cache_entries', (('scope', 'url'),), len(snapshot['urls'])),
+    ]
+
+metrics.register_collector(collect_negative_metrics)
+
+# ======================
+# Circuit breaker на каждый origin
+# ======================
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Origin помечен неработающим, запрос отклонен без обращения к нему"""
+
+class CircuitOpenTimeout(requests.exceptions.Timeout):
+    """Origin помечен неработающим из-за таймаутов, запрос отклонен без обращения к нему"""
+
+class CircuitBreaker:
+    """
+    Здоровье одного origin: доля ошибок и задержки в скользящем окне.
+    closed - запросы идут, open - сразу отказ, half_open - пропускаем пробные запросы.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.window = deque()
+        self.opened_at = 0.0
+        self.open_until = 0.0
+        self.last_failure = 'connection'
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+        self.times_opened = 0
+        self.rejected = 0
+
+    def _trim(self, now):
+        while self.window and self.window[0][0] < now - BREAKER_WINDOW:
+            self.window.popleft()
+
+    def _open(self, now):
+        self.state = 'open'
+        self.opened_at = now
+        self.open_until = now + BREAKER_OPEN_SECONDS
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+        self.times_opened += 1
+
+    def before_request(self):
+        """Проверяет, можно ли идти в origin. Возвращает True, если это пробный запрос"""
+        now = time.monotonic()
+        with self.lock:
+            if self.state == 'open':
+                if now < self.open_until:
+                    self.rejected += 1
+                    self._raise_open()
+                self.state = 'half_open'
+            if self.state == 'half_open':
+                if self.probes_in_flight >= BREAKER_HALF_OPEN_PROBES:
+                    self.rejected += 1
+                    self._raise_open()
+                self.probes_in_flight += 1
+                return True
+            return False
+
+    def _raise_open(self):
+        if self.last_failure == 'timeout':
+            raise CircuitOpenTimeout(f'Circuit open for {self.host}')
+        raise CircuitOpenError(f'Circuit open for {self.host}')
+
+    def record(self, ok, latency, probe, failure_kind=None):
+        now = time.monotonic()
+        # Слишком медленный ответ считаем отказом
+        if ok and latency > BREAKER_SLOW_CALL_SECONDS:
+            ok = False
+            failure_kind = 'timeout'
+        with self.lock:
+            self._trim(now)
+            self.window.append((now, ok, latency))
+            if not ok:
+                self.last_failure = failure_kind or 'connection'
+
+            if probe:
+                self.probes_in_flight = max(0, self.probes_in_flight - 1)
+                if self.state != 'half_open':
+                    return
+                if not ok:
+                    self._open(now)
+                    return
+                self.probe_successes += 1
+                if self.probe_successes >= BREAKER_HALF_OPEN_SUCCESSES:
+                    self.state = 'closed'
+                    self.window.clear()
+                return
+
+            if self.state == 'closed' and not ok:
+                failures = sum(1 for _, success, _ in self.window if not success)
+                if len(self.window) >= BREAKER_MIN_REQUESTS and failures / len(self.window) >= BREAKER_FAILURE_RATE:
+                    self._open(now)
+
+    def release_probe(self):
+        """Пробный запрос завершился без результата (например, ошибка на стороне клиента)"""
+        with self.lock:
+            self.probes_in_flight = max(0, self.probes_in_flight - 1)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            self._trim(now)
+            total = len(self.window)
+            failures = sum(1 for _, ok, _ in self.window if not ok)
+            latencies = sorted(latency for _, ok, latency in self.window if ok)
+            state = self.state
+            if state == 'open' and now >= self.open_until:
+                state = 'half_open'
+            return {
+                'state': state,
+                'requests': total,
+                'failures': failures,
+                'failure_rate': round(failures / total, 4) if total else 0.0,
+                'latency_p50': round(latencies[len(latencies) // 2], 4) if latencies else None,
+                'latency_p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 4) if latencies else None,
+                'open_remaining': round(max(0.0, self.open_until - now), 2) if self.state == 'open' else 0.0,
+                'last_failure': self.last_failure,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected,
+            }
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+def get_breaker(url):
+    host = urlsplit(url).netloc.lower()
+    breaker = breakers.get(host)
+    if breaker is not None:
+        return breaker
+    with breakers_lock:
+        breaker = breakers.get(host)
+        if breaker is None:
+            if len(breakers) >= BREAKER_MAX_HOSTS:
+                # Забываем здоровые origin без недавних запросов
+                for key in [k for k, b in breakers.items() if b.state == 'closed' and not b.window]:
+                    del breakers[key]
+            breaker = CircuitBreaker(host)
+            breakers[host] = breaker
+        return breaker
+
+def get_breaker_states():
+    return {host: breaker.snapshot() for host, breaker in list(breakers.items())}
+
+metrics.describe('dh_proxy_breaker_state', 'gauge', 'Circuit breaker state per upstream host (1 for the current state)')
+metrics.describe('dh_proxy_breaker_failure_rate', 'gauge', 'Failure rate in the breaker sliding window')
+metrics.describe('dh_proxy_breaker_rejected_total', 'counter', 'Requests rejected by an open breaker')
+
+def collect_breaker_metrics():
+    samples = []
+    for host, state in get_breaker_states().items():
+        for name in ('closed', 'open', 'half_open'):
+            samples.append(('dh_proxy_breaker_state', (('host', host), ('state', name)), int(state['state'] == name)))
+        samples.append(('dh_proxy_breaker_failure_rate', (('host', host),), state['failure_rate']))
+        samples.append(('dh_proxy_breaker_rejected_total', (('host', host),), state['rejected']))
+    return samples
+
+metrics.register_collector(collect_breaker_metrics)
+
+def fetch_upstream(method, url, headers, data=None, allow_redirects=True, timeout=None):
+    """
+    Запрос к origin с таймаутами по задержкам его хоста; timeout дополнительно ограничивает их.
+    Идемпотентный запрос без тела может быть продублирован (hedged), если это включено.
+    Известные постоянные редиректы проходятся сразу, без запросов к промежуточным адресам.
+    Хост из отрицательного кэша отклоняется сразу той же ошибкой соединения.
+    """
+    requested_url = url
+    hops = 0
+    if REDIRECT_CACHE_ENABLED:
+        url, hops, strip_auth = redirect_cache.resolve(method, url)
+        if hops:
+            count_redirect_event('rewrites')
+            count_redirect_event('hops_saved', hops)
+            headers = redirected_headers(headers, strip_auth)
+    if NEGATIVE_CACHE_ENABLED:
+        negative_cache.check_host(url)
+
+    tracker = get_host_latency(urlsplit(url).hostname)
+    if ADAPTIVE_TIMEOUTS:
+        connect_timeout, read_timeout, hedge_delay = tracker.get_limits()
+    else:
+        connect_timeout = read_timeout = UPSTREAM_TIMEOUT
+        hedge_delay = None
+    if timeout is not None:
+        connect_timeout, read_timeout = min(connect_timeout, timeout), min(read_timeout, timeout)
+
+    retry_budget.deposit()
+    if HEDGE_ENABLED and hedge_delay is not None and method in ('GET', 'HEAD') and data is None:
+        response = fetch_hedged(method, url, headers, allow_redirects, (connect_timeout, read_timeout), hedge_delay, tracker)
+    else:
+        response = fetch_upstream_once(method, url, headers, data, allow_redirects, (connect_timeout, read_timeout), tracker)
+
+    if REDIRECT_CACHE_ENABLED:
+        # Адрес, куда вел редирект, перестал отвечать - в следующий раз идем по исходному url
+        if hops and response.status_code >= 400 and redirect_cache.forget(requested_url):
+            count_redirect_event('dropped')
+        learn_redirects(response)
+    return response
+
+def fetch_upstream_once(method, url, headers, data, allow_redirects, timeouts, tracker):
+    """Один запрос к origin через общий пул соединений и circuit breaker его хоста"""
+    breaker = get_breaker(url) if BREAKER_ENABLED else None
+    probe = breaker.before_request() if breaker else False
+    timing = current_timing()
+    connection_before = sum(timing.phases.get(phase, 0.0) for phase in ('dns', 'connect', 'tls')) if timing else 0.0
+    start = time.monotonic()
+    try:
+        response = upstream_session.request(
+            method=method,
+            url=url,
+            headers=headers,
+            data=data,
+            timeout=timeouts,
+            allow_redirects=allow_redirects,
+            stream=True
+        )
+    except requests.exceptions.Timeout as e:
+        # Таймаут чтения тоже замер: иначе p99 занижается и таймауты хоста сжимаются по спирали
+        if isinstance(e, requests.exceptions.ReadTimeout):
+            tracker.ttfb.append(time.monotonic() - start)
+        if breaker:
+            breaker.record(False, time.monotonic() - start, probe, 'timeout')
+        raise
+    except requests.exceptions.ConnectionError as e:
+        if breaker:
+            breaker.record(False, time.monotonic() - start, probe, 'connection')
+        if NEGATIVE_CACHE_ENABLED:
+            # После редиректа упасть мог другой хост - запоминаем тот, к которому шел запрос
+            negative_cache.record_error(getattr(e.request, 'url', None) or url, e)
+        raise
+    except Exception:
+        if breaker and probe:
+            breaker.release_probe()
+        raise
+
+    tracker.ttfb.append(response.elapsed.total_seconds())
+    if timing is not None:
+        # До первого байта ответа, без времени на установку соединения
+        connection = sum(timing.phases.get(phase, 0.0) for phase in ('dns', 'connect', 'tls')) - connection_before
+        timing.add('ttfb', max(0.0, time.monotonic() - start - connection))
+    if breaker:
+        breaker.record(True, time.monotonic() - start, probe)
+    return response
+
+def fetch_cached(url, headers, timeout=None):
+    """
+    GET через кэш. Возвращает (ответ, статус кэша),
+    где статус - HIT, MISS, REVALIDATED, NEGATIVE или BYPASS.
+    """
+    request_headers = CaseInsensitiveDict(headers)
+    if not is_request_cacheable(request_headers):
+        return coalesced_fetch('GET', url, headers, lambda: (fetch_upstream('GET', url, headers, timeout=timeout), 'BYPASS'))
+
+    entry, fresh = lookup_cached(url, request_headers)
+    if fresh:
+        response_cache.count('hits')
+        return CachedResponse(entry), 'HIT'
+
+    negative = lookup_negative(url, request_headers)
+    if negative is not None:
+        return CachedResponse(negative), 'NEGATIVE'
+
+    # Устаревшую запись отдаем сразу, а origin спрашиваем в фоне
+    request_cache_control = parse_cache_control(request_headers.get('Cache-Control'))
+    if entry is not None and 'no-cache' not in request_cache_control:
+        if entry.can_serve_stale('stale-while-revalidate', CACHE_STALE_WHILE_REVALIDATE):
+            response_cache.count('stale_while_revalidate')
+            revalidate_in_background(url, headers, entry)
+            return CachedResponse(entry, STALE_WARNING), 'STALE'
+
+    return coalesced_fetch('GET', url, headers, lambda: fetch_and_store(url, headers, entry, timeout))
+
+STALE_WARNING = '110 - "Response is Stale"'
+REVALIDATION_FAILED_WARNING = '111 - "Revalidation Failed"'
+
+# Фоновые ревалидации: не больше одной на запись, пул ограничен
+revalidation_executor = ThreadPoolExecutor(max_workers=CACHE_REVALIDATE_WORKERS, thread_name_prefix='revalidate')
+revalidating = set()
+revalidating_lock = threading.Lock()
+
+def revalidate_in_background(url, headers, entry):
+    with revalidating_lock:
+        if entry.key in revalidating:
+            return
+        revalidating.add(entry.key)
+    revalidation_executor.submit(revalidate_entry, url, dict(headers), entry)
+
+def revalidate_entry(url, headers, entry):
+    try:
+        response_cache.count('background_revalidations')
+        response, _ = coalesced_fetch('GET', url, headers, lambda: fetch_and_store(url, headers, entry))
+        try:
+            # Тело дочитываем, чтобы новая версия попала в кэш
+            for _ in iter_raw_body(response):
+                pass
+        finally:
+            response.close()
+    except Exception:
+        # Ошибку увидит следующий запрос, когда окно stale-while-revalidate закончится
+        pass
+    finally:
+        with revalidating_lock:
+            revalidating.discard(entry.key)
+
+def lookup_cached(url, request_headers):
+    """Запись кэша для запроса и признак того, что ее можно отдать без origin"""
+    request_cache_control = parse_cache_control(request_headers.get('Cache-Control'))
+    if request_headers.get('Pragma', '').lower() == 'no-cache':
+        request_cache_control.setdefault('no-cache', True)
+
+    entry = response_cache.lookup(url, request_headers)
+    return entry, entry is not None and entry.is_fresh(request_cache_control)
+
+def lookup_negative(url, request_headers):
+    """Запомненный 404/410 для url, если запрос разрешает ответ без origin"""
+    if not NEGATIVE_CACHE_ENABLED or 'Authorization' in request_headers:
+        return None
+    request_cache_control = parse_cache_control(request_headers.get('Cache-Control'))
+    if 'no-cache' in request_cache_control or request_headers.get('Pragma', '').lower() == 'no-cache':
+        return None
+    return negative_cache.lookup_url(url)
+
+def fetch_head(url, headers):
+    """HEAD: свежая запись кэша отвечает без origin, иначе к origin уходит настоящий HEAD"""
+    request_headers = CaseInsensitiveDict(headers)
+    if is_request_cacheable(request_headers):
+        entry, fresh = lookup_cached(url, request_headers)
+        if fresh:
+            response_cache.count('hits')
+            return CachedResponse(entry), 'HIT'
+        negative = lookup_negative(url, request_headers)
+        if negative is not None:
+            return CachedResponse(negative), 'NEGATIVE'
+    return fetch_upstream('HEAD', url, headers), 'BYPASS'
+
+class RangeNotSatisfiable(Exception):
+    def __init__(self, size):
+        super().__init__(size)
+        self.size = size
+
+def parse_byte_range(value, size):
+    """
+    Один диапазон из Range (RFC 7233) для тела длиной size: (первый, последний байт).
+    None - заголовок не разобрать или диапазонов несколько, такой Range решает origin.
+    """
+    unit, _, ranges = (value or '').partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, sep, last = ranges.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:
+            # Суффикс: последние last байт
+            length = int(last)
+            # У пустого тела нет последних байт: bytes 0--1/0 не ответить
+            if length <= 0 or size == 0:
+                raise RangeNotSatisfiable(size)
+            return max(0, size - length), size - 1
+        first = int(first)
+        last = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable(size)
+    if first > last:
+        return None
+    return first, min(last, size - 1)
+
+def if_range_matches(entry, value):
+    """If-Range совпадает с сохраненным ответом (сравнение только по сильному валидатору)"""
+    if not value:
+        return True
+    if value.startswith(('"', 'W/')):
+        etag = entry.headers.get('ETag')
+        return bool(etag) and not etag.startswith('W/') and etag == value
+    return value == entry.headers.get('Last-Modified')
+
+def fetch_range(url, headers):
+    """
+    GET с Range. Свежий полный ответ из кэша режется на месте, без origin и без перекодирования;
+    иначе Range уходит к origin, а его 206 отдается клиенту без изменений.
+    """
+    request_headers = CaseInsensitiveDict(headers)
+    if is_request_cacheable(request_headers):
+        entry, fresh = lookup_cached(url, request_headers)
+        if fresh and entry.status == 200 and if_range_matches(entry, request_headers.get('If-Range')):
+            passthrough = choose_response_encoding(
+                get_content_encoding(entry.headers), request_headers.get('Accept-Encoding'),
+                must_decode=bool(build_body_stages(entry, []))
+            ) is None
+            byte_range = parse_byte_range(request_headers['Range'], entry.size) if passthrough else None
+            if byte_range is not None:
+                response_cache.count('hits')
+                response_cache.count('range_hits')
+                return CachedResponse(entry, byte_range=byte_range), 'HIT'
+    return fetch_upstream('GET', url, headers), 'BYPASS'
+
+def fetch_and_store(url, headers, entry, timeout=None):
+    """
+    Запрос к origin при промахе кэша или для ревалидации устаревшей записи.
+    Если origin недоступен или ответил 5xx, а запись еще в окне stale-if-error, отдается она.
+    """
+    stale = entry
+    request_headers = CaseInsensitiveDict(headers)
+    upstream_headers = dict(headers)
+    has_client_conditionals = 'If-None-Match' in request_headers or 'If-Modified-Since' in request_headers
+    if entry is not None and not has_client_conditionals:
+        upstream_headers.update(entry.conditional_headers())
+        response_cache.count('revalidations')
+    else:
+        response_cache.count('misses')
+        entry = None
+
+    request_time = time.time()
+    try:
+        response = fetch_upstream('GET', url, upstream_headers, timeout=timeout)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+        if stale is not None and stale.can_serve_stale('stale-if-error', CACHE_STALE_IF_ERROR):
+            response_cache.count('stale_if_error')
+            return CachedResponse(stale, REVALIDATION_FAILED_WARNING), 'STALE'
+        raise
+
+    if response.status_code >= 500 and stale is not None:
+        if stale.can_serve_stale('stale-if-error', CACHE_STALE_IF_ERROR):
+            response.close()
+            response_cache.count('stale_if_error')
+            return CachedResponse(stale, REVALIDATION_FAILED_WARNING), 'STALE'
+
+    if entry is not None and response.status_code == 304:
+        response.close()
+        response_cache.count('revalidated')
+        entry = response_cache.refresh(entry, response, request_time)
+        return CachedResponse(entry), 'REVALIDATED'
+
+    if is_response_storable(response, request_headers):
+        attach_cache_writer(url, request_headers, response, request_time)
+    elif NEGATIVE_CACHE_ENABLED:
+        negative_ttl = negative_url_ttl(response, request_headers)
+        if negative_ttl:
+            attach_negative_writer(url, response, request_time, negative_ttl)
+    return response, 'MISS'
+
+# ======================
+# Объединение одинаковых одновременных запросов (single-flight)
+# ======================
+
+inflight = {}
+inflight_lock = threading.Lock()
+
+COALESCE_EVENTS = ('requests', 'flights', 'coalesced', 'not_shared', 'detached')
+
+def count_coalesce_event(name):
+    metrics.inc('dh_proxy_coalesce_events_total', (('event', name),))
+
+def get_coalesce_stats():
+    values = metrics.counter_values('dh_proxy_coalesce_events_total')
+    stats = {name: values.get((('event', name),), 0) for name in COALESCE_EVENTS}
+    stats['collapse_ratio'] = round(stats['coalesced'] / stats['requests'], 4) if stats['requests'] else 0.0
+    stats['in_flight'] = len(inflight)
+    return stats
+
+def coalesce_key(method, url, headers):
+    """
+    Ключ запроса: метод, url и все заголовки, кроме COALESCE_IGNORED_HEADERS. Учетные данные
+    бывают не только в Authorization и Cookie (X-Api-Key и т.п.) - такие запросы не объединяются
+    """
+    parts = [method, url]
+    for name, value in sorted((key.lower(), value) for key, value in headers.items()):
+        if name not in COALESCE_IGNORED_HEADERS:
+            parts.append(f'{name}:{value}')
+    return '\n'.join(parts)
+
+class FlightLagError(requests.exceptions.ConnectionError):
+    """Потребитель отстал от общего тела больше чем на COALESCE_MAX_BUFFER и был отключен"""
+
+class Flight:
+    """
+    Один запрос к origin, результат которого получают все одинаковые одновременные запросы.
+    Тело читается из origin тем потребителем, которому следующий чанк нужен первым,
+    остальные берут его из общего буфера. Буфер не растет больше COALESCE_MAX_BUFFER:
+    быстрый потребитель ждет отставшего, а слишком долго стоящего отключает.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.ready = threading.Event()
+        self.response = None
+        self.status = None
+        self.error = None
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.base = 0
+        self.buffered = 0
+        self.reading = False
+        self.done = False
+        self.body_error = None
+        self.source = None
+        self.joinable = True
+        self.consumers = {}
+        self.detached = set()
+        self.next_consumer = 0
+
+    def join(self):
+        """Регистрирует потребителя. Вызывается под inflight_lock"""
+        with self.cond:
+            consumer = self.next_consumer
+            self.next_consumer += 1
+            self.consumers[consumer] = 0
+            return consumer
+
+    def close_to_joiners(self):
+        with inflight_lock:
+            if inflight.get(self.key) is self:
+                del inflight[self.key]
+            with self.cond:
+                self.joinable = False
+
+    def start(self, response, status, request_headers):
+        self.response = response
+        self.status = status
+        self.request_headers = CaseInsensitiveDict(request_headers)
+        # Ответ, который нельзя положить в разделяемый кэш, ведомым не раздаем
+        self.shareable = is_response_shareable(response, self.request_headers)
+        if not self.shareable:
+            self.close_to_joiners()
+        self.source = iter(response.raw.stream(STREAM_CHUNK_SIZE, decode_content=False))
+        self.ready.set()
+
+    def is_shared_with(self, request_headers):
+        """Подходит ли ответ ведущего запросу ведомого: разделяемый и с теми же заголовками из Vary"""
+        if not self.shareable:
+            return False
+        request_headers = CaseInsensitiveDict(request_headers)
+        return all(
+            request_headers.get(name) == self.request_headers.get(name)
+            for name in parse_vary(self.response.headers)
+        )
+
+    def fail(self, error):
+        self.error = error
+        self.close_to_joiners()
+        self.ready.set()
+
+    def _trim(self):
+        """Отбрасывает чанки, которые уже прочитали все потребители. Вызывается под self.cond"""
+        if self.joinable or not self.consumers:
+            return
+        consumed = min(self.consumers.values()) - self.base
+        if consumed > 0:
+            self.buffered -= sum(len(chunk) for chunk in self.chunks[:consumed])
+            del self.chunks[:consumed]
+            self.base += consumed
+            # Место в буфере освободилось - будим ждущего его читателя
+            self.cond.notify_all()
+
+    def _detach_laggards(self, consumer):
+        """Отключает самых отставших потребителей, кроме consumer. Вызывается под self.cond"""
+        slowest = min(self.consumers.values())
+        for other, position in list(self.consumers.items()):
+            if other != consumer and position == slowest:
+                del self.consumers[other]
+                self.detached.add(other)
+                count_coalesce_event('detached')
+        self._trim()
+        self.cond.notify_all()
+
+    def read(self, consumer, position):
+        """Возвращает чанк номер position или None, если тело закончилось"""
+        while True:
+            with self.cond:
+                lag_deadline = None
+                while True:
+                    if consumer in self.detached:
+                        raise FlightLagError('Consumer fell too far behind a shared upstream response')
+                    self.consumers[consumer] = position
+                    self._trim()
+                    index = position - self.base
+                    if index < len(self.chunks):
+                        return self.chunks[index]
+                    if self.body_error is not None:
+                        raise self.body_error
+                    if self.done:
+                        return None
+                    if self.reading:
+                        self.cond.wait()
+                        continue
+                    if self.joinable or self.buffered < COALESCE_MAX_BUFFER:
+                        self.reading = True
+                        break
+                    # Буфер полон из-за отставших: ждем, пока они дочитают, но не дольше COALESCE_LAG_TIMEOUT
+                    if lag_deadline is None:
+                        lag_deadline = time.monotonic() + COALESCE_LAG_TIMEOUT
+                    remaining = lag_deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._detach_laggards(consumer)
+                        lag_deadline = None
+                        continue
+                    self.cond.wait(remaining)
+
+            chunk = None
+            error = None
+            try:
+                chunk = next(self.source, None)
+            except Exception as e:
+                error = e
+
+            with self.cond:
+                self.reading = False
+                if error is not None:
+                    self.body_error = error
+                    self.done = True
+                elif chunk is None:
+                    self.done = True
+                else:
+                    self.chunks.append(chunk)
+                    self.buffered += len(chunk)
+                finished = self.done or self.buffered > COALESCE_MAX_BUFFER
+                self.cond.notify_all()
+
+            # Большие и завершенные тела больше не раздаем новым запросам
+            if finished and self.joinable:
+                self.close_to_joiners()
+
+    def leave(self, consumer):
+        with inflight_lock:
+            with self.cond:
+                self.detached.discard(consumer)
+                if consumer not in self.consumers:
+                    return
+                del self.consumers[consumer]
+                self._trim()
+                self.cond.notify_all()
+                last = not self.consumers
+                if last:
+                    self.joinable = False
+                    if inflight.get(self.key) is self:
+                        del inflight[self.key]
+        if last and self.response is not None:
+            # Последний клиент ушел - освобождаем соединение с origin
+            self.response.close()
+
+class SharedResponse:
+    """Ответ одного потребителя из общего Flight с интерфейсом, который нужен make_proxy_response"""
+
+    def __init__(self, flight, consumer):
+        self.status_code = flight.response.status_code
+        self.url = flight.response.url
+        self.headers = CaseInsensitiveDict(flight.response.headers)
+        self.raw = self
+        self._flight = flight
+        self._consumer = consumer
+
+    def stream(self, amt=None, decode_content=None):
+        position = 0
+        while True:
+            chunk = self._flight.read(self._consumer, position)
+            if chunk is None:
+                return
+            position += 1
+            yield chunk
+
+    def close(self):
+        self._flight.leave(self._consumer)
+
+def coalesced_fetch(method, url, headers, fetch):
+    """
+    Выполняет fetch() один раз на все одинаковые одновременные запросы.
+    fetch возвращает (ответ, статус кэша).
+    """
+    if not COALESCE_ENABLED:
+        return fetch()
+
+    key = coalesce_key(method, url, headers)
+    with inflight_lock:
+        flight = inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight(key)
+            inflight[key] = flight
+        consumer = flight.join()
+
+    count_coalesce_event('requests')
+    if leader:
+        count_coalesce_event('flights')
+        try:
+            response, status = fetch()
+        except Exception as e:
+            flight.fail(e)
+            raise
+        flight.start(response, status, headers)
+    else:
+        flight.ready.wait()
+        if flight.error is not None:
+            raise flight.error
+        if not flight.is_shared_with(headers):
+            # Приватный ответ или ответ под другие заголовки - идем к origin сами
+            flight.leave(consumer)
+            count_coalesce_event('not_shared')
+            return fetch()
+        count_coalesce_event('coalesced')
+
+    return SharedResponse(flight, consumer), flight.status
+
+# ======================
+# Пакетные запросы
+# ======================
+
+BATCH_METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH')
+
+# Общий для всех пакетов пул: один большой пакет не может занять больше BATCH_CONCURRENCY потоков
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+
+metrics.describe('dh_proxy_batch_items_total', 'counter', 'Batch items by outcome')
+
+class BatchItemError(Exception):
+    """Ошибка одного элемента пакета: уходит клиенту строкой с полем error"""
+
+def parse_batch_item(index, item):
+    """Проверяет элемент пакета {method, url, headers, body} и готовит его к запросу"""
+    if not isinstance(item, dict) or not isinstance(item.get('url'), str):
+        raise BatchItemError('url is required')
+    method = str(item.get('method', 'GET')).upper()
+    if method not in BATCH_METHODS:
+        raise BatchItemError(f'method {method} is not allowed')
+    headers = item.get('headers') or {}
+    if not isinstance(headers, dict):
+        raise BatchItemError('headers must be an object')
+
+    body = item.get('body')
+    if body is not None:
+        if item.get('body_encoding') == 'base64':
+            try:
+                body = base64.b64decode(body, validate=True)
+            except (binascii.Error, TypeError):
+                raise BatchItemError('body is not valid base64')
+        else:
+            body = str(body).encode('utf-8')
+
+    try:
+        timeout = min(float(item.get('timeout', BATCH_ITEM_TIMEOUT)), BATCH_ITEM_TIMEOUT)
+    except (TypeError, ValueError):
+        raise BatchItemError('timeout must be a number')
+
+    return {
+        'id': item.get('id', index),
+        'method': method,
+        'url': normalize_target_url(item['url']),
+        'headers': build_upstream_headers({str(k): str(v) for k, v in headers.items()}),
+        'body': body,
+        'timeout': timeout,
+    }
+
+def run_batch_item(item, deadline, cancelled):
+    """Выполняет один элемент пакета в потоке пула, заняв место в bulkhead-пуле его origin"""
+    limiter = bulkhead_for(item['url'])
+    if limiter is None:
+        return execute_batch_item(item, deadline, cancelled)
+    if not limiter.acquire():
+        raise BulkheadFull(limiter.name)
+    try:
+        return execute_batch_item(item, deadline, cancelled)
+    finally:
+        limiter.release()
+
+def execute_batch_item(item, deadline, cancelled):
+    """Запрос элемента пакета к origin и строка результата"""
+    start = time.monotonic()
+    timeout = max(0.001, deadline - start)
+    method, url = item['method'], item['url']
+
+    if method == 'GET':
+        response, cache_status = fetch_cached(url, item['headers'], timeout=timeout)
+    else:
+        response = fetch_upstream(method, url, item['headers'], data=item['body'], timeout=timeout)
+        cache_status = 'BYPASS'
+        if method != 'HEAD' and response.status_code < 400:
+            response_cache.invalidate(url)
+            negative_cache.forget_url(url)
+
+    chunks = []
+    size = 0
+    try:
+        for chunk in iter_response_body(response, 'identity'):
+            if cancelled.is_set() or time.monotonic() > deadline:
+                raise requests.exceptions.Timeout('Request timeout')
+            size += len(chunk)
+            if size > BATCH_MAX_ITEM_BYTES:
+                raise BatchItemError('response too large')
+            chunks.append(chunk)
+    finally:
+        response.close()
+
+    body = b''.join(chunks)
+    result = {
+        'id': item['id'],
+        'url': url,
+        'status': response.status_code,
+        'headers': {
+            key: value for key, value in response.headers.items()
+            if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() not in ('content-encoding', 'content-length')
+        },
+        'cache': cache_status,
+        'elapsed': round(time.monotonic() - start, 4),
+    }
+    try:
+        result['body'] = body.decode('utf-8')
+        result['body_encoding'] = 'utf-8'
+    except UnicodeDecodeError:
+        result['body'] = base64.b64encode(body).decode('ascii')
+        result['body_encoding'] = 'base64'
+    return result
+
+def batch_error(item_id, url, error):
+    """Строка результата для элемента, который не удалось выполнить"""
+    if isinstance(error, requests.exceptions.Timeout):
+        status, message = 504, 'Request timeout'
+    elif isinstance(error, requests.exceptions.ConnectionError):
+        status, message = 502, 'Connection failed'
+    elif isinstance(error, BulkheadFull):
+        status, message = 503, str(error)
+    elif isinstance(error, BatchItemError):
+        status, message = 400, str(error)
+    else:
+        status, message = 500, str(error)
+    return {'id': item_id, 'url': url, 'status': status, 'error': message}
+
+def batch_line(result):
+    metrics.inc('dh_proxy_batch_items_total', (('outcome', 'error' if 'error' in result else 'ok'),))
+    return json.dumps(result, ensure_ascii=False) + '\n'
+
+def stream_batch(items, deadline):
+    """
+    Выполняет элементы пакета параллельно и отдает NDJSON-строки в порядке завершения.
+    Элемент, не успевший за свой таймаут или до общего дедлайна, отдается с ошибкой.
+    """
+    cancelled = threading.Event()
+    pending = deque(items)
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < BATCH_CONCURRENCY:
+                item = pending.popleft()
+                item_deadline = min(deadline, time.monotonic() + item['timeout'])
+                future = batch_executor.submit(run_batch_item, item, item_deadline, cancelled)
+                running[future] = (item, item_deadline)
+
+            next_deadline = min(item_deadline for _, item_deadline in running.values())
+            done, _ = wait(running, timeout=max(0.0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            for future in done:
+                item, _ = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = batch_error(item['id'], item['url'], e)
+                yield batch_line(result)
+
+            # Просроченные элементы отдаем сразу; поток пула сам бросит чтение по своему дедлайну
+            now = time.monotonic()
+            for future, (item, item_deadline) in list(running.items()):
+                if now >= item_deadline:
+                    del running[future]
+                    future.cancel()
+                    yield batch_line(batch_error(item['id'], item['url'], requests.exceptions.Timeout()))
+            if now >= deadline:
+                while pending:
+                    item = pending.popleft()
+                    yield batch_line(batch_error(item['id'], item['url'], requests.exceptions.Timeout()))
+    finally:
+        # Клиент ушел или пакет завершен - недочитанные ответы бросаем
+        cancelled.set()
+        for future in running:
+            future.cancel()
+
+def is_trusted_admin(remote_addr, headers):
+    """
+    Доступ к админке и метрикам: они показывают хосты, которые открывают пользователи.
+    С PROXY_ADMIN_TOKEN нужен токен (X-Admin-Token или Authorization: Bearer), без него - только loopback
+    """
+    if ADMIN_TOKEN:
+        token = headers.get('X-Admin-Token')
+        if token is None:
+            scheme, _, token = (headers.get('Authorization') or '').partition(' ')
+            if scheme.lower() != 'bearer':
+                return False
+        return hmac.compare_digest(token.strip().encode(), ADMIN_TOKEN.encode())
+    try:
+        address = ipaddress.ip_address((remote_addr or '').split('%')[0])
+    except ValueError:
+        return False
+    return address.is_loopback or bool(getattr(address, 'ipv4_mapped', None) and address.ipv4_mapped.is_loopback)
+
+def admin_only(view):
+    """Закрывает служебный маршрут для всех, кроме администратора (см. is_trusted_admin)"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_trusted_admin(request.remote_addr, request.headers):
+            return Response(json.dumps({'error': 'forbidden'}), 403, mimetype='application/json')
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/')
+def index():
+    return render_template_string(HTML_TEMPLATE)
+
+@app.route('/url=<path:target_url>', provide_automatic_options=False)
+@instrumented('proxy_get')
+@admitted
+@bulkheaded
+def proxy_get(target_url):
+    try:
+        url = normalize_target_url(target_url)
+        headers = build_upstream_headers()
+
+        if request.method == 'HEAD':
+            response, cache_status = fetch_head(url, headers)
+            proxy_response = make_head_response(response)
+            proxy_response.headers['X-Cache'] = cache_status
+            return proxy_response
+
+        if 'Range' in request.headers:
+            response, cache_status = fetch_range(url, headers)
+        else:
+            response, cache_status = fetch_cached(url, headers)
+
+        proxy_response = make_proxy_response(response)
+        proxy_response.headers['X-Cache'] = cache_status
+        return proxy_response
+
+    except RangeNotSatisfiable as e:
+        return Response(status=416, headers=CORS_HEADERS + (('Content-Range', f'bytes */{e.size}'),))
+    except requests.exceptions.Timeout:
+        return Response('Proxy Error: Request timeout', 504)
+    except requests.exceptions.ConnectionError:
+        return Response('Proxy Error: Connection failed', 502)
+    except Exception as e:
+        return Response(f'Proxy Error: {str(e)}', 500)
+
+@app.route('/url=<path:target_url>', methods=['POST', 'PUT', 'DELETE', 'PATCH'], provide_automatic_options=False)
+@instrumented('proxy_with_body')
+@admitted
+@bulkheaded
+def proxy_with_body(target_url):
+    try:
+        url = normalize_target_url(target_url)
+        headers = build_upstream_headers()
+
+        body = open_request_body()
+        if body is None:
+            response = fetch_upstream(request.method, url, headers)
+        else:
+            response = fetch_upstream(request.method, url, headers, data=body, allow_redirects=False)
+            response = follow_redirect_after_body(response, request.method, headers)
+
+        # Небезопасный метод делает сохраненные ответы для этого url устаревшими
+        if response.status_code < 400:
+            response_cache.invalidate(url)
+            negative_cache.forget_url(url)
+
+        return make_proxy_response(response)
+
+    except RequestBodyTooLarge:
+        return Response('Proxy Error: Request body too large', 413)
+    except requests.exceptions.Timeout:
+        return Response('Proxy Error: Request timeout', 504)
+    except requests.exceptions.ConnectionError:
+        return Response('Proxy Error: Connection failed', 502)
+    except Exception as e:
+        return Response(f'Proxy Error: {str(e)}', 500)
+
+@app.route('/url=<path:target_url>', methods=['OPTIONS'])
+@instrumented('preflight')
+def proxy_preflight(target_url):
+    # Preflight браузера отвечаем сами: origin его не видит, браузер кэширует ответ на Max-Age
+    return Response(status=204, headers=PREFLIGHT_HEADERS)
+
+@app.route('/batch', methods=['POST'])
+@instrumented('batch')
+@admitted
+def proxy_batch():
+    if request.content_length and request.content_length > BATCH_MAX_REQUEST_BYTES:
+        return Response(json.dumps({'error': 'batch too large'}), 413, mimetype='application/json')
+
+    payload = request.get_json(silent=True)
+    deadline = BATCH_DEADLINE
+    if isinstance(payload, dict):
+        try:
+            deadline = min(float(payload.get('deadline', BATCH_DEADLINE)), BATCH_DEADLINE)
+        except (TypeError, ValueError):
+            return Response(json.dumps({'error': 'deadline must be a number'}), 400, mimetype='application/json')
+        payload = payload.get('requests')
+    if not isinstance(payload, list) or not payload:
+        return Response(json.dumps({'error': 'expected a JSON list of requests'}), 400, mimetype='application/json')
+    if len(payload) > BATCH_MAX_ITEMS:
+        return Response(json.dumps({'error': f'at most {BATCH_MAX_ITEMS} requests per batch'}), 413, mimetype='application/json')
+
+    items = []
+    invalid = []
+    for index, raw_item in enumerate(payload):
+        try:
+            items.append(parse_batch_item(index, raw_item))
+        except BatchItemError as e:
+            item_id = raw_item.get('id', index) if isinstance(raw_item, dict) else index
+            url = raw_item.get('url') if isinstance(raw_item, dict) else None
+            invalid.append(batch_error(item_id, url, e))
+
+    def generate():
+        for result in invalid:
+            yield batch_line(result)
+        yield from stream_batch(items, time.monotonic() + deadline)
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/metrics')
+@admin_only
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/pool')
+@admin_only
+def admin_pool():
+    return Response(json.dumps(get_pool_stats()), mimetype='application/json')
+
+@app.route('/admin/cache')
+@admin_only
+def admin_cache():
+    return Response(json.dumps(response_cache.get_stats()), mimetype='application/json')
+
+
+@app.route('/admin/coalesce')
+@admin_only
+def admin_coalesce():
+    return Response(json.dumps(get_coalesce_stats()), mimetype='application/json')
+
+@app.route('/admin/dns')
+@admin_only
+def admin_dns():
+    return Response(json.dumps(get_dns_stats()), mimetype='application/json')
+
+@app.route('/admin/negative')
+@admin_only
+def admin_negative():
+    return Response(json.dumps(get_negative_stats()), mimetype='application/json')
+
+@app.route('/admin/timeouts')
+@admin_only
+def admin_timeouts():
+    return Response(json.dumps(get_timeout_states()), mimetype='application/json')
+
+@app.route('/admin/admission')
+@admin_only
+def admin_admission():
+    return Response(json.dumps({limiter.name: limiter.snapshot() for limiter in limiters}), mimetype='application/json')
+
+@app.route('/admin/bulkheads')
+@admin_only
+def admin_bulkheads():
+    states = {limiter.name: dict(limiter.snapshot(), hosts=list(hosts)) for limiter, hosts in bulkheads}
+    return Response(json.dumps(states), mimetype='application/json')
+
+@app.route('/admin/breakers')
+@admin_only
+def admin_breakers():
+    return Response(json.dumps(get_breaker_states()), mimetype='application/json')
+
+@app.route('/admin/cache/purge', methods=['POST'])
+@admin_only
+def admin_cache_purge():
+    prefix = request.args.get('prefix', '')
+    if not prefix:
+        return Response(json.dumps({'error': 'prefix is required'}), 400, mimetype='application/json')
+    prefix = normalize_target_url(prefix)
+    removed = response_cache.purge(prefix)
+    return Response(json.dumps({'prefix': prefix, 'removed': removed}), mimetype='application/json')
 
 if __name__ == '__main__':
-    import os
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port, threaded=True)
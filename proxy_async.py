@@ -0,0 +1,205 @@
+"""
+Асинхронный движок DH PROXY на asyncio + aiohttp.
+
+Те же маршруты /url=... и та же обработка заголовков и сжатия, что и в proxy.py,
+но вместо потока на каждый запрос - одна событийная петля. Медленные origin
+с таймаутом 30 секунд больше не съедают потоки: один процесс держит десятки
+тысяч одновременных запросов.
+
+Запуск: python proxy_async.py (порт берется из PORT, по умолчанию 8080)
+"""
+import asyncio
+import os
+import socket
+from urllib.parse import urljoin
+
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector, ClientConnectionError, DummyCookieJar
+from aiohttp.abc import AbstractResolver
+from multidict import CIMultiDict
+
+import proxy
+
+# Лимиты соединений к origin: 0 - без ограничения
+ASYNC_UPSTREAM_LIMIT = int(os.environ.get('ASYNC_UPSTREAM_LIMIT', 0))
+ASYNC_UPSTREAM_LIMIT_PER_HOST = int(os.environ.get('ASYNC_UPSTREAM_LIMIT_PER_HOST', 0))
+# Как у requests.Session в proxy.py
+MAX_REDIRECTS = 30
+
+BODY_METHODS = ('POST', 'PUT', 'DELETE', 'PATCH')
+BODY_HEADERS = ('content-type', 'content-length', 'transfer-encoding')
+
+UPSTREAM_SESSION = web.AppKey('upstream', ClientSession)
+
+class CachedResolver(AbstractResolver):
+    """Резолвер aiohttp поверх общего кэша DNS из proxy.py; промах резолвится в пуле потоков"""
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        loop = asyncio.get_running_loop()
+        addresses = await loop.run_in_executor(None, proxy.dns_cache.resolve, host)
+        return [
+            {
+                'hostname': host,
+                'host': address,
+                'port': port,
+                'family': address_family,
+                'proto': 0,
+                'flags': socket.AI_NUMERICHOST | socket.AI_NUMERICSERV,
+            }
+            for address_family, address in addresses
+            if family in (socket.AF_UNSPEC, address_family)
+        ]
+
+    async def close(self):
+        pass
+
+async def create_upstream_session(app):
+    """Общая клиентская сессия с keep-alive пулом на каждый origin"""
+    connector = TCPConnector(
+        limit=ASYNC_UPSTREAM_LIMIT,
+        limit_per_host=ASYNC_UPSTREAM_LIMIT_PER_HOST,
+        keepalive_timeout=proxy.UPSTREAM_IDLE_TIMEOUT,
+        # Свой кэш DNS aiohttp не учитывает TTL записей - используем общий
+        resolver=CachedResolver() if proxy.DNS_CACHE_ENABLED else None,
+        use_dns_cache=not proxy.DNS_CACHE_ENABLED,
+        ssl=proxy.UPSTREAM_SSL_CONTEXT
+    )
+    app[UPSTREAM_SESSION] = ClientSession(
+        connector=connector,
+        timeout=ClientTimeout(total=None, sock_connect=proxy.UPSTREAM_TIMEOUT, sock_read=proxy.UPSTREAM_TIMEOUT),
+        auto_decompress=False,
+        # Сессия общая для всех клиентов - cookies origin-серверов в ней не храним
+        cookie_jar=DummyCookieJar()
+    )
+    yield
+    await app[UPSTREAM_SESSION].close()
+
+async def index(request):
+    return web.Response(text=proxy.HTML_TEMPLATE, content_type='text/html')
+
+async def limited_body(content, limit):
+    """Тело запроса клиента к origin по частям с проверкой лимита на лету"""
+    total = 0
+    async for chunk in content.iter_chunked(proxy.REQUEST_BODY_CHUNK_SIZE):
+        total += len(chunk)
+        if limit and total > limit:
+            raise proxy.RequestBodyTooLarge()
+        yield chunk
+
+def redirect_method(method, status, has_body):
+    """
+    Метод следующего запроса после редиректа или None, если редирект отдается клиенту.
+    Без тела - как requests, с потоковым телом - как proxy.follow_redirect_after_body
+    """
+    if has_body:
+        if status == 303 or (status in (301, 302) and method == 'POST'):
+            return 'GET'
+        return None
+    if status in (302, 303) and method != 'HEAD':
+        return 'GET'
+    if status == 301 and method == 'POST':
+        return 'GET'
+    return method
+
+async def open_upstream(session, method, url, headers, data):
+    """
+    Запрос к origin. Редиректы aiohttp не проходит сам: потоковое тело второй раз не отправить,
+    а учетные данные не должны уходить на другой хост - переходы делаются здесь, как в proxy.py
+    """
+    upstream = await session.request(method, url, headers=headers, data=data, allow_redirects=False)
+    for _ in range(MAX_REDIRECTS):
+        location = upstream.headers.get('Location')
+        if upstream.status not in proxy.REDIRECT_STATUSES or not location:
+            break
+        next_method = redirect_method(method, upstream.status, data is not None)
+        if next_method is None:
+            break
+        current_url = str(upstream.url)
+        target = urljoin(current_url, location)
+        headers = proxy.redirected_headers(headers, proxy.upstream_session.should_strip_auth(current_url, target))
+        if next_method != method:
+            headers = {k: v for k, v in headers.items() if k.lower() not in BODY_HEADERS}
+        upstream.release()
+        method, url, data = next_method, target, None
+        upstream = await session.request(method, url, headers=headers, allow_redirects=False)
+    return upstream
+
+async def proxy_request(request):
+    url = proxy.normalize_target_url(request.match_info['target_url'])
+    headers = proxy.build_upstream_headers(request.headers)
+
+    data = None
+    if request.method in BODY_METHODS and request.body_exists:
+        limit = proxy.MAX_REQUEST_BODY
+        if limit and request.content_length and request.content_length > limit:
+            return web.Response(text='Proxy Error: Request body too large', status=413)
+        # Тело запроса идет к origin потоком, без буферизации в памяти
+        data = limited_body(request.content, limit)
+        if request.content_length is not None:
+            headers['Content-Length'] = str(request.content_length)
+
+    try:
+        upstream = await open_upstream(request.app[UPSTREAM_SESSION], request.method, url, headers, data)
+    except proxy.RequestBodyTooLarge:
+        return web.Response(text='Proxy Error: Request body too large', status=413)
+    except asyncio.TimeoutError:
+        return web.Response(text='Proxy Error: Request timeout', status=504)
+    except ClientConnectionError as e:
+        # aiohttp оборачивает ошибку из генератора тела запроса
+        if isinstance(e.__cause__, proxy.RequestBodyTooLarge):
+            return web.Response(text='Proxy Error: Request body too large', status=413)
+        return web.Response(text='Proxy Error: Connection failed', status=502)
+    except Exception as e:
+        return web.Response(text=f'Proxy Error: {str(e)}', status=500)
+
+    completed = False
+    try:
+        response_headers, target_encoding, stages = proxy.prepare_response_body(
+            upstream, upstream.status, request.headers.get('Accept-Encoding')
+        )
+        # Непройденный редирект уходит клиенту с Location в форме /url=
+        if upstream.status in proxy.REDIRECT_STATUSES and 'Location' in upstream.headers:
+            proxy.set_header(response_headers, 'Location', proxy.proxied_location(str(upstream.url), upstream.headers['Location']))
+        response = web.StreamResponse(status=upstream.status, headers=CIMultiDict(response_headers))
+        await response.prepare(request)
+
+        transcoder = None
+        if target_encoding is not None:
+            transcoder = proxy.BodyTranscoder(
+                proxy.get_content_encoding(upstream.headers), target_encoding, stages
+            )
+
+        async for chunk in upstream.content.iter_chunked(proxy.STREAM_CHUNK_SIZE):
+            if transcoder is None:
+                await response.write(chunk)
+                continue
+            for data in transcoder.feed(chunk):
+                await response.write(data)
+        if transcoder is not None:
+            for data in transcoder.finish():
+                await response.write(data)
+
+        await response.write_eof()
+        completed = True
+        return response
+    finally:
+        # Недочитанное соединение (клиент ушел, origin оборвал) в пул не возвращаем
+        if completed:
+            upstream.release()
+        else:
+            upstream.close()
+
+async def preflight(request):
+    return web.Response(status=204, headers=proxy.PREFLIGHT_HEADERS)
+
+def create_app():
+    app = web.Application()
+    app.cleanup_ctx.append(create_upstream_session)
+    app.router.add_get('/', index)
+    for method in ('GET', 'HEAD') + BODY_METHODS:
+        app.router.add_route(method, '/url={target_url:.+}', proxy_request)
+    app.router.add_route('OPTIONS', '/url={target_url:.+}', preflight)
+    return app
+
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 8080))
+    web.run_app(create_app(), host='0.0.0.0', port=port, access_log=None)
@@ -0,0 +1,487 @@
+"""
+CONNECT-туннель DH PROXY: отдельный слушатель для клиентов, которым нужен HTTPS
+до origin без расшифровки на прокси или вообще не-HTTP протокол.
+
+После CONNECT host:port прокси только перекладывает байты между сокетами клиента
+и origin в одной событийной петле на selectors. На Linux байты идут через
+os.splice (сокет -> pipe -> сокет) и не копируются в память Python.
+
+Запуск: python proxy_tunnel.py (порт берется из PROXY_TUNNEL_PORT, по умолчанию 8443)
+Туннели и счетчики байт: GET /admin/tunnels, метрики Prometheus: GET /metrics
+"""
+import json
+import os
+import re
+import selectors
+import socket
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import proxy
+
+TUNNEL_PORT = int(os.environ.get('PROXY_TUNNEL_PORT', 8443))
+# Туннель без байт в обе стороны дольше этого закрывается
+TUNNEL_IDLE_TIMEOUT = float(os.environ.get('PROXY_TUNNEL_IDLE_TIMEOUT', 300))
+TUNNEL_CONNECT_TIMEOUT = float(os.environ.get('PROXY_TUNNEL_CONNECT_TIMEOUT', 10))
+# Сколько клиент может слать заголовки CONNECT
+TUNNEL_HANDSHAKE_TIMEOUT = float(os.environ.get('PROXY_TUNNEL_HANDSHAKE_TIMEOUT', 10))
+# Порты назначения через запятую, * - любые
+TUNNEL_ALLOWED_PORTS = os.environ.get('PROXY_TUNNEL_PORTS', '443')
+TUNNEL_MAX_TUNNELS = int(os.environ.get('PROXY_TUNNEL_MAX', 10000))
+# Резолв и connect к origin блокирующие - они идут в пуле потоков, а не в петле
+TUNNEL_CONNECT_WORKERS = int(os.environ.get('PROXY_TUNNEL_CONNECT_WORKERS', 64))
+TUNNEL_SPLICE = hasattr(os, 'splice') and os.environ.get('PROXY_TUNNEL_SPLICE', '1') == '1'
+TUNNEL_CHUNK_SIZE = 64 * 1024
+MAX_HEADER_BYTES = 16 * 1024
+RECENT_TUNNELS = 100
+# Метка имени хоста после IDNA; подчеркивание встречается в реальных именах, поэтому допускается
+HOST_LABEL = re.compile(r'(?!-)[A-Za-z0-9_-]{1,63}(?<!-)')
+
+ESTABLISHED = b'HTTP/1.1 200 Connection Established\r\nX-Proxy-Server: DH-PROXY/2.0\r\n\r\n'
+
+proxy.metrics.describe('dh_proxy_tunnel_events_total', 'counter', 'CONNECT tunnels: accepted, established, failed to connect, rejected, closed on idle timeout or error')
+proxy.metrics.describe('dh_proxy_tunnel_bytes_total', 'counter', 'Bytes relayed through CONNECT tunnels by direction')
+proxy.metrics.describe('dh_proxy_tunnels_active', 'gauge', 'Open CONNECT tunnels')
+
+def count_tunnel_event(name):
+    proxy.metrics.inc('dh_proxy_tunnel_events_total', (('event', name),))
+
+def parse_allowed_ports(value):
+    if value.strip() == '*':
+        return None
+    return {int(port) for port in value.split(',') if port.strip()}
+
+def parse_authority(value):
+    """
+    host:port из строки CONNECT, IPv6 - в квадратных скобках. Имя приводится к IDNA;
+    None - адрес не разобрать или имя не может быть именем хоста
+    """
+    host, sep, port = value.rpartition(':')
+    if not sep or not host or not port.isdigit() or not 0 < int(port) < 65536:
+        return None
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+        return (host, int(port)) if proxy.is_ip_address(host) else None
+    if proxy.is_ip_address(host):
+        return host, int(port)
+    try:
+        host = host.rstrip('.').encode('idna').decode('ascii')
+    except UnicodeError:
+        return None
+    if len(host) > 253 or not all(HOST_LABEL.fullmatch(label) for label in host.split('.')):
+        return None
+    return host, int(port)
+
+def parse_headers(head):
+    """Заголовки запроса после строки запроса, без учета регистра имен"""
+    headers = proxy.CaseInsensitiveDict()
+    for line in head.split('\r\n')[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip()] = value.strip()
+    return headers
+
+def peer_address(sock):
+    try:
+        return sock.getpeername()[0]
+    except OSError:
+        return None
+
+def open_upstream(host, port):
+    """Соединение с origin: адреса из общего кэша DNS пробуются по очереди"""
+    if proxy.DNS_CACHE_ENABLED and not proxy.is_ip_address(host):
+        addresses = proxy.dns_cache.resolve(host)
+    else:
+        addresses = [(info[0], info[4][0]) for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+    error = None
+    for family, address in addresses:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(TUNNEL_CONNECT_TIMEOUT)
+        try:
+            sock.connect((address, port))
+        except OSError as e:
+            sock.close()
+            error = e
+            continue
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+    raise error or OSError(f'no addresses for {host}')
+
+class Relay:
+    """
+    Одно направление туннеля: src -> dst. Прочитанное лежит либо в pipe (splice),
+    либо в buffer; пока оно не записано в dst, из src больше не читаем.
+    """
+
+    def __init__(self, src, dst, initial=b''):
+        self.src = src
+        self.dst = dst
+        self.buffer = memoryview(initial)
+        self.pending = 0
+        self.eof = False
+        self.done = False
+        self.bytes = 0
+        self.pipe = os.pipe() if TUNNEL_SPLICE else None
+
+    def wants_read(self):
+        return not self.eof and not self.pending and not self.buffer
+
+    def wants_write(self):
+        return not self.done and bool(self.pending or self.buffer)
+
+    def read(self):
+        """Читает порцию из src; BlockingIOError - данных пока нет"""
+        if self.pipe is not None:
+            n = os.splice(self.src.fileno(), self.pipe[1], TUNNEL_CHUNK_SIZE,
+                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            self.pending = n
+        else:
+            data = self.src.recv(TUNNEL_CHUNK_SIZE)
+            n = len(data)
+            self.buffer = memoryview(data)
+        self.bytes += n
+        if n == 0:
+            self.eof = True
+        return n
+
+    def write(self):
+        """Дописывает прочитанное в dst; BlockingIOError - dst пока не готов принять"""
+        while self.buffer:
+            sent = self.dst.send(self.buffer)
+            self.buffer = self.buffer[sent:]
+        while self.pending:
+            self.pending -= os.splice(self.pipe[0], self.dst.fileno(), self.pending,
+                                      flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        if self.eof and not self.done:
+            # Полузакрытие: src закончил писать - сообщаем об этом dst, обратное направление живет
+            self.done = True
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def close(self):
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+
+class Tunnel:
+    def __init__(self, tunnel_id, client, upstream, target, early_data):
+        self.id = tunnel_id
+        self.client = client
+        self.upstream = upstream
+        self.target = target
+        # Байты, которые клиент прислал сразу за заголовками CONNECT (например, TLS ClientHello)
+        self.sent = Relay(client, upstream, early_data)
+        self.sent.bytes = len(early_data)
+        self.received = Relay(upstream, client, ESTABLISHED)
+        self.created = time.monotonic()
+        self.last_activity = self.created
+        self.masks = {client: 0, upstream: 0}
+
+    def relays(self):
+        return self.sent, self.received
+
+    def events(self, sock):
+        mask = 0
+        for relay in self.relays():
+            if relay.src is sock and relay.wants_read():
+                mask |= selectors.EVENT_READ
+            if relay.dst is sock and relay.wants_write():
+                mask |= selectors.EVENT_WRITE
+        return mask
+
+    def finished(self):
+        return self.sent.done and self.received.done
+
+    def snapshot(self, now=None):
+        now = now or time.monotonic()
+        return {
+            'id': self.id,
+            'target': self.target,
+            # received включает только данные origin, без строки ответа на CONNECT
+            'bytes_sent': self.sent.bytes,
+            'bytes_received': self.received.bytes,
+            'age': round(now - self.created, 3),
+            'idle': round(now - self.last_activity, 3),
+        }
+
+class Handshake:
+    """Клиент, от которого еще не пришли заголовки CONNECT"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.data = bytearray()
+        self.started = time.monotonic()
+
+class TunnelServer:
+    def __init__(self, host, port):
+        self.allowed_ports = parse_allowed_ports(TUNNEL_ALLOWED_PORTS)
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.create_server((host, port), backlog=1024)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        # Пул сообщает о готовых соединениях через socketpair, чтобы разбудить select
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        self.connect_executor = ThreadPoolExecutor(max_workers=TUNNEL_CONNECT_WORKERS, thread_name_prefix='tunnel-connect')
+        self.connected = deque()
+        self.handshakes = {}
+        self.connecting = 0
+        self.tunnels = {}
+        self.recent = deque(maxlen=RECENT_TUNNELS)
+        self.next_id = 1
+        self.closed_bytes = {'sent': 0, 'received': 0}
+        proxy.metrics.register_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        tunnels = list(self.tunnels.values())
+        sent = self.closed_bytes['sent'] + sum(t.sent.bytes for t in tunnels)
+        received = self.closed_bytes['received'] + sum(t.received.bytes for t in tunnels)
+        return [
+            ('dh_proxy_tunnel_bytes_total', (('direction', 'sent'),), sent),
+            ('dh_proxy_tunnel_bytes_total', (('direction', 'received'),), received),
+            ('dh_proxy_tunnels_active', (), len(tunnels)),
+        ]
+
+    def get_stats(self):
+        now = time.monotonic()
+        return {
+            'active': [tunnel.snapshot(now) for tunnel in self.tunnels.values()],
+            'recent': list(self.recent),
+            'connecting': self.connecting,
+            'bytes_sent': self.closed_bytes['sent'] + sum(t.sent.bytes for t in self.tunnels.values()),
+            'bytes_received': self.closed_bytes['received'] + sum(t.received.bytes for t in self.tunnels.values()),
+            'splice': TUNNEL_SPLICE,
+        }
+
+    def serve_forever(self):
+        last_sweep = time.monotonic()
+        while True:
+            for key, mask in self.selector.select(timeout=1):
+                if key.fileobj is self.listener:
+                    self.accept()
+                elif key.fileobj is self.wakeup_reader:
+                    self.finish_connects()
+                elif isinstance(key.data, Handshake):
+                    self.read_handshake(key.data)
+                else:
+                    self.relay(key.data, key.fileobj, mask)
+            now = time.monotonic()
+            if now - last_sweep >= 1:
+                last_sweep = now
+                self.sweep(now)
+
+    def accept(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except BlockingIOError:
+                return
+            except OSError:
+                # EMFILE и подобное: попробуем на следующей итерации петли
+                return
+            count_tunnel_event('accepted')
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            handshake = Handshake(sock)
+            self.handshakes[sock] = handshake
+            self.selector.register(sock, selectors.EVENT_READ, handshake)
+
+    def drop_handshake(self, handshake):
+        self.handshakes.pop(handshake.sock, None)
+        try:
+            self.selector.unregister(handshake.sock)
+        except (KeyError, ValueError):
+            pass
+
+    def reply(self, handshake, status, body=b'', content_type='text/plain', extra=''):
+        """Короткий ответ вместо туннеля; сокет закрывается"""
+        self.drop_handshake(handshake)
+        head = (
+            f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+            f'Connection: close\r\nX-Proxy-Server: DH-PROXY/2.0\r\n{extra}\r\n'
+        ).encode('latin-1')
+        try:
+            handshake.sock.settimeout(1)
+            handshake.sock.sendall(head + body)
+        except OSError:
+            pass
+        handshake.sock.close()
+
+    def read_handshake(self, handshake):
+        try:
+            data = handshake.sock.recv(MAX_HEADER_BYTES)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.drop_handshake(handshake)
+            handshake.sock.close()
+            return
+        handshake.data += data
+        end = handshake.data.find(b'\r\n\r\n')
+        if end < 0:
+            if len(handshake.data) > MAX_HEADER_BYTES:
+                self.reply(handshake, '431 Request Header Fields Too Large')
+            return
+
+        request_line = bytes(handshake.data[:handshake.data.find(b'\r\n')]).decode('latin-1')
+        early_data = bytes(handshake.data[end + 4:])
+        method, _, rest = request_line.partition(' ')
+        target = rest.partition(' ')[0]
+
+        if method == 'GET' and target in ('/admin/tunnels', '/metrics'):
+            headers = parse_headers(bytes(handshake.data[:end]).decode('latin-1'))
+            if not proxy.is_trusted_admin(peer_address(handshake.sock), headers):
+                self.reply(handshake, '403 Forbidden', json.dumps({'error': 'forbidden'}).encode(), 'application/json')
+                return
+        if method == 'GET' and target == '/admin/tunnels':
+            self.reply(handshake, '200 OK', json.dumps(self.get_stats()).encode(), 'application/json')
+            return
+        if method == 'GET' and target == '/metrics':
+            self.reply(handshake, '200 OK', proxy.metrics.render().encode(), 'text/plain; version=0.0.4')
+            return
+        if method != 'CONNECT':
+            self.reply(handshake, '405 Method Not Allowed', b'Proxy Error: only CONNECT is supported', extra='Allow: CONNECT\r\n')
+            return
+
+        authority = parse_authority(target)
+        if authority is None:
+            self.reply(handshake, '400 Bad Request', b'Proxy Error: CONNECT target must be host:port')
+            return
+        if self.allowed_ports is not None and authority[1] not in self.allowed_ports:
+            count_tunnel_event('rejected')
+            self.reply(handshake, '403 Forbidden', b'Proxy Error: port is not allowed')
+            return
+        if len(self.tunnels) + self.connecting >= TUNNEL_MAX_TUNNELS:
+            count_tunnel_event('rejected')
+            self.reply(handshake, '503 Service Unavailable', b'Proxy Error: too many tunnels', extra='Retry-After: 1\r\n')
+            return
+
+        # Пока идет connect, сокет клиента не слушаем: ранние данные дочитаем уже в туннель
+        self.drop_handshake(handshake)
+        self.connecting += 1
+        future = self.connect_executor.submit(open_upstream, *authority)
+        future.add_done_callback(lambda f: self.connect_done(handshake, target, early_data, f))
+
+    def connect_done(self, handshake, target, early_data, future):
+        # Поток пула: только передаем результат в петлю
+        self.connected.append((handshake, target, early_data, future))
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass
+
+    def finish_connects(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.connected:
+            handshake, target, early_data, future = self.connected.popleft()
+            self.connecting -= 1
+            try:
+                upstream = future.result()
+            except Exception as e:
+                # Любая ошибка connect закрывает только этого клиента, а не петлю
+                count_tunnel_event('connect_failed')
+                if isinstance(e, socket.timeout):
+                    status = '504 Gateway Timeout'
+                elif isinstance(e, ValueError):
+                    status = '400 Bad Request'
+                else:
+                    status = '502 Bad Gateway'
+                self.reply(handshake, status, f'Proxy Error: {e}'.encode('utf-8', 'replace'))
+                continue
+            upstream.setblocking(False)
+            tunnel = Tunnel(self.next_id, handshake.sock, upstream, target, early_data)
+            self.next_id += 1
+            self.tunnels[tunnel.id] = tunnel
+            count_tunnel_event('established')
+            self.pump(tunnel)
+
+    def pump(self, tunnel):
+        """Двигает данные по обоим направлениям, пока сокеты не заблокируются"""
+        try:
+            for relay in tunnel.relays():
+                if relay.wants_write():
+                    relay.write()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.close_tunnel(tunnel, 'errors')
+            return
+        self.update(tunnel)
+
+    def relay(self, tunnel, sock, mask):
+        tunnel.last_activity = time.monotonic()
+        try:
+            for relay in tunnel.relays():
+                if mask & selectors.EVENT_WRITE and relay.dst is sock and relay.wants_write():
+                    relay.write()
+                if mask & selectors.EVENT_READ and relay.src is sock and relay.wants_read():
+                    try:
+                        relay.read()
+                    except BlockingIOError:
+                        continue
+                    # Сразу пробуем отдать прочитанное, не дожидаясь следующего select
+                    try:
+                        relay.write()
+                    except BlockingIOError:
+                        pass
+        except OSError:
+            # Сброс соединения одной из сторон - туннель целиком закрывается
+            self.close_tunnel(tunnel, 'errors')
+            return
+        if tunnel.finished():
+            self.close_tunnel(tunnel)
+            return
+        self.update(tunnel)
+
+    def update(self, tunnel):
+        for sock in (tunnel.client, tunnel.upstream):
+            mask = tunnel.events(sock)
+            current = tunnel.masks[sock]
+            if mask == current:
+                continue
+            if not mask:
+                self.selector.unregister(sock)
+            elif not current:
+                self.selector.register(sock, mask, tunnel)
+            else:
+                self.selector.modify(sock, mask, tunnel)
+            tunnel.masks[sock] = mask
+
+    def close_tunnel(self, tunnel, reason=None):
+        if self.tunnels.pop(tunnel.id, None) is None:
+            return
+        if reason:
+            count_tunnel_event(reason)
+        for sock in (tunnel.client, tunnel.upstream):
+            if tunnel.masks[sock]:
+                self.selector.unregister(sock)
+            sock.close()
+        for relay in tunnel.relays():
+            relay.close()
+        self.closed_bytes['sent'] += tunnel.sent.bytes
+        self.closed_bytes['received'] += tunnel.received.bytes
+        snapshot = tunnel.snapshot()
+        snapshot['closed'] = reason or 'done'
+        self.recent.append(snapshot)
+
+    def sweep(self, now):
+        for handshake in list(self.handshakes.values()):
+            if now - handshake.started > TUNNEL_HANDSHAKE_TIMEOUT:
+                self.reply(handshake, '408 Request Timeout')
+        for tunnel in list(self.tunnels.values()):
+            if now - tunnel.last_activity > TUNNEL_IDLE_TIMEOUT:
+                self.close_tunnel(tunnel, 'idle_timeouts')
+
+if __name__ == '__main__':
+    TunnelServer('0.0.0.0', TUNNEL_PORT).serve_forever()
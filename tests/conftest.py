@@ -0,0 +1,105 @@
+"""
+Общие фикстуры тестов: временный каталог дискового кэша (до импорта proxy) и
+локальный origin, у которого каждый тест сам задает ответы по путям.
+"""
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('PROXY_CACHE_DIR', tempfile.mkdtemp(prefix='dh-proxy-test-'))
+
+class OriginRequest:
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+class Origin:
+    """
+    Origin на случайном порту. route(path, ...) задает ответ: статус, заголовки и тело
+    или функцию OriginRequest -> (статус, заголовки, тело). Все запросы пишутся в requests.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path, host='127.0.0.1'):
+        return f'http://{host}:{self.port}{path}'
+
+    def route(self, path, status=200, headers=None, body=b''):
+        if callable(status):
+            self.routes[path] = status
+        else:
+            self.routes[path] = lambda request: (status, dict(headers or {}), body)
+
+    def hits(self, path):
+        with self.lock:
+            return sum(1 for request in self.requests if request.path == path)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _make_handler(self):
+        origin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                request = OriginRequest(self.command, self.path, self.headers, body)
+                with origin.lock:
+                    origin.requests.append(request)
+                handler = origin.routes.get(self.path)
+                if handler is None:
+                    status, headers, body = 404, {}, b'not found'
+                else:
+                    status, headers, body = handler(request)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = do_PATCH = _handle
+
+        return Handler
+
+@pytest.fixture
+def origin():
+    server = Origin()
+    yield server
+    server.close()
+
+@pytest.fixture
+def client():
+    import proxy
+    return proxy.app.test_client()
+
+def get(client, url, headers=None):
+    """(статус, заголовки, тело) ответа прокси на GET /url=url"""
+    response = client.get('/url=' + url, headers=headers or {})
+    try:
+        return response.status_code, response.headers, response.get_data()
+    finally:
+        response.close()
@@ -0,0 +1,42 @@
+def echo_auth(request):
+    return 200, {}, f'{request.method} {request.headers.get("Authorization")} {request.headers.get("Cookie")}'.encode()
+
+def send(client, method, url, headers=None):
+    response = client.open('/url=' + url, method=method, data=b'payload', headers=headers or {})
+    try:
+        return response.status_code, response.headers, response.get_data()
+    finally:
+        response.close()
+
+CREDENTIALS = {'Authorization': 'Bearer secret', 'Cookie': 'sid=1'}
+
+def test_post_redirect_to_other_host_drops_credentials(client, origin):
+    origin.route('/form', 302, {'Location': origin.url('/done', host='localhost')})
+    origin.route('/done', echo_auth)
+    status, _, body = send(client, 'POST', origin.url('/form'), CREDENTIALS)
+    assert (status, body) == (200, b'GET None None')
+
+def test_post_redirect_to_same_host_keeps_authorization_only(client, origin):
+    origin.route('/form', 303, {'Location': '/done'})
+    origin.route('/done', echo_auth)
+    status, _, body = send(client, 'POST', origin.url('/form'), CREDENTIALS)
+    assert (status, body) == (200, b'GET Bearer secret None')
+
+def test_put_with_302_is_returned_to_client(client, origin):
+    origin.route('/resource', 302, {'Location': '/elsewhere?x=1'})
+    status, headers, _ = send(client, 'PUT', origin.url('/resource'))
+    assert status == 302
+    assert headers['Location'] == '/url=' + origin.url('/elsewhere%3Fx=1')
+    assert origin.hits('/elsewhere?x=1') == 0
+
+def test_put_with_303_becomes_get(client, origin):
+    origin.route('/resource', 303, {'Location': '/status'})
+    origin.route('/status', echo_auth)
+    status, _, body = send(client, 'PUT', origin.url('/resource'))
+    assert (status, body) == (200, b'GET None None')
+
+def test_307_location_is_rewritten_for_the_proxy(client, origin):
+    origin.route('/upload', 307, {'Location': origin.url('/upload2', host='localhost')})
+    status, headers, _ = send(client, 'POST', origin.url('/upload'))
+    assert status == 307
+    assert headers['Location'] == '/url=' + origin.url('/upload2', host='localhost')
@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+import proxy
+
+@pytest.fixture
+def breaker(monkeypatch):
+    monkeypatch.setattr(proxy, 'BREAKER_MIN_REQUESTS', 4)
+    monkeypatch.setattr(proxy, 'BREAKER_FAILURE_RATE', 0.5)
+    monkeypatch.setattr(proxy, 'BREAKER_OPEN_SECONDS', 0.1)
+    monkeypatch.setattr(proxy, 'BREAKER_HALF_OPEN_PROBES', 1)
+    monkeypatch.setattr(proxy, 'BREAKER_HALF_OPEN_SUCCESSES', 2)
+    return proxy.CircuitBreaker('origin.test')
+
+def fail(breaker, kind='connection'):
+    probe = breaker.before_request()
+    breaker.record(False, 0.01, probe, kind)
+
+def succeed(breaker):
+    probe = breaker.before_request()
+    breaker.record(True, 0.01, probe)
+
+def test_opens_after_failure_rate_with_enough_requests(breaker):
+    succeed(breaker)
+    succeed(breaker)
+    fail(breaker)
+    assert breaker.state == 'closed'
+    fail(breaker)
+    assert breaker.state == 'open'
+    with pytest.raises(proxy.CircuitOpenError):
+        breaker.before_request()
+    assert breaker.snapshot()['rejected'] == 1
+
+def test_timeouts_are_rejected_as_timeouts(breaker):
+    for _ in range(4):
+        fail(breaker, 'timeout')
+    with pytest.raises(proxy.CircuitOpenTimeout):
+        breaker.before_request()
+
+def test_half_open_allows_one_probe_and_closes_after_successes(breaker):
+    for _ in range(4):
+        fail(breaker)
+    time.sleep(0.15)
+    assert breaker.before_request() is True
+    with pytest.raises(proxy.CircuitOpenError):
+        breaker.before_request()
+    breaker.record(True, 0.01, True)
+    succeed(breaker)
+    assert breaker.state == 'closed'
+
+def test_failed_probe_reopens(breaker):
+    for _ in range(4):
+        fail(breaker)
+    time.sleep(0.15)
+    fail(breaker)
+    assert breaker.state == 'open'
+
+def test_slow_success_counts_as_failure(breaker, monkeypatch):
+    monkeypatch.setattr(proxy, 'BREAKER_SLOW_CALL_SECONDS', 0.5)
+    for _ in range(4):
+        probe = breaker.before_request()
+        breaker.record(True, 1.0, probe)
+    assert breaker.state == 'open'
+    assert breaker.snapshot()['last_failure'] == 'timeout'
+
+def test_open_breaker_fails_proxy_request_fast(client, origin, monkeypatch):
+    monkeypatch.setattr(proxy, 'BREAKER_MIN_REQUESTS', 1)
+    url = origin.url('/down')
+    breaker = proxy.get_breaker(url)
+    fail(breaker)
+    response = client.get('/url=' + url)
+    assert response.status_code == 502
+    assert origin.hits('/down') == 0
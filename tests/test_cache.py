@@ -0,0 +1,132 @@
+import os
+import time
+
+import proxy
+
+from conftest import get
+
+def etag_route(max_age):
+    """Ответ с ETag, на If-None-Match с тем же ETag - 304"""
+    def handler(request):
+        headers = {'Cache-Control': f'max-age={max_age}', 'ETag': '"v1"', 'Content-Type': 'text/plain'}
+        if request.headers.get('If-None-Match') == '"v1"':
+            return 304, headers, b''
+        return 200, headers, b'body v1'
+    return handler
+
+def test_fresh_response_is_served_from_cache(client, origin):
+    origin.route('/fresh', 200, {'Cache-Control': 'max-age=60'}, b'cached body')
+    url = origin.url('/fresh')
+
+    status, headers, body = get(client, url)
+    assert (status, headers['X-Cache'], body) == (200, 'MISS', b'cached body')
+    status, headers, body = get(client, url)
+    assert (status, headers['X-Cache'], body) == (200, 'HIT', b'cached body')
+    assert 'Age' in headers
+    assert origin.hits('/fresh') == 1
+
+def test_no_store_is_not_cached(client, origin):
+    origin.route('/private', 200, {'Cache-Control': 'no-store'}, b'secret')
+    url = origin.url('/private')
+    get(client, url)
+    assert get(client, url)[1]['X-Cache'] == 'MISS'
+    assert origin.hits('/private') == 2
+
+def test_client_no_cache_skips_fresh_entry(client, origin):
+    origin.route('/fresh', 200, {'Cache-Control': 'max-age=60'}, b'cached body')
+    url = origin.url('/fresh')
+    get(client, url)
+    get(client, url, {'Cache-Control': 'no-cache'})
+    assert origin.hits('/fresh') == 2
+
+def test_temporary_redirect_target_is_not_cached_under_source(client, origin):
+    origin.route('/docs', 302, {'Location': '/docs/'})
+    origin.route('/docs/', 200, {'Cache-Control': 'max-age=60'}, b'index')
+    url = origin.url('/docs')
+    get(client, url)
+    assert get(client, url)[1]['X-Cache'] == 'MISS'
+
+def test_stale_entry_is_revalidated_with_etag(client, origin):
+    origin.route('/etag', etag_route(0))
+    url = origin.url('/etag')
+
+    assert get(client, url)[1]['X-Cache'] == 'MISS'
+    status, headers, body = get(client, url)
+    assert (status, headers['X-Cache'], body) == (200, 'REVALIDATED', b'body v1')
+    assert origin.requests[-1].headers.get('If-None-Match') == '"v1"'
+
+def test_origin_stale_while_revalidate_serves_stale(client, origin):
+    origin.route('/swr', 200, {'Cache-Control': 'max-age=0, stale-while-revalidate=60'}, b'old')
+    url = origin.url('/swr')
+    get(client, url)
+    status, headers, body = get(client, url)
+    assert (status, headers['X-Cache'], body) == (200, 'STALE', b'old')
+    assert headers['Warning'] == proxy.STALE_WARNING
+
+def test_stale_while_revalidate_default_is_opt_in(client, origin, monkeypatch):
+    monkeypatch.setattr(proxy, 'CACHE_STALE_WHILE_REVALIDATE', 60)
+    origin.route('/etag', etag_route(0))
+    url = origin.url('/etag')
+    get(client, url)
+    assert get(client, url)[1]['X-Cache'] == 'STALE'
+
+def failing_after_first(headers, body):
+    """Первый ответ - 200 с headers, следующие - 500"""
+    state = {'calls': 0}
+    def handler(request):
+        state['calls'] += 1
+        if state['calls'] == 1:
+            return 200, headers, body
+        return 500, {}, b'origin down'
+    return handler
+
+def test_origin_stale_if_error_serves_stale_on_5xx(client, origin):
+    origin.route('/sie', failing_after_first({'Cache-Control': 'max-age=0, stale-if-error=300'}, b'old'))
+    url = origin.url('/sie')
+    get(client, url)
+    status, headers, body = get(client, url)
+    assert (status, headers['X-Cache'], body) == (200, 'STALE', b'old')
+    assert headers['Warning'] == proxy.REVALIDATION_FAILED_WARNING
+
+def test_error_is_passed_through_without_stale_if_error(client, origin):
+    origin.route('/plain', failing_after_first({'Cache-Control': 'max-age=0'}, b'old'))
+    url = origin.url('/plain')
+    get(client, url)
+    status, _, body = get(client, url)
+    assert (status, body) == (500, b'origin down')
+
+def make_entry(cache, url, body):
+    now = time.time()
+    return proxy.CacheEntry(cache.make_key(url, {}), url, 200, [], [], now, now, len(body), body)
+
+def test_shared_blob_survives_eviction_during_store(tmp_path, monkeypatch):
+    cache = proxy.ResponseCache(0, 1024 * 1024, str(tmp_path), 1024 * 1024)
+    cache.store(make_entry(cache, 'http://a.test/', b'same body'))
+    second = make_entry(cache, 'http://b.test/', b'same body')
+
+    write_disk = cache._write_disk
+    def write_after_purge(entry, write_blob):
+        # Запись с тем же телом удаляется между решением не писать блоб и сохранением
+        cache.purge('http://a.test/')
+        return write_disk(entry, write_blob)
+    monkeypatch.setattr(cache, '_write_disk', write_after_purge)
+    cache.store(second)
+
+    assert os.path.exists(cache._blob_path(second.digest))
+    assert cache.lookup('http://b.test/', {}).body == b'same body'
+
+def test_admin_routes_are_loopback_only_without_token(client, monkeypatch):
+    monkeypatch.setattr(proxy, 'ADMIN_TOKEN', None)
+    for path in ('/admin/cache', '/admin/dns', '/metrics'):
+        assert client.get(path).status_code == 200
+        assert client.get(path, environ_base={'REMOTE_ADDR': '203.0.113.5'}).status_code == 403
+    response = client.post('/admin/cache/purge?prefix=http://example.com/',
+                           environ_base={'REMOTE_ADDR': '203.0.113.5'})
+    assert response.status_code == 403
+
+def test_admin_routes_require_configured_token(client, monkeypatch):
+    monkeypatch.setattr(proxy, 'ADMIN_TOKEN', 'secret')
+    assert client.get('/admin/cache').status_code == 403
+    assert client.get('/admin/cache', headers={'X-Admin-Token': 'wrong'}).status_code == 403
+    assert client.get('/admin/cache', headers={'X-Admin-Token': 'secret'}).status_code == 200
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
@@ -0,0 +1,56 @@
+import threading
+import time
+
+import proxy
+
+from conftest import get
+
+def slow_route(headers, body_for):
+    """Отвечает через 0.3 с, чтобы одинаковые запросы успели объединиться"""
+    def handler(request):
+        time.sleep(0.3)
+        return 200, dict(headers), body_for(request)
+    return handler
+
+def fetch_concurrently(url, headers_list):
+    results = [None] * len(headers_list)
+
+    def run(index, headers):
+        results[index] = get(proxy.app.test_client(), url, headers)
+
+    threads = [threading.Thread(target=run, args=(i, h)) for i, h in enumerate(headers_list)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_identical_requests_share_one_upstream_fetch(origin):
+    origin.route('/shared', slow_route({'Cache-Control': 'no-cache'}, lambda request: b'shared body'))
+    results = fetch_concurrently(origin.url('/shared'), [{}, {}, {}])
+    assert [body for _, _, body in results] == [b'shared body'] * 3
+    assert origin.hits('/shared') == 1
+
+def test_private_response_is_not_fanned_out(origin):
+    counter = iter(range(100))
+    origin.route('/private', slow_route(
+        {'Cache-Control': 'private, no-store', 'Set-Cookie': 'sid=1'},
+        lambda request: f'user {next(counter)}'.encode()
+    ))
+    results = fetch_concurrently(origin.url('/private'), [{}, {}])
+    assert {body for _, _, body in results} == {b'user 0', b'user 1'}
+    assert origin.hits('/private') == 2
+
+def test_requests_with_different_credentials_are_not_coalesced(origin):
+    origin.route('/api', slow_route({}, lambda request: request.headers['X-Api-Key'].encode()))
+    results = fetch_concurrently(origin.url('/api'), [{'X-Api-Key': 'alice'}, {'X-Api-Key': 'bob'}])
+    assert [body for _, _, body in results] == [b'alice', b'bob']
+    assert origin.hits('/api') == 2
+
+def test_follower_with_other_vary_value_refetches(origin):
+    origin.route('/lang', slow_route(
+        {'Vary': 'User-Agent'}, lambda request: request.headers['User-Agent'].encode()
+    ))
+    results = fetch_concurrently(origin.url('/lang'), [{'User-Agent': 'a'}, {'User-Agent': 'b'}])
+    assert [body for _, _, body in results] == [b'a', b'b']
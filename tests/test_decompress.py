@@ -0,0 +1,44 @@
+import gzip
+import os
+import zlib
+
+import brotli
+import pytest
+
+import proxy
+
+def decompress_all(decompressor, data, step=1000):
+    chunks = []
+    for offset in range(0, len(data), step):
+        chunks.extend(decompressor.decompress(data[offset:offset + step]))
+    chunks.append(decompressor.flush())
+    return chunks
+
+def test_gzip_members_are_all_decoded():
+    data = gzip.compress(b'a' * 100000) + gzip.compress(b'b' * 100000)
+    body = b''.join(decompress_all(proxy.StreamDecompressor('gzip'), data, step=7))
+    assert body == b'a' * 100000 + b'b' * 100000
+
+def test_gzip_trailing_garbage_after_member_is_ignored():
+    data = gzip.compress(b'payload') + b'\x00' * 16
+    assert b''.join(decompress_all(proxy.StreamDecompressor('gzip'), data)) == b'payload'
+
+def test_gzip_invalid_first_member_raises():
+    with pytest.raises(zlib.error):
+        decompress_all(proxy.StreamDecompressor('gzip'), b'not gzip at all')
+
+def test_raw_deflate_is_detected():
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(b'raw deflate ' * 100) + compressor.flush()
+    assert b''.join(decompress_all(proxy.StreamDecompressor('deflate'), data)) == b'raw deflate ' * 100
+
+def test_brotli_output_is_bounded_per_chunk():
+    raw = os.urandom(1000) + b'\x00' * (32 * 1024 * 1024)
+    bomb = brotli.compress(raw)
+    decompressor = proxy.StreamDecompressor('br', max_output=64 * 1024)
+    total = 0
+    for chunk in decompressor.decompress(bomb):
+        # Буфер brotli может чуть перерасти лимит, но не на порядки
+        assert len(chunk) <= 2 * 64 * 1024
+        total += len(chunk)
+    assert total == len(raw)
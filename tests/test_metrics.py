@@ -0,0 +1,25 @@
+import threading
+
+import proxy
+
+def test_counters_from_short_lived_threads_are_summed():
+    metrics = proxy.Metrics(shards=4)
+    metrics.describe('requests_total', 'counter', 'requests')
+    metrics.describe('duration_seconds', 'histogram', 'duration', buckets=(0.1, 1))
+    labels = (('route', 'test'),)
+
+    def handle():
+        metrics.inc('requests_total', labels)
+        metrics.observe('duration_seconds', 0.5, labels)
+
+    # Поток на запрос, как у Flask с threaded=True
+    for _ in range(20):
+        threads = [threading.Thread(target=handle) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    counters, histograms = metrics.snapshot()
+    assert counters[('requests_total', labels)] == 200
+    assert histograms[('duration_seconds', labels)] == [0, 200, 0, 100.0]
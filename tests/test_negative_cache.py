@@ -0,0 +1,63 @@
+import socket
+
+import proxy
+
+from conftest import get
+
+def negative_hits(kind):
+    values = proxy.metrics.counter_values('dh_proxy_negative_cache_events_total')
+    return values.get((('event', 'hits'), ('kind', kind)), 0)
+
+def test_not_found_is_answered_from_negative_cache(client, origin):
+    origin.route('/missing', 404, {}, b'no such page')
+    url = origin.url('/missing')
+    assert get(client, url)[:3:2] == (404, b'no such page')
+    status, headers, body = get(client, url)
+    assert (status, headers['X-Cache'], body) == (404, 'NEGATIVE', b'no such page')
+    assert origin.hits('/missing') == 1
+
+def test_client_no_cache_bypasses_negative_cache(client, origin):
+    origin.route('/missing', 404, {}, b'no such page')
+    url = origin.url('/missing')
+    get(client, url)
+    get(client, url, {'Cache-Control': 'no-cache'})
+    assert origin.hits('/missing') == 2
+
+def test_no_store_not_found_is_not_remembered(client, origin):
+    origin.route('/missing', 404, {'Cache-Control': 'no-store'}, b'no such page')
+    url = origin.url('/missing')
+    get(client, url)
+    get(client, url)
+    assert origin.hits('/missing') == 2
+
+def test_not_found_after_temporary_redirect_is_not_remembered(client, origin):
+    origin.route('/old', 302, {'Location': '/gone'})
+    url = origin.url('/old')
+    get(client, url)
+    get(client, url)
+    assert origin.hits('/old') == 2
+
+def test_successful_post_forgets_not_found(client, origin):
+    state = {'created': False}
+    def item(request):
+        if request.method == 'POST':
+            state['created'] = True
+            return 201, {}, b'created'
+        return (200, {}, b'item') if state['created'] else (404, {}, b'no item')
+    origin.route('/item', item)
+    url = origin.url('/item')
+    get(client, url)
+    assert client.post('/url=' + url, data=b'new').status_code == 201
+    assert get(client, url)[:3:2] == (200, b'item')
+
+def test_refused_host_is_failed_without_connecting(client):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    url = f'http://127.0.0.1:{port}/'
+
+    assert get(client, url)[0] == 502
+    hits = negative_hits('refused')
+    assert get(client, url)[0] == 502
+    assert negative_hits('refused') == hits + 1
@@ -0,0 +1,113 @@
+"""
+Сквозной smoke-тест асинхронного движка: proxy_async поверх локального origin,
+ответы identity, gzip и 206 проходят через prepare_response_body и BodyTranscoder,
+редиректы проходятся вручную по тем же правилам, что и в proxy.py.
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+import gzip
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import proxy_async
+
+BODY = b'hello from origin ' * 100
+
+class OriginHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        status, headers, body = 200, {'Content-Type': 'text/plain'}, BODY
+        if self.path == '/gzip':
+            headers['Content-Encoding'] = 'gzip'
+            body = gzip.compress(BODY)
+        elif self.path == '/range':
+            status = 206
+            headers['Content-Range'] = f'bytes 0-9/{len(BODY)}'
+            body = BODY[:10]
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture(scope='module')
+def origin_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OriginHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+def fetch(path, headers=None, method='GET', data=None):
+    """(статус, заголовки, тело) ответа proxy_async на запрос к path"""
+    async def run():
+        async with TestClient(TestServer(proxy_async.create_app())) as client:
+            response = await client.request(
+                method, path, headers=headers or {}, data=data, auto_decompress=False, allow_redirects=False
+            )
+            return response.status, response.headers, await response.read()
+    return asyncio.run(run())
+
+def test_identity(origin_url):
+    status, headers, body = fetch(f'/url={origin_url}/plain')
+    assert status == 200
+    assert body == BODY
+    assert headers['Access-Control-Allow-Origin'] == '*'
+
+def test_gzip_passthrough(origin_url):
+    status, headers, body = fetch(f'/url={origin_url}/gzip', {'Accept-Encoding': 'gzip'})
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(body) == BODY
+
+def test_gzip_decoded_for_identity_client(origin_url):
+    status, headers, body = fetch(f'/url={origin_url}/gzip', {'Accept-Encoding': 'identity'})
+    assert status == 200
+    assert 'Content-Encoding' not in headers
+    assert body == BODY
+
+def test_partial_content(origin_url):
+    status, headers, body = fetch(f'/url={origin_url}/range', {'Range': 'bytes=0-9'})
+    assert status == 206
+    assert headers['Content-Range'] == f'bytes 0-9/{len(BODY)}'
+    assert body == BODY[:10]
+
+def echo_request(request):
+    return 200, {}, f'{request.method} {request.headers.get("Authorization")} {request.body!r}'.encode()
+
+def test_redirect_to_other_host_drops_authorization(origin):
+    origin.route('/start', 302, {'Location': origin.url('/target', host='localhost')})
+    origin.route('/target', echo_request)
+    status, _, body = fetch(f'/url={origin.url("/start")}', {'Authorization': 'Bearer secret'})
+    assert (status, body) == (200, b"GET None b''")
+
+def test_redirect_on_same_host_keeps_authorization(origin):
+    origin.route('/start', 301, {'Location': '/target'})
+    origin.route('/target', echo_request)
+    status, _, body = fetch(f'/url={origin.url("/start")}', {'Authorization': 'Bearer secret'})
+    assert (status, body) == (200, b"GET Bearer secret b''")
+
+def test_post_303_is_followed_with_get(origin):
+    origin.route('/form', 303, {'Location': '/done'})
+    origin.route('/done', echo_request)
+    status, _, body = fetch(f'/url={origin.url("/form")}', method='POST', data=b'payload')
+    assert (status, body) == (200, b"GET None b''")
+
+def test_post_307_is_returned_with_proxied_location(origin):
+    origin.route('/upload', 307, {'Location': '/upload2'})
+    status, headers, _ = fetch(f'/url={origin.url("/upload")}', method='POST', data=b'payload')
+    assert status == 307
+    assert headers['Location'] == '/url=' + origin.url('/upload2')
+    assert origin.hits('/upload2') == 0
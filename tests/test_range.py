@@ -0,0 +1,51 @@
+import pytest
+
+import proxy
+
+from conftest import get
+
+BODY = b'0123456789'
+HEADERS = {'Cache-Control': 'max-age=60', 'Content-Type': 'application/octet-stream', 'ETag': '"v1"'}
+
+@pytest.fixture
+def cached_url(client, origin):
+    origin.route('/file', 200, HEADERS, BODY)
+    url = origin.url('/file')
+    assert get(client, url)[1]['X-Cache'] == 'MISS'
+    return url
+
+def test_range_is_sliced_from_cache(client, origin, cached_url):
+    status, headers, body = get(client, cached_url, {'Range': 'bytes=2-5'})
+    assert (status, headers['X-Cache'], body) == (206, 'HIT', b'2345')
+    assert headers['Content-Range'] == 'bytes 2-5/10'
+    assert origin.hits('/file') == 1
+
+def test_suffix_range_from_cache(client, cached_url):
+    status, headers, body = get(client, cached_url, {'Range': 'bytes=-3'})
+    assert (status, body) == (206, b'789')
+    assert headers['Content-Range'] == 'bytes 7-9/10'
+
+def test_range_past_end_is_not_satisfiable(client, cached_url):
+    status, headers, _ = get(client, cached_url, {'Range': 'bytes=20-'})
+    assert status == 416
+    assert headers['Content-Range'] == 'bytes */10'
+
+def test_if_range_mismatch_goes_to_origin(client, origin, cached_url):
+    status, headers, body = get(client, cached_url, {'Range': 'bytes=2-5', 'If-Range': '"v0"'})
+    assert (status, headers['X-Cache'], body) == (200, 'BYPASS', BODY)
+    assert origin.hits('/file') == 2
+
+def test_origin_partial_content_is_passed_through(client, origin):
+    origin.route('/partial', 206, {'Content-Range': 'bytes 0-3/10', 'Content-Type': 'text/html'}, b'<htm')
+    status, headers, body = get(client, origin.url('/partial'), {'Range': 'bytes=0-3'})
+    assert (status, headers['X-Cache'], body) == (206, 'BYPASS', b'<htm')
+    assert headers['Content-Range'] == 'bytes 0-3/10'
+
+@pytest.mark.parametrize('value', ['bytes=-5', 'bytes=0-'])
+def test_any_range_of_empty_body_is_not_satisfiable(value):
+    with pytest.raises(proxy.RangeNotSatisfiable):
+        proxy.parse_byte_range(value, 0)
+
+def test_unparsable_range_is_left_to_origin():
+    assert proxy.parse_byte_range('bytes=0-1,4-5', 10) is None
+    assert proxy.parse_byte_range('items=0-1', 10) is None
@@ -0,0 +1,45 @@
+from conftest import get
+
+def test_permanent_redirect_is_learned(client, origin):
+    origin.route('/old', 301, {'Location': '/new'})
+    origin.route('/new', 200, {}, b'new')
+    get(client, origin.url('/old'))
+    assert get(client, origin.url('/old'))[2] == b'new'
+    assert origin.hits('/old') == 1
+
+def test_redirect_with_vary_is_not_learned(client, origin):
+    def by_language(request):
+        target = '/ru/' if 'ru' in (request.headers.get('Accept-Language') or '') else '/en/'
+        return 301, {'Location': target, 'Vary': 'Accept-Language'}, b''
+    origin.route('/', by_language)
+    origin.route('/ru/', 200, {}, b'ru')
+    origin.route('/en/', 200, {}, b'en')
+    assert get(client, origin.url('/'), {'Accept-Language': 'ru'})[2] == b'ru'
+    assert get(client, origin.url('/'), {'Accept-Language': 'en'})[2] == b'en'
+    assert origin.hits('/') == 2
+
+def test_redirect_for_request_with_cookie_is_not_learned(client, origin):
+    origin.route('/account', 301, {'Location': '/account/alice'})
+    origin.route('/account/alice', 200, {}, b'alice')
+    # Заголовок Cookie тестовый клиент Werkzeug заменяет своим хранилищем
+    client.set_cookie('session', 'alice')
+    get(client, origin.url('/account'))
+    client.delete_cookie('session')
+    get(client, origin.url('/account'))
+    assert origin.hits('/account') == 2
+
+def test_public_redirect_for_request_with_cookie_is_learned(client, origin):
+    origin.route('/moved', 301, {'Location': '/here', 'Cache-Control': 'public, max-age=60'})
+    origin.route('/here', 200, {}, b'here')
+    client.set_cookie('session', 'alice')
+    get(client, origin.url('/moved'))
+    client.delete_cookie('session')
+    get(client, origin.url('/moved'))
+    assert origin.hits('/moved') == 1
+
+def test_redirect_for_request_with_authorization_is_not_learned(client, origin):
+    origin.route('/me', 308, {'Location': '/users/alice'})
+    origin.route('/users/alice', 200, {}, b'alice')
+    get(client, origin.url('/me'), {'Authorization': 'Bearer alice'})
+    get(client, origin.url('/me'))
+    assert origin.hits('/me') == 2
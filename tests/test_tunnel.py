@@ -0,0 +1,66 @@
+import socket
+import threading
+
+import pytest
+
+import proxy
+import proxy_tunnel
+
+@pytest.fixture(scope='module')
+def tunnel_address():
+    mp = pytest.MonkeyPatch()
+    mp.setattr(proxy_tunnel, 'TUNNEL_ALLOWED_PORTS', '*')
+    server = proxy_tunnel.TunnelServer('127.0.0.1', 0)
+    mp.undo()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.listener.getsockname()
+
+def send(address, data):
+    """Отправляет data слушателю туннеля и возвращает все, что он ответил до закрытия"""
+    with socket.create_connection(address, timeout=5) as sock:
+        sock.sendall(data)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+def status_line(reply):
+    return reply.split(b'\r\n', 1)[0]
+
+def test_invalid_host_label_is_rejected(tunnel_address):
+    reply = send(tunnel_address, b'CONNECT ' + b'a' * 64 + b'.com:443 HTTP/1.1\r\n\r\n')
+    assert status_line(reply) == b'HTTP/1.1 400 Bad Request'
+
+def test_unexpected_connect_error_closes_only_that_client(tunnel_address, monkeypatch):
+    def broken_upstream(host, port):
+        raise UnicodeError('label too long')
+    monkeypatch.setattr(proxy_tunnel, 'open_upstream', broken_upstream)
+    reply = send(tunnel_address, b'CONNECT example.com:443 HTTP/1.1\r\n\r\n')
+    assert status_line(reply) == b'HTTP/1.1 400 Bad Request'
+    # Петля жива и обслуживает следующих клиентов
+    reply = send(tunnel_address, b'GET /admin/tunnels HTTP/1.1\r\n\r\n')
+    assert status_line(reply) == b'HTTP/1.1 200 OK'
+
+def test_tunnel_relays_bytes_to_origin(tunnel_address, origin):
+    origin.route('/hello', 200, {}, b'through the tunnel')
+    with socket.create_connection(tunnel_address, timeout=5) as sock:
+        sock.sendall(f'CONNECT 127.0.0.1:{origin.port} HTTP/1.1\r\n\r\n'.encode())
+        assert sock.recv(len(proxy_tunnel.ESTABLISHED)) == proxy_tunnel.ESTABLISHED
+        sock.sendall(b'GET /hello HTTP/1.1\r\nHost: origin\r\nConnection: close\r\n\r\n')
+        reply = b''
+        while chunk := sock.recv(65536):
+            reply += chunk
+    assert reply.endswith(b'through the tunnel')
+
+@pytest.mark.parametrize('authority', ['a' * 64 + '.com:443', 'x..y:443', '-a.com:443', 'a.com:0', '[host]:443'])
+def test_parse_authority_rejects_invalid_targets(authority):
+    assert proxy_tunnel.parse_authority(authority) is None
+
+def test_parse_authority_encodes_idna():
+    assert proxy_tunnel.parse_authority('пример.рф:443') == ('xn--e1afmkfd.xn--p1ai', 443)
+
+def test_unencodable_name_is_a_resolution_error():
+    with pytest.raises(socket.gaierror):
+        proxy.query_dns('a' * 64 + '.com')